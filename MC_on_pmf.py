@@ -13,8 +13,9 @@ from ost import *
 import random
 import itertools
 from scipy.interpolate import griddata
+from pmf import SparsePMF
 
-__all__ = ('GenerateTrajectory', 'PlotTrajOnPMF')
+__all__ = ('GenerateTrajectory', 'GenerateTrajectories', 'PlotTrajOnPMF')
 
 kB = 0.0019872041  # kcal/mol
 
@@ -38,6 +39,13 @@ class Node():
 
 
 def MakeGrid(system, num_bins=None):
+  """
+  Grid of points on which the PMF is evaluated and step sizes of the grid along each CV.
+  By default, the grid covers the range of the CVs with *num_bins* points along each CV, except for
+  a :class:`~pmf.SparsePMF`, for which the grid only contains the centers of the bins with data.
+  """
+  if not num_bins and isinstance(system.pmf, SparsePMF):
+    return [tuple(p) for p in system.pmf.points], system.pmf.grid.widths.copy()
   if not num_bins:
     num_bins = [cv.num_bins for cv in system.cv_list]
   xl = []
@@ -58,6 +66,8 @@ class Grid():
 
 
 def PMFOnGrid(pmf, grid):
+  if isinstance(pmf, SparsePMF):
+    return Grid(grid, pmf.GetValues(grid))
   return Grid(grid, griddata(pmf.points, pmf.values, grid))
 
 
@@ -131,10 +141,16 @@ class Network():
       if pmf_grid.values[i] < max_E:
         self.AddNode(grid[i], pmf_grid.values[i], [D.values[i]
                                                    for D in D_grids])
-    for i, node1 in enumerate(self.nodes):
-      for node2 in self.nodes[i + 1:]:
-        v = npy.abs(npy.array(node1.cv_values) - npy.array(node2.cv_values))
-        if all(v <= 1.1 * step_sizes) and npy.sum(v <= 0.1 * step_sizes) == 1:
+    # Nodes one step apart along one of the CVs are linked, found from their position on the grid
+    origin = npy.array(self.nodes[0].cv_values) if self.nodes else None
+    positions = dict((tuple(npy.round((npy.array(n.cv_values) - origin) / step_sizes).astype(int)), n)
+                     for n in self.nodes)
+    for key, node1 in positions.items():
+      for i in range(system.dimensionality):
+        other = list(key)
+        other[i] += 1
+        node2 = positions.get(tuple(other))
+        if node2:
           self.LinkNodes(node1, node2, system.temperature)
 
   def BrownianDynamics(self, init_pos, nsteps=1000, final_nodes=[]):
@@ -234,12 +250,24 @@ def _test_laplace_transform():
 
 
 def autocorrelation(x):
-  x = npy.array(x)
+  """
+  Normalized autocorrelation of *x* for time shifts up to 90% of its length.
+  The lagged products are computed for all shifts at once with an FFT, which makes
+  this usable on long time series (O(N log N) instead of O(N^2)).
+  """
+  x = npy.array(x, dtype=float)
+  n = len(x)
   sm = npy.mean(x * x)
-  #ac=[npy.corrcoef(x[i:],x[:-i])[0,1] for i in range(1,len(x)/2)]
-  ac = [1.0]
-  ac.extend([npy.mean(x[i:] * x[:-i]) / sm for i in range(1, int(0.9 * len(x)))])
-  return npy.array(ac)
+  n_lags = max(int(0.9 * n), 1)
+  # Zero padding to at least 2n avoids the circular wrap-around of the FFT
+  n_fft = 1
+  while n_fft < 2 * n:
+    n_fft *= 2
+  fx = npy.fft.rfft(x, n_fft)
+  sums = npy.fft.irfft(fx * npy.conjugate(fx), n_fft)[:n_lags]
+  ac = sums / (n - npy.arange(n_lags)) / sm
+  ac[0] = 1.0
+  return ac
 
 
 def TrapezoidalIntegration(x, y):
@@ -250,15 +278,49 @@ def TrapezoidalIntegration(x, y):
   return npy.sum(dx * y)
 
 
-def LaplaceTransform(x, y, s_min=0, s_max=5, s_step=0.01):
-  x = npy.array(x)
-  y = npy.array(y)
+def TrapezoidalWeights(x):
+  """
+  Weights *w* of the trapezoidal rule on the points *x*, such that
+  *npy.dot(w, y)* equals *TrapezoidalIntegration(x, y)*.
+  """
+  x = npy.array(x, dtype=float)
+  w = npy.zeros(len(x))
+  dx = x[1:] - x[:-1]
+  w[:-1] += dx / 2.
+  w[1:] += dx / 2.
+  return w
+
+
+def BatchLaplaceTransform(x, y, s, chunk_size=1 << 20):
+  """
+  Laplace transform of *y(x)* evaluated for all the values in *s*. The integral
+  for every *s* is computed as one matrix-vector product between the matrix *exp(-s*x)*
+  and the trapezoid weights multiplied by *y*. The matrix is built in blocks of at most
+  *chunk_size* elements, over *s* and, for long time series, over *x* as well (summing the
+  partial products), so that the memory used does not depend on the length of the series.
+
+  :param x: Points at which *y* is known
+  :param y: Values of the function to transform
+  :param s: Values at which the Laplace transform is evaluated
+  :param chunk_size: Maximal number of elements of the blocks of the matrix
+  :type chunk_size: :class:`int`
+  """
+  x = npy.array(x, dtype=float)
+  wy = TrapezoidalWeights(x) * npy.array(y, dtype=float)
+  s = npy.array(s, dtype=float)
+  yl = npy.zeros(len(s))
+  n_x = max(min(len(x), chunk_size), 1)
+  n_s = max(chunk_size // n_x, 1)
+  for i in range(0, len(s), n_s):
+    si = s[i:i + n_s]
+    for j in range(0, len(x), n_x):
+      yl[i:i + n_s] += npy.dot(npy.exp(-npy.outer(si, x[j:j + n_x])), wy[j:j + n_x])
+  return yl
+
+
+def LaplaceTransform(x, y, s_min=0, s_max=5, s_step=0.01, chunk_size=1 << 20):
   s = npy.arange(s_min, s_max, s_step)
-  yl = []
-  for si in s:
-    z = npy.exp(-si * x) * y
-    yl.append(TrapezoidalIntegration(x, z))
-  return (s, npy.array(yl))
+  return (s, BatchLaplaceTransform(x, y, s, chunk_size))
 
 
 def GenerateTrajectory(system, init_cv, step_sizes, temperature=300, max_nstep=1000):
@@ -276,6 +338,50 @@ def GenerateTrajectory(system, init_cv, step_sizes, temperature=300, max_nstep=1
   return traj
 
 
+def GenerateTrajectories(system, init_cvs, step_sizes, temperature=300, max_nstep=1000):
+  """
+  Metropolis Monte Carlo on the PMF for many independent chains at once. This is the
+  batched version of *GenerateTrajectory*: at every step, the trial moves of all the chains
+  are evaluated with a single vectorized call to *PMF.GetValues*.
+  Contrary to *GenerateTrajectory*, the position of every chain is recorded at every step,
+  rejected moves simply repeating the previous position.
+
+  :param init_cvs: Initial values of the CVs, one row per chain
+  :param step_sizes: Maximal step size for each CV
+  :param temperature: Temperature in K
+  :param max_nstep: Number of Monte Carlo steps
+  :type init_cvs: :class:`numpy.array`
+  :type step_sizes: :class:`list` (:class:`float`)
+  :type temperature: :class:`float`
+  :type max_nstep: :class:`int`
+
+  :returns: An array of shape *(max_nstep+1, n_chains, dimensionality)* with the positions of
+   the chains and an array of shape *(max_nstep, n_chains)* telling which moves were accepted.
+  """
+  current_cv = npy.array(init_cvs, dtype=float)
+  if current_cv.ndim == 1:
+    current_cv = current_cv.reshape([-1, 1])
+  n_chains, dimensionality = current_cv.shape
+  step_sizes = npy.array(step_sizes, dtype=float)
+  current_E = system.pmf.GetValues(current_cv)
+  kb = 1.98 * 0.001  # in kCal/K/mol
+  traj = npy.empty([max_nstep + 1, n_chains, dimensionality])
+  accepted = npy.zeros([max_nstep, n_chains], dtype=bool)
+  traj[0] = current_cv
+  for i in range(max_nstep):
+    trial_cv = current_cv + \
+        (npy.random.random([n_chains, dimensionality]) - 0.5) * step_sizes
+    E = system.pmf.GetValues(trial_cv)
+    with npy.errstate(over="ignore", invalid="ignore"):
+      acc = npy.random.random(n_chains) < npy.exp(-(E -
+                                                    current_E) / (kb * temperature))
+    current_cv[acc] = trial_cv[acc]
+    current_E[acc] = E[acc]
+    traj[i + 1] = current_cv
+    accepted[i] = acc
+  return traj, accepted
+
+
 def PlotTrajOnPMF(system, traj, outputdir, filename, skip=100, n_levels=None, max_E=None):
   energy_units = "kcal/mol"
   if not max_E:
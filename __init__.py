@@ -1,5 +1,6 @@
 from sipmf import SiPMF
+from multi import MultiSiPMF
 from environment import Environment
 from colvar import CollectiveVariable
 from system import System
-__all__ = ["Environment", "CollectiveVariable", "SiPMF","System"]
+__all__ = ["Environment", "CollectiveVariable", "SiPMF", "MultiSiPMF", "System"]
@@ -0,0 +1,306 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+This module contains the :class:`UncertaintyAllocation` class, which decides which windows should be
+sampled further from an estimate of their contribution to the uncertainty of the PMF, as well as the functions
+used for this estimate (statistical inefficiency, block bootstrap and overlap of histograms).
+"""
+import logging
+import numpy as npy
+
+__all__ = ('UncertaintyAllocation', 'StatisticalInefficiency',
+           'BlockBootstrapSEM', 'SampleHistogram', 'HistogramOverlap')
+
+
+def StatisticalInefficiency(x, min_lag=3):
+  """
+  Statistical inefficiency *g* of a time series, i.e. the number of consecutive samples needed to get
+  one independent sample. It is calculated by integrating the normalized autocorrelation function
+  up to its first non-positive value (but at least up to *min_lag*).
+
+  :param x: The time series
+  :param min_lag: Minimal number of lags included in the integral
+  :type x: :class:`numpy.array`
+  :type min_lag: :class:`int`
+  """
+  x = npy.asarray(x, dtype=float)
+  n = len(x)
+  if n < 2:
+    return 1.0
+  dx = x - npy.mean(x)
+  var = npy.dot(dx, dx) / n
+  if var <= 0:
+    return 1.0
+  # Autocorrelation through FFT, padded to avoid circular correlations
+  size = 1 << int(npy.ceil(npy.log2(2 * n)))
+  f = npy.fft.rfft(dx, size)
+  acf = npy.fft.irfft(f * npy.conjugate(f), size)[1:n]
+  t = npy.arange(1, n)
+  C = acf / (var * (n - t))
+  stop = npy.nonzero((C <= 0) & (t > min_lag))[0]
+  if len(stop):
+    C = C[:stop[0]]
+    t = t[:stop[0]]
+  g = 1.0 + 2.0 * npy.sum(C * (1.0 - t / float(n)))
+  return max(g, 1.0)
+
+
+def BlockBootstrapSEM(x, block_length, n_bootstrap=200, random_state=None):
+  """
+  Standard error of the mean of each column of *x*, estimated by bootstrapping blocks of *block_length*
+  consecutive samples, so that correlations within the time series are taken into account.
+
+  :param x: The samples, one row per sample.
+  :param block_length: Length of the blocks, typically the statistical inefficiency.
+  :param n_bootstrap: Number of bootstrap samples
+  :param random_state: Random number generator
+  :type x: :class:`numpy.array`
+  :type block_length: :class:`float`
+  :type n_bootstrap: :class:`int`
+  :type random_state: :class:`numpy.random.RandomState`
+  """
+  x = npy.asarray(x, dtype=float)
+  x = x.reshape([len(x), -1])
+  if random_state is None:
+    random_state = npy.random.RandomState()
+  b = max(int(npy.ceil(block_length)), 1)
+  nb = len(x) // b
+  if nb < 2:
+    # Not enough independent samples, the spread of the data is the best we can say
+    return npy.std(x, axis=0)
+  means = x[:nb * b].reshape([nb, b, -1]).mean(axis=1)
+  idx = random_state.randint(0, nb, size=(n_bootstrap, nb))
+  return npy.std(means[idx].mean(axis=1), axis=0, ddof=1)
+
+
+def SampleHistogram(cvs, cv_list):
+  """
+  Normalized histogram of samples of the CVs on the bins used for the PMF (*bin_size* of each CV).
+  Only the occupied bins are stored, so the histogram is a dictionary mapping the bin indices to the fraction of the samples in that bin.
+
+  :param cvs: The values of the CVs, one row per sample
+  :param cv_list: List of the CVs
+  :type cvs: :class:`numpy.array`
+  :type cv_list: :class:`list` (:class:`~colvar.CollectiveVariable`)
+  """
+  cvs = npy.asarray(cvs, dtype=float).reshape([-1, len(cv_list)])
+  if len(cvs) == 0:
+    return {}
+  bins = npy.empty(cvs.shape, dtype=int)
+  for i, cv in enumerate(cv_list):
+    bins[:, i] = npy.floor((cvs[:, i] - cv.min_value) / cv.bin_size)
+    if cv.periodicity:
+      bins[:, i] %= cv.num_bins
+  keys, counts = npy.unique(bins.view([("", int)] * bins.shape[1]), return_counts=True)
+  n = float(len(cvs))
+  return dict((tuple(k), c / n) for k, c in zip(keys.tolist(), counts))
+
+
+def HistogramOverlap(h1, h2):
+  """
+  Overlap between two normalized histograms (see *SampleHistogram*), i.e. the sum over the bins
+  of the minimum of both histograms. It is 1 for identical and 0 for disjoint histograms.
+  """
+  if len(h1) > len(h2):
+    h1, h2 = h2, h1
+  return sum([min(p, h2[k]) for k, p in h1.iteritems() if k in h2])
+
+
+class UncertaintyAllocation():
+  """
+  Adaptive sampling policy deciding which windows get a new phase (see *System.SubmitNewJobs*).
+  Instead of sampling every window up to the same number of data points (*System.n_data*), the windows are
+  sampled until their contribution to the uncertainty of the PMF is below *target_error*.
+
+  The contribution of a window is estimated from the standard error of the mean of its CVs, obtained by
+  bootstrapping blocks as long as the statistical inefficiency of the data. Through umbrella integration, it
+  translates into an error on the free energy difference across one window step of
+  *spring_constant x step_size x standard_error* (summed in quadrature over the CVs). Windows whose histogram
+  poorly overlaps the histogram of one of their neighbors on the lattice of windows are not considered
+  converged and get a higher priority.
+
+  Every window is sampled up to *min_n_data* data points. Beyond that, only windows in the low free energy
+  region (free energy below *max_E*) whose error is above the target (or which poorly overlap with a neighbor)
+  are sampled further, up to *max_n_data* data points. Windows are submitted in order of the expected reduction
+  of the variance of the PMF brought by one more phase.
+  """
+
+  def __repr__(self):
+    return "UncertaintyAllocation({0},{1},{2},{3},{4})".format(self.target_error, self.min_n_data, self.max_n_data, self.max_E, self.min_overlap)
+
+  def __init__(self, target_error, min_n_data=None, max_n_data=None, max_E=None, min_overlap=0.05, n_bootstrap=200, seed=None):
+    """
+    :param target_error: Target for the error contribution of each window (in units of the free energy).
+    :param min_n_data: Number of data points collected for every window. By default a quarter of *System.n_data*.
+    :param max_n_data: Maximal number of data points collected for a window. By default four times *System.n_data*.
+    :param max_E: Only windows with free energy below *max_E* are sampled beyond *min_n_data*. By default *System.max_E1*.
+    :param min_overlap: Minimal overlap (see *HistogramOverlap*) of the histograms of neighboring windows.
+    :param n_bootstrap: Number of bootstrap samples used to estimate the standard errors.
+    :param seed: Seed of the random number generator used for bootstrapping.
+    :type target_error: :class:`float`
+    :type min_n_data: :class:`int`
+    :type max_n_data: :class:`int`
+    :type max_E: :class:`float`
+    :type min_overlap: :class:`float`
+    :type n_bootstrap: :class:`int`
+    :type seed: :class:`int`
+    """
+    self.target_error = target_error
+    self.min_n_data = min_n_data
+    self.max_n_data = max_n_data
+    self.max_E = max_E
+    self.min_overlap = min_overlap
+    self.n_bootstrap = n_bootstrap
+    self.seed = seed
+    self.window_stats = {}
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    # The statistics are cheap to recompute and would make the state file large
+    state["window_stats"] = {}
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.window_stats = {}
+
+  def GetMinNData(self, system):
+    if self.min_n_data is not None:
+      return self.min_n_data
+    return max(system.n_data // 4, 1)
+
+  def GetMaxNData(self, system):
+    if self.max_n_data is not None:
+      return self.max_n_data
+    return 4 * system.n_data
+
+  def GetMaxE(self, system):
+    if self.max_E is not None:
+      return self.max_E
+    return system.max_E1
+
+  def GetWindowStatistics(self, system, window, running_phases=()):
+    """
+    Statistics of the data of the finished run phases of a window: number of data points (*n_data*),
+    statistical inefficiency (*g*), standard error of the mean of each CV (*sem*), error contribution
+    of the window (*error*), average number of data points per phase (*n_data_per_phase*) and histogram (*histogram*).
+    The statistics are cached and only recomputed when phases have been added to the window.
+    Returns *None* if the window does not have any data yet.
+
+    :param system: The system
+    :param window: The window
+    :param running_phases: Phases whose job is not finished yet, which are ignored.
+    :type system: :class:`~system.System`
+    :type window: :class:`~window.Window`
+    :type running_phases: :class:`set` (:class:`~phase.Phase`)
+    """
+    phases = [p for p in window.phases if p.type == "run" and p not in running_phases and p.n_data > 0]
+    key = tuple([(p.name, p.n_data) for p in phases])
+    cached = self.window_stats.get(window.name)
+    if cached and cached[0] == key:
+      return cached[1]
+    if not phases:
+      return None
+    data = []
+    for p in phases:
+      t, cvs = p.ReadDataFile()
+      data.append(npy.array(cvs, dtype=float).reshape(
+          [system.dimensionality, -1]).transpose())
+    data = npy.concatenate(data)
+    if len(data) == 0:
+      return None
+    # Deviations from the window center, unwrapped for periodic CVs
+    dx = data - npy.array(window.cv_values, dtype=float)
+    for i, cv in enumerate(system.cv_list):
+      if cv.periodicity:
+        dx[:, i] = (dx[:, i] + cv.periodicity / 2.0) % cv.periodicity - cv.periodicity / 2.0
+    g = max([StatisticalInefficiency(dx[:, i]) for i in range(system.dimensionality)])
+    if self.seed is None:
+      random_state = npy.random.RandomState()
+    else:
+      random_state = npy.random.RandomState(self.seed)
+    sem = BlockBootstrapSEM(dx, g, self.n_bootstrap, random_state)
+    error = npy.sqrt(npy.sum([(k * cv.step_size * s)**2 for k, cv, s in zip(window.spring_constants, system.cv_list, sem)]))
+    stats = {"n_data": len(data), "g": g, "sem": sem, "error": float(error),
+             "n_data_per_phase": len(data) / float(len(phases)),
+             "histogram": SampleHistogram(data, system.cv_list)}
+    self.window_stats[window.name] = (key, stats)
+    return stats
+
+  def Estimate(self, system, windows=None):
+    """
+    Estimate the uncertainty of the windows. Returns a dictionary mapping each window with data to a dictionary
+    containing the number of data points (*n_data*), the effective number of independent data points (*n_eff*),
+    the statistical inefficiency (*g*), the error contribution of the window (*error*), the smallest overlap
+    of its histogram with that of a neighboring window (*overlap*, *None* if no neighbor has data) and the expected
+    reduction of the variance of the PMF from sampling one more phase of the window (*score*).
+
+    :param system: The system
+    :param windows: The windows for which to estimate the uncertainty. By default all windows.
+    :type system: :class:`~system.System`
+    :type windows: :class:`list` (:class:`~window.Window`)
+    """
+    if windows is None:
+      windows = system.windows
+    running_phases = set([job.phase for job in system.unfinished_jobs])
+    neighbors = system.GetNeighborWindows(windows)
+    res = {}
+    for w in windows:
+      stats = self.GetWindowStatistics(system, w, running_phases)
+      if stats is None:
+        continue
+      overlap = None
+      for n in neighbors[w]:
+        nstats = self.GetWindowStatistics(system, n, running_phases)
+        if nstats is None:
+          continue
+        o = HistogramOverlap(stats["histogram"], nstats["histogram"])
+        if overlap is None or o < overlap:
+          overlap = o
+      n_data = stats["n_data"]
+      n_phase = stats["n_data_per_phase"]
+      score = stats["error"]**2 * n_phase / (n_data + n_phase)
+      if overlap is not None and overlap < self.min_overlap:
+        score *= (self.min_overlap / max(overlap, 1e-3))**2
+      res[w] = {"n_data": n_data, "n_eff": n_data / stats["g"], "g": stats["g"],
+                "error": stats["error"], "overlap": overlap, "score": score}
+    return res
+
+  def SelectWindows(self, system, windows):
+    """
+    Select the windows among *windows* that should be sampled further and return them sorted by priority.
+    The windows with less than *min_n_data* data points come first, followed by the windows of the low free
+    energy region that are not converged, sorted by decreasing expected reduction of the variance of the PMF.
+
+    :param system: The system
+    :param windows: The candidate windows, typically the windows whose last job finished.
+    :type system: :class:`~system.System`
+    :type windows: :class:`list` (:class:`~window.Window`)
+    """
+    min_n_data = self.GetMinNData(system)
+    max_n_data = self.GetMaxNData(system)
+    max_E = self.GetMaxE(system)
+    to_fill = [w for w in windows if w.n_data < min_n_data]
+    candidates = [w for w in windows if min_n_data <= w.n_data < max_n_data and
+                  not getattr(w, "free_energy", -npy.inf) > max_E]
+    estimates = self.Estimate(system, candidates)
+    selected = []
+    n_converged = 0
+    for w in candidates:
+      e = estimates.get(w)
+      if e is None:
+        continue
+      poor_overlap = e["overlap"] is not None and e["overlap"] < self.min_overlap
+      if e["error"] <= self.target_error and not poor_overlap:
+        n_converged += 1
+        continue
+      selected.append(w)
+    selected.sort(key=lambda w: estimates[w]["score"], reverse=True)
+    n_stopped = len(windows) - len(to_fill) - len(selected)
+    logging.info("Allocation: {0} windows below {1} data points, {2} windows extended, {3} converged, {4} stopped (max data or free energy)".format(
+        len(to_fill), min_n_data, len(selected), n_converged, n_stopped - n_converged))
+    for w in selected:
+      e = estimates[w]
+      logging.info("Extending {0}: n_data={1}, g={2:.1f}, error={3:.3f}, overlap={4}".format(
+          w.name, e["n_data"], e["g"], e["error"], e["overlap"]))
+    return to_fill + selected
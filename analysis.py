@@ -4,45 +4,196 @@
 This module contains the analysis function for trajectories genereated with a siPMF run.
 """
 import os,subprocess,logging
+import pickle,hashlib,multiprocessing
+import dcd
+from reus import FindReplicaFrame
 import numpy as npy
 import matplotlib.pyplot as plt
 from matplotlib.mlab import griddata
 from ost import *
 
-__all__=('BuildTrajectory')
+__all__=('BuildTrajectory','AnalyzeWindows','LoadTrajFrames')
+
+def _Vec3List(xyz):
+  return geom.Vec3List([geom.Vec3(*el) for el in xyz.tolist()])
+
+def LoadTrajFrames(eh,path_to_traj,frames):
+  """
+  Load a subset of the frames of a DCD trajectory, without reading the rest of the file
+  (see :class:`~dcd.DCDIndex`).
+
+  :param eh: The entity
+  :param path_to_traj: Path to the DCD file
+  :param frames: Indices of the frames to load, e.g. *range(first,n_frames,stride)*
+
+  :type eh: :class:`mol.EntityHandle`
+  :type path_to_traj: :class:`str`
+  :type frames: :class:`list` (:class:`int`)
+  """
+  t=mol.CreateCoordGroup(eh.atoms)
+  for xyz in dcd.DCDIndex(path_to_traj).ReadFrames(frames):
+    t.AddFrame(_Vec3List(xyz))
+  return t
 
 def BuildTrajectory(system,windows,eh,traj_filename,stride=1):
   """
-  Makes a trajectory from the simulations of a list of windows
+  Makes a trajectory from the simulations of a list of windows, by taking the last frame
+  of the last phase of every window. Only that frame is read from the trajectory files.
+  For phases sampled with replica exchange, the frame of the last sample recorded in the window
+  is read from the trajectory of the replica that recorded it (see :func:`~reus.FindReplicaFrame`).
 
   :param system: The system for which to generate a trajectory
   :param windows: The list of windows from which to generate the trajectory
   :param eh: The entity
   :param traj_filename: The name of the trajectory files
+  :param stride: The last frame is the last one that would be read using this stride
 
   :type system:  :class:`~system.System`
   :type windows:  :class:`list` (:class:`~window.Window`)
   :type eh: :class:`mol.EntityHandle`
   :type traj_filename: :class:`str`
+  :type stride: :class:`int`
   """
   t_out=mol.CreateCoordGroup(eh.atoms)
   for w in windows:
     p=w.phases[-1]
-    t=io.LoadCHARMMTraj(eh,os.path.join(p.outdir,traj_filename),stride=stride)
-    print os.path.join(p.outdir,traj_filename),t.GetFrameCount()
-    vl=t.GetFramePositions(t.GetFrameCount()-1)
-    t_out.AddFrame(vl)
+    replica=FindReplicaFrame(system,p)
+    if replica:
+      replica_phase,frame=replica
+      index=dcd.DCDIndex(os.path.join(replica_phase.outdir,traj_filename))
+      print os.path.join(replica_phase.outdir,traj_filename),frame
+      t_out.AddFrame(_Vec3List(index.ReadFrame(frame)))
+      continue
+    index=dcd.DCDIndex(os.path.join(p.outdir,traj_filename))
+    n=index.GetFrameCount()
+    print os.path.join(p.outdir,traj_filename),(n-1)//stride+1
+    t_out.AddFrame(_Vec3List(index.ReadFrame(((n-1)//stride)*stride)))
   return t_out
 
 
-def AnalyzeWindows(system,eh,analysis_function,function_arguments,traj_filename,first_phase=0,first_frame=0,stride=1,windows=None):
+def _CodeId(code):
+  """
+  Representation of a code object: its bytecode, the names it uses and its constants,
+  including the code objects of the nested functions.
+  """
+  consts=[_CodeId(c) if hasattr(c,"co_code") else repr(c) for c in code.co_consts]
+  return [code.co_code,code.co_names,consts]
+
+def _CellContents(cell):
+  try:return repr(cell.cell_contents)
+  except ValueError:return None
+
+def _PhaseCacheKey(path_to_traj,analysis_function,function_arguments,stride,first_frame):
+  """
+  Key under which the result of *analysis_function* on a phase trajectory is cached.
+  It depends on the path and modification time of the trajectory, on the identity of the
+  function (module, name, code with its constants and names, default arguments and the
+  values of the variables of its closure) and on the representation of its arguments.
+  """
+  code=getattr(analysis_function,"func_code",None)
+  fid=[getattr(analysis_function,"__module__",""),getattr(analysis_function,"__name__",repr(analysis_function))]
+  if code:
+    closure=[_CellContents(c) for c in analysis_function.func_closure or []]
+    fid.append(hashlib.sha1(repr([_CodeId(code),repr(analysis_function.func_defaults),closure])).hexdigest())
+  key=[os.path.abspath(path_to_traj),os.path.getmtime(path_to_traj),fid,repr(function_arguments),stride,first_frame]
+  return hashlib.sha1(repr(key)).hexdigest()
+
+# Arguments of the worker processes. They are set before the pool is created, so that they are
+# inherited when forking instead of being pickled (entities cannot be pickled).
+_worker_context={}
+
+def _AnalyzePhase(path_to_traj):
+  c=_worker_context
+  if c["use_dcd_index"]:
+    n=dcd.DCDIndex(path_to_traj).GetFrameCount()
+    t=LoadTrajFrames(c["eh"],path_to_traj,range(c["first_frame"]*c["stride"],n,c["stride"]))
+    return list(c["analysis_function"](t,*c["function_arguments"]))
+  t=io.LoadCHARMMTraj(c["eh"],path_to_traj,stride=c["stride"])
+  return list(c["analysis_function"](t,*c["function_arguments"])[c["first_frame"]:])
+
+def AnalyzeWindows(system,eh,analysis_function,function_arguments,traj_filename,first_phase=0,first_frame=0,stride=1,windows=None,n_procs=1,use_cache=True,cache_dir=None,use_dcd_index=True):
+  """
+  Apply *analysis_function* to the trajectories of all the phases of a list of windows. The function is called
+  as *analysis_function(traj,*function_arguments)* and should return one value per frame.
+  The phases are analyzed in parallel in *n_procs* processes and the result for each phase is cached
+  on disk, keyed on the path and modification time of the trajectory, the function and its arguments.
+  Repeated analyses therefore only process the phases that are new or have changed.
+  For the cache to work, the representation (*repr*) of the arguments has to be the same between calls.
+  Changes to the functions or global variables used by *analysis_function* are not detected,
+  the cache has to be cleared (or *use_cache* set to *False*) in that case.
+  With *use_dcd_index*, the frames before *first_frame* are not even read from the trajectories.
+
+  :param system: The system to analyze
+  :param eh: The entity
+  :param analysis_function: The function applied to each trajectory
+  :param function_arguments: Additional arguments passed to the function
+  :param traj_filename: The name of the trajectory files
+  :param first_phase: Index of the first phase analyzed in every window
+  :param first_frame: Index of the first result kept for every phase
+  :param stride: Stride used when loading the trajectories
+  :param windows: The windows to analyze. By default all the windows of the system are analyzed.
+  :param n_procs: Number of processes used to analyze the phases
+  :param use_cache: Use the on-disk cache of results
+  :param cache_dir: Directory of the cache. By default *basedir/analysis_cache*.
+  :param use_dcd_index: Only read the needed frames, using a :class:`~dcd.DCDIndex`. Otherwise
+   the whole trajectories are loaded with *io.LoadCHARMMTraj*.
+
+  :type system:  :class:`~system.System`
+  :type eh: :class:`mol.EntityHandle`
+  :type traj_filename: :class:`str`
+  :type first_phase: :class:`int`
+  :type first_frame: :class:`int`
+  :type stride: :class:`int`
+  :type windows:  :class:`list` (:class:`~window.Window`)
+  :type n_procs: :class:`int`
+  :type use_cache: :class:`bool`
+  :type cache_dir: :class:`str`
+  :type use_dcd_index: :class:`bool`
+  """
   if not windows:windows=system.windows
+  if not cache_dir:cache_dir=os.path.join(system.basedir,"analysis_cache")
+  if use_cache and not os.path.isdir(cache_dir):os.makedirs(cache_dir)
+  phase_results={}
+  to_compute=[]
+  for w in windows:
+    for p in w.phases[first_phase:]:
+      path=os.path.join(p.outdir,traj_filename)
+      if use_cache:
+        cache_file=os.path.join(cache_dir,_PhaseCacheKey(path,analysis_function,function_arguments,stride,first_frame)+".pkl")
+        if os.path.isfile(cache_file):
+          f=open(cache_file,"rb")
+          phase_results[path]=pickle.load(f)
+          f.close()
+          continue
+      else:cache_file=None
+      to_compute.append((path,cache_file))
+  logging.info("Analyzing {0} phases, {1} results taken from the cache".format(len(to_compute),len(phase_results)))
+  _worker_context.update({"eh":eh,"analysis_function":analysis_function,"function_arguments":function_arguments,
+                          "stride":stride,"first_frame":first_frame,"use_dcd_index":use_dcd_index})
+  try:
+    paths=[el[0] for el in to_compute]
+    if n_procs==1 or len(paths)<=1:
+      results=map(_AnalyzePhase,paths)
+    else:
+      pool=multiprocessing.Pool(n_procs)
+      try:results=pool.map(_AnalyzePhase,paths)
+      finally:
+        pool.close()
+        pool.join()
+  finally:
+    _worker_context.clear()
+  for (path,cache_file),res in zip(to_compute,results):
+    phase_results[path]=res
+    if cache_file:
+      f=open(cache_file+".tmp","wb")
+      pickle.dump(res,f,pickle.HIGHEST_PROTOCOL)
+      f.close()
+      os.rename(cache_file+".tmp",cache_file)
   res_dict={}
   for w in windows:
     res=[]
     for p in w.phases[first_phase:]:
-      t=io.LoadCHARMMTraj(eh,os.path.join(p.outdir,traj_filename),stride=stride)
-      res.extend(analysis_function(t,*function_arguments)[first_frame:])
+      res.extend(phase_results[os.path.join(p.outdir,traj_filename)])
     res_dict[w]=res
   return res_dict
 
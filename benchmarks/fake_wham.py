@@ -0,0 +1,376 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+Stand-in for the WHAM programs of A. Grossfield (*wham* and *wham-2d*), written with numpy only,
+so that the benchmarks can run where WHAM is not installed. It accepts the same command lines as
+the ones built by *System.CalculatePMF* and writes its output in the same format:
+::
+  python fake_wham.py [P|Ppi|Pval] hist_min hist_max num_bins tol temperature numpad metadatafile freefile
+  python fake_wham.py Px=val hist_min_x hist_max_x num_bins_x Py=val hist_min_y hist_max_y num_bins_y tol temperature numpad metadatafile freefile use_mask
+
+The restraining potentials are *1/2 k (x-x0)^2*, energies are in kcal/mol. Only the bins within
+a cutoff of each window are taken into account, and the free energies of the windows are initialized
+from the overlap of the histograms of neighboring windows, which keeps the number of iterations small
+even with thousands of windows. Unlike the original programs, no Monte Carlo error analysis is done.
+"""
+import sys
+import numpy as npy
+
+KB = 0.001982923700
+# Bins where the restraining potential of a window is above this (in kT) are ignored for that window
+BIAS_CUTOFF = 30.0
+MAX_ITERATIONS = 100000
+
+
+def _ParsePeriod(arg):
+  """
+  Periodicity from a *P*, *Ppi*, *Pval*, *Px=val* or *Py=val* argument (0 for non periodic).
+  """
+  if "=" in arg:
+    arg = arg.split("=")[1]
+  elif arg.startswith("P"):
+    arg = arg[1:]
+    if arg == "":
+      return 2 * npy.pi
+  if arg == "pi":
+    return npy.pi
+  return float(arg)
+
+
+def ParseCommandLine(argv):
+  """
+  Returns a dictionary with the histogram definition (*periods*, *mins*, *maxs*, *num_bins*) and the
+  other parameters of the command line.
+  """
+  args = list(argv)
+  if args and args[0].startswith("Px"):
+    periods, mins, maxs, num_bins = [], [], [], []
+    for i in range(2):
+      periods.append(_ParsePeriod(args[4 * i]))
+      mins.append(float(args[4 * i + 1]))
+      maxs.append(float(args[4 * i + 2]))
+      num_bins.append(int(args[4 * i + 3]))
+    rest = args[8:]
+  else:
+    period = 0.0
+    if args and args[0].startswith("P"):
+      period = _ParsePeriod(args.pop(0))
+    periods, mins, maxs, num_bins = [period], [float(args[0])], [
+        float(args[1])], [int(args[2])]
+    rest = args[3:]
+  if len(rest) < 5:
+    raise ValueError("Not enough arguments")
+  return {"periods": npy.array(periods), "mins": npy.array(mins), "maxs": npy.array(maxs),
+          "num_bins": npy.array(num_bins), "tolerance": float(rest[0]), "temperature": float(rest[1]),
+          "num_pads": int(rest[2]), "metadatafile": rest[3], "freefile": rest[4]}
+
+
+def ReadDataFile(path, dimensionality):
+  """
+  Values of the CVs in a datafile (*time cv1 [cv2]* per line), skipping comment lines.
+  """
+  f = open(path, "r")
+  lines = [l for l in f if not (l.startswith("#") or l.startswith("*"))]
+  f.close()
+  values = npy.fromstring(" ".join(lines), sep=" ")
+  if len(values) == 0:
+    return npy.zeros([0, dimensionality])
+  n_cols = len(lines[0].split())
+  return values.reshape([-1, n_cols])[:, 1:dimensionality + 1]
+
+
+def ReadMetadataFile(path, dimensionality):
+  """
+  Datafiles, centers and spring constants of the windows listed in the metadata file.
+  """
+  datafiles, centers, springs = [], [], []
+  f = open(path, "r")
+  for l in f:
+    s = l.split()
+    if not s or s[0].startswith("#"):
+      continue
+    datafiles.append(s[0])
+    centers.append([float(el) for el in s[1:1 + dimensionality]])
+    springs.append([float(el)
+                    for el in s[1 + dimensionality:1 + 2 * dimensionality]])
+  f.close()
+  return datafiles, npy.array(centers).reshape([-1, dimensionality]), npy.array(springs).reshape([-1, dimensionality])
+
+
+def _Delta(x, center, periods):
+  d = x - center
+  periodic = periods > 0
+  if npy.any(periodic):
+    p = periods[periodic]
+    d[..., periodic] -= p * npy.round(d[..., periodic] / p)
+  return d
+
+
+def BinSamples(samples, mins, maxs, num_bins, periods):
+  """
+  Flat bin index of every sample, -1 for samples outside of the histogram.
+  """
+  widths = (maxs - mins) / num_bins
+  x = samples.copy()
+  periodic = periods > 0
+  if npy.any(periodic):
+    x[:, periodic] = mins[periodic] + \
+        npy.mod(x[:, periodic] - mins[periodic], periods[periodic])
+  idx = npy.floor((x - mins) / widths).astype(int)
+  valid = npy.all((idx >= 0) & (idx < num_bins), axis=1)
+  flat = npy.ravel_multi_index(
+      tuple(npy.clip(idx, 0, num_bins - 1).T), tuple(num_bins))
+  flat[~valid] = -1
+  return flat
+
+
+def BiasTriples(centers, springs, mins, maxs, num_bins, periods, kT, occupied):
+  """
+  Sparse representation of the restraining potentials: arrays *(window, bin, bias)* for all the
+  occupied bins within the cutoff of each window.
+  """
+  widths = (maxs - mins) / num_bins
+  radius = npy.sqrt(2 * BIAS_CUTOFF * kT / npy.max(springs, axis=0))
+  half = npy.ceil(radius / widths).astype(int)
+  half = npy.minimum(half, num_bins)
+  offsets = npy.array(list(npy.ndindex(*(2 * half + 1)))) - half
+  windows, bins, biases = [], [], []
+  # Process the windows in chunks to limit the memory usage
+  chunk = max(1, 2000000 // len(offsets))
+  for start in range(0, len(centers), chunk):
+    c = centers[start:start + chunk]
+    k = springs[start:start + chunk]
+    center_bins = npy.floor((c - mins) / widths).astype(int)
+    idx = center_bins[:, None, :] + offsets[None, :, :]
+    periodic = periods > 0
+    idx[:, :, periodic] = npy.mod(idx[:, :, periodic], num_bins[periodic])
+    valid = npy.all((idx >= 0) & (idx < num_bins), axis=2)
+    bin_centers = mins + (idx + 0.5) * widths
+    d = _Delta(bin_centers, c[:, None, :], periods)
+    u = 0.5 * npy.sum(k[:, None, :] * d * d, axis=2)
+    flat = npy.ravel_multi_index(
+        tuple(npy.moveaxis(npy.clip(idx, 0, num_bins - 1), 2, 0)), tuple(num_bins))
+    keep = valid & (u < BIAS_CUTOFF * kT)
+    keep[valid] &= occupied[flat[valid]]
+    w = npy.repeat(npy.arange(start, start + len(c))
+                   [:, None], len(offsets), axis=1)
+    windows.append(w[keep])
+    bins.append(flat[keep])
+    biases.append(u[keep])
+  windows = npy.concatenate(windows)
+  bins = npy.concatenate(bins)
+  biases = npy.concatenate(biases)
+  # Periodic images can map two offsets to the same bin
+  code = windows.astype(npy.int64) * int(npy.prod(num_bins)) + bins
+  code, first = npy.unique(code, return_index=True)
+  return windows[first], bins[first], biases[first]
+
+
+def InitialFreeEnergies(n_windows, count_windows, count_bins, counts, n_samples, bias, kT):
+  """
+  Initial guess of the free energies of the windows. Within one window, *-kT ln(n(b)/N) - U(b)* equals *F(b)-f*
+  up to the noise, so two windows sampling bin *b* give an estimate of the difference of their *f*. For each bin,
+  the differences between the window with most samples and the other windows are averaged over the bins (weighted
+  by their inverse variance) and the free energies are the weighted least squares solution of all these differences,
+  obtained with conjugate gradients.
+  """
+  a = -kT * npy.log(counts / n_samples[count_windows]) - bias
+  # For each bin, the window with the most samples is the reference
+  order = npy.lexsort((-counts, count_bins))
+  b_sorted = count_bins[order]
+  first = npy.concatenate([[True], b_sorted[1:] != b_sorted[:-1]])
+  ref = order[first][npy.cumsum(first) - 1]
+  other = order
+  mask = count_windows[other] != count_windows[ref]
+  ref = ref[mask]
+  other = other[mask]
+  f = npy.zeros(n_windows)
+  if len(ref) == 0:
+    return f
+  w = 1.0 / (1.0 / counts[ref] + 1.0 / counts[other])
+  code = count_windows[ref].astype(npy.int64) * n_windows + count_windows[other]
+  ucode, inv = npy.unique(code, return_inverse=True)
+  weights = npy.bincount(inv, weights=w)
+  # f_i - f_j for each pair of windows (i,j)
+  delta = npy.bincount(inv, weights=w * (a[other] - a[ref])) / weights
+  i = (ucode // n_windows).astype(int)
+  j = (ucode % n_windows).astype(int)
+
+  def Laplacian(x):
+    d = weights * (x[i] - x[j])
+    return npy.bincount(i, weights=d, minlength=n_windows) - npy.bincount(j, weights=d, minlength=n_windows)
+  rhs = npy.bincount(i, weights=weights * delta, minlength=n_windows) - \
+      npy.bincount(j, weights=weights * delta, minlength=n_windows)
+  r = rhs - Laplacian(f)
+  p = r.copy()
+  rr = npy.dot(r, r)
+  for it in range(10 * n_windows):
+    if rr <= 1e-20 * npy.dot(rhs, rhs):
+      break
+    lp = Laplacian(p)
+    alpha = rr / npy.dot(p, lp)
+    f += alpha * p
+    r -= alpha * lp
+    rr_new = npy.dot(r, r)
+    p = r + rr_new / rr * p
+    rr = rr_new
+  return f - f[0]
+
+
+def Wham(samples_per_window, centers, springs, mins, maxs, num_bins, periods, temperature, tolerance):
+  """
+  Solve the WHAM equations on the histogram. Returns the free energy of every bin (*inf* where
+  there is no data) and the free energies of the windows.
+  """
+  kT = KB * temperature
+  n_bins_tot = int(npy.prod(num_bins))
+  n_windows = len(centers)
+  count_codes = []
+  n_samples = npy.zeros(n_windows)
+  for i, samples in enumerate(samples_per_window):
+    flat = BinSamples(samples, mins, maxs, num_bins, periods)
+    flat = flat[flat >= 0]
+    n_samples[i] = len(flat)
+    count_codes.append(i * n_bins_tot + flat.astype(npy.int64))
+  count_codes = npy.concatenate(count_codes) if count_codes else npy.zeros(0, dtype=npy.int64)
+  codes, counts = npy.unique(count_codes, return_counts=True)
+  count_windows = (codes // n_bins_tot).astype(int)
+  count_bins = (codes % n_bins_tot).astype(int)
+  counts = counts.astype(float)
+  numerator = npy.bincount(count_bins, weights=counts, minlength=n_bins_tot)
+  occupied = numerator > 0
+  tw, tb, tu = BiasTriples(centers, springs, mins, maxs,
+                           num_bins, periods, kT, occupied)
+  # Bias of each (window,bin) pair with counts, needed for the initial guess.
+  # The triples are sorted by window and bin, so they can be looked up with a binary search.
+  triple_codes = tw.astype(npy.int64) * n_bins_tot + tb
+  pos = npy.minimum(npy.searchsorted(triple_codes, codes), max(len(triple_codes) - 1, 0))
+  found = triple_codes[pos] == codes if len(triple_codes) else npy.zeros(len(codes), dtype=bool)
+  # Samples beyond the cutoff of their own window are ignored
+  count_windows = count_windows[found]
+  count_bins = count_bins[found]
+  counts = counts[found]
+  n_samples = npy.bincount(count_windows, weights=counts, minlength=n_windows)
+  numerator = npy.bincount(count_bins, weights=counts, minlength=n_bins_tot)
+  occupied = numerator > 0
+  f = InitialFreeEnergies(n_windows, count_windows, count_bins, counts,
+                          npy.maximum(n_samples, 1), tu[pos[found]], kT)
+  # The sums over windows and bins are done in log space, as the free energies of the windows can
+  # span many kT. Triples are sorted by window, they are also sorted by bin for the sums over windows.
+  u = tu / kT
+  g = f / kT
+  # Windows without samples do not contribute to the PMF
+  has_data = n_samples > 0
+  keep = has_data[tw]
+  tw, tb, u = tw[keep], tb[keep], u[keep]
+  log_n = npy.log(npy.maximum(n_samples, 1))
+  log_numerator = npy.full(n_bins_tot, -npy.inf)
+  log_numerator[occupied] = npy.log(numerator[occupied])
+  by_window = _Segments(tw)
+  by_bin_order = npy.argsort(tb, kind="mergesort")
+  by_bin = _Segments(tb[by_bin_order])
+  sampled_windows = npy.unique(tw)
+  log_p = npy.full(n_bins_tot, -npy.inf)
+  for it in range(MAX_ITERATIONS):
+    log_denominator = _SegmentLogSumExp(
+        (log_n[tw] + g[tw] - u)[by_bin_order], by_bin)
+    bins = tb[by_bin_order][by_bin[0]]
+    log_p[:] = -npy.inf
+    log_p[bins] = log_numerator[bins] - log_denominator
+    new_g = g.copy()
+    new_g[sampled_windows] = - \
+        _SegmentLogSumExp(log_p[tb] - u, by_window)
+    new_g -= new_g[0]
+    change = kT * npy.max(npy.abs(new_g - g)[has_data]) if npy.any(has_data) else 0.0
+    g = new_g
+    if change < tolerance:
+      break
+  log_p -= npy.max(log_p)
+  p = npy.exp(log_p)
+  p /= npy.sum(p)
+  free = -kT * log_p
+  if npy.any(npy.isfinite(free)):
+    free -= npy.min(free[npy.isfinite(free)])
+  return free.reshape(tuple(num_bins)), p.reshape(tuple(num_bins)), g * kT
+
+
+def _Segments(keys):
+  """
+  Start of each run of equal values in the sorted array *keys* and index of the run of every element.
+  """
+  starts = npy.nonzero(npy.concatenate([[True], keys[1:] != keys[:-1]]))[0]
+  return starts, npy.cumsum(npy.concatenate([[True], keys[1:] != keys[:-1]])) - 1
+
+
+def _SegmentLogSumExp(x, segments):
+  starts, segment = segments
+  m = npy.maximum.reduceat(x, starts)
+  m_finite = npy.where(npy.isfinite(m), m, 0.0)
+  with npy.errstate(divide="ignore"):
+    return m_finite + npy.log(npy.add.reduceat(npy.exp(x - m_finite[segment]), starts))
+
+
+def WriteFreeFile1D(path, free, prob, params, f):
+  widths = (params["maxs"] - params["mins"]) / params["num_bins"]
+  out = open(path, "w")
+  out.write("#Coor\t\tFree\t\t+/-\t\tProb\t\t+/-\n")
+  for i in range(params["num_bins"][0]):
+    x = params["mins"][0] + (i + 0.5) * widths[0]
+    out.write("{0:f}\t{1:f}\t{2:f}\t{3:f}\t{4:f}\n".format(
+        x, free[i], 0.0, prob[i], 0.0))
+  out.write("#Window\t\tFree\t+/-\t\n")
+  for i, fi in enumerate(f):
+    out.write("#{0}\t{1:f}\t{2:f}\n".format(i, fi, 0.0))
+  out.close()
+
+
+def WriteFreeFile2D(path, free, prob, params):
+  """
+  Like *wham-2d*, the output grid is extended by *numpad* bins on each side, which are filled
+  with the values of the periodic images (or left empty for non periodic CVs).
+  Empty bins get a free energy of 9999999.
+  """
+  widths = (params["maxs"] - params["mins"]) / params["num_bins"]
+  num_pads = params["num_pads"]
+  nx, ny = params["num_bins"]
+  out = open(path, "w")
+  out.write("#X\t\tY\t\tFree\t\tPro\n")
+  for i in range(-num_pads, nx + num_pads):
+    x = params["mins"][0] + (i + 0.5) * widths[0]
+    for j in range(-num_pads, ny + num_pads):
+      y = params["mins"][1] + (j + 0.5) * widths[1]
+      ii, jj = i, j
+      if params["periods"][0] > 0:
+        ii = i % nx
+      if params["periods"][1] > 0:
+        jj = j % ny
+      if 0 <= ii < nx and 0 <= jj < ny and npy.isfinite(free[ii, jj]):
+        fe, pr = free[ii, jj], prob[ii, jj]
+      else:
+        fe, pr = 9999999.0, 0.0
+      out.write("{0:f}\t{1:f}\t{2:f}\t{3:f}\n".format(x, y, fe, pr))
+    out.write("\n")
+  out.close()
+
+
+def main(argv):
+  try:
+    params = ParseCommandLine(argv)
+  except (ValueError, IndexError) as e:
+    sys.stderr.write("{0}\n{1}".format(e, __doc__))
+    return 1
+  dimensionality = len(params["num_bins"])
+  datafiles, centers, springs = ReadMetadataFile(
+      params["metadatafile"], dimensionality)
+  samples = [ReadDataFile(df, dimensionality) for df in datafiles]
+  free, prob, f = Wham(samples, centers, springs, params["mins"], params["maxs"], params["num_bins"],
+                       params["periods"], params["temperature"], params["tolerance"])
+  if dimensionality == 1:
+    WriteFreeFile1D(params["freefile"], free, prob, params, f)
+  else:
+    WriteFreeFile2D(params["freefile"], free, prob, params)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
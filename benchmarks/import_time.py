@@ -0,0 +1,109 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+Import-time benchmark for the siPMF package. It measures, in fresh python processes, the time
+needed to import the package and to load a saved :class:`~system.System` with *LoadSystem*,
+and checks that neither of them imports matplotlib or scipy. It exits with a non-zero status
+if a heavy module gets imported or if the median time exceeds *--max-time*, so that it can be
+used to guard against regressions:
+::
+  python benchmarks/import_time.py --repeat 10 --max-time 0.5
+"""
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import argparse
+import json
+
+HEAVY_MODULES = ["matplotlib", "scipy"]
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE_NAME = os.path.basename(PACKAGE_DIR)
+
+_IMPORT_CODE = """
+import sys, time, json, importlib
+sys.path.insert(0, {parent!r})
+t0 = time.time()
+pkg = importlib.import_module({name!r})
+t1 = time.time()
+if {state!r}:
+  importlib.import_module({name!r} + ".system").LoadSystem({state!r})
+t2 = time.time()
+heavy = sorted(set(m.split(".")[0] for m in sys.modules if m.split(".")[0] in {heavy!r}))
+print(json.dumps({{"import": t1 - t0, "load": t2 - t1, "heavy": heavy}}))
+"""
+
+
+def _MakeState(tmpdir):
+  """
+  Create and save a small system with a few windows and a PMF in *tmpdir*.
+  Returns the path to the state file (without the .pkl extension).
+  """
+  sys.path.insert(0, os.path.dirname(PACKAGE_DIR))
+  import importlib
+  import numpy as npy
+  pkg = importlib.import_module(PACKAGE_NAME)
+  PMF = importlib.import_module(PACKAGE_NAME + ".pmf").PMF
+  cv = pkg.CollectiveVariable("X", -5.0, 5.0, 0.5, 100, 10.0)
+  system = pkg.System(tmpdir, [cv], "init.in", "run.in", "init.sh", "run.sh", "colvars.traj",
+                      1000, 5000, 100, 1.0, 5.0, 300.0)
+  system.Initialize([0.0], [10.0], tmpdir)
+  for x in [-0.5, 0.5]:
+    system.AddWindow([x], [10.0], parent_window=system.windows[0])
+  points = npy.linspace(cv.wham_min_value, cv.wham_max_value, cv.wham_num_bins)
+  system.pmf = PMF(points, points * points, [cv], 10.0)
+  system.Save("siPMF_state")
+  return os.path.join(tmpdir, "siPMF_state")
+
+
+def Measure(repeat, state=""):
+  """
+  Import the package (and load *state* if given) *repeat* times, each time in a new python process.
+  Returns the list of results, each a dictionary with the import time, load time and heavy modules imported.
+  """
+  code = _IMPORT_CODE.format(parent=os.path.dirname(PACKAGE_DIR), name=PACKAGE_NAME,
+                             state=state, heavy=HEAVY_MODULES)
+  results = []
+  for i in range(repeat):
+    out = subprocess.check_output([sys.executable, "-c", code])
+    results.append(json.loads(out.decode().strip().splitlines()[-1]))
+  return results
+
+
+def _Median(values):
+  values = sorted(values)
+  return values[len(values) // 2]
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+  parser.add_argument("--repeat", type=int, default=5,
+                      help="number of fresh processes used for each measurement")
+  parser.add_argument("--max-time", type=float, default=None,
+                      help="fail if the median import (or import+load) time in seconds exceeds this")
+  args = parser.parse_args()
+  tmpdir = tempfile.mkdtemp()
+  failed = False
+  try:
+    state = _MakeState(tmpdir)
+    for label, st in [("import", ""), ("import+LoadSystem", state)]:
+      results = Measure(args.repeat, st)
+      t = _Median([r["import"] + r["load"] for r in results])
+      heavy = sorted(set(m for r in results for m in r["heavy"]))
+      print("{0}: median {1:.3f}s over {2} runs, heavy modules imported: {3}".format(
+          label, t, args.repeat, ", ".join(heavy) if heavy else "none"))
+      if heavy:
+        failed = True
+      if args.max_time is not None and t > args.max_time:
+        print("{0} exceeds the maximal time of {1}s".format(label, args.max_time))
+        failed = True
+  finally:
+    shutil.rmtree(tmpdir)
+  if failed:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,879 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+Synthetic benchmarks of the siPMF package. A :class:`~system.System` is built on an analytic potential
+(1D double well, 2D Muller-Brown or N-D periodic cosine potential) and jobs are run by a fake
+:class:`~environment.Environment`: *qsub* records the job and *qstat* reports it in the queue, then running,
+then finished after configurable delays. When a job finishes, harmonically restrained overdamped Langevin
+samples of the potential are written to the datafile of its phase, so that all the code that reads and
+writes datafiles runs as it would on a cluster. WHAM is replaced by *fake_wham.py* unless another
+executable is given (for more than two CVs, the PMF is calculated in process, see :mod:`~wham`).
+Since the CVs are the only degrees of freedom, the exact PMF is the potential itself,
+which is used to check the accuracy of the calculated PMF.
+
+Two benchmarks are available:
+::
+  python benchmarks/synthetic.py run --potential doublewell --max-error 0.5
+  python benchmarks/synthetic.py micro --potential mullerbrown --sizes 10 100 1000 10000
+  python benchmarks/synthetic.py run --dimensionality 1 --chain-length 3 --samples-per-phase 30 --max-window-samples 240
+
+*run* times *SiPMF.Run* from a single window at the minimum of the potential until no new windows can be
+generated, and reports the error of the final PMF as well as the number of jobs and samples it took
+(*--allocation-target* runs it with an :class:`~allocation.UncertaintyAllocation`). *micro* builds systems with a lattice of windows covering
+the whole potential and times *UpdateDataFiles*, *UpdatePMF*, *Save*, *LoadSystem*,
+*RebuildWindowsAndPhasesFromDirectoryTree* and *GenerateNewWindows* for each number of windows.
+The time spent generating the samples (i.e. "running the simulations") is reported separately and
+is not part of any of the measured times. Both exit with a non-zero status if the error of the PMF
+exceeds *--max-error*, and *run* also if a window collected more than *--max-window-samples* samples.
+The third command is a regression case for chains of short phases: each window needs 7 phases of
+30 samples, and windows got new chains while their previous chain was still running when a window
+was listed once for each of its finished phases.
+"""
+import os
+import re
+import sys
+import time
+import json
+import shutil
+import tempfile
+import argparse
+import importlib
+import numpy as npy
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE_NAME = os.path.basename(PACKAGE_DIR)
+FAKE_WHAM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_wham.py")
+KB = 0.001982923700
+
+sys.path.insert(0, os.path.dirname(PACKAGE_DIR))
+os.environ.setdefault("MPLBACKEND", "Agg")
+siPMF = importlib.import_module(PACKAGE_NAME)
+_system = importlib.import_module(PACKAGE_NAME + ".system")
+_metrics = importlib.import_module(PACKAGE_NAME + ".metrics")
+_allocation = importlib.import_module(PACKAGE_NAME + ".allocation")
+_packing = importlib.import_module(PACKAGE_NAME + ".packing")
+_reus = importlib.import_module(PACKAGE_NAME + ".reus")
+_wham = importlib.import_module(PACKAGE_NAME + ".wham")
+_sizing = importlib.import_module(PACKAGE_NAME + ".sizing")
+_multi = importlib.import_module(PACKAGE_NAME + ".multi")
+
+
+class Potential():
+  """
+  Base class of the analytic potentials (in kcal/mol). Derived classes define *Energy* and *Gradient*,
+  which work on arrays of points of shape *(...,dimensionality)*, as well as the box in which windows
+  are generated (*mins*, *maxs*), the periodicity of each CV (0 if not periodic), a point close to
+  the global minimum and the largest curvature of the potential (*stiffness*), used to choose the time step.
+  """
+  names = []
+  units = ""
+
+  def Wrap(self, x):
+    """
+    Wrap the periodic CVs into the box.
+    """
+    x = npy.array(x, dtype=float)
+    for i, p in enumerate(self.periods):
+      if p:
+        x[..., i] = self.mins[i] + npy.mod(x[..., i] - self.mins[i], p)
+    return x
+
+  def Delta(self, x, center):
+    """
+    Difference *x-center* using the minimum image for periodic CVs.
+    """
+    d = npy.array(x, dtype=float) - center
+    for i, p in enumerate(self.periods):
+      if p:
+        d[..., i] -= p * npy.round(d[..., i] / p)
+    return d
+
+  def CVList(self, n_windows_per_cv, temperature, bins_per_step=4):
+    """
+    Collective variables for a lattice of *n_windows_per_cv* windows along every CV covering the box.
+    Spring constants are chosen such that the standard deviation of a window is half a step (at most four times stiffer
+    for adapted windows).
+    """
+    kT = KB * temperature
+    cv_list = []
+    for name, mi, ma, p in zip(self.names, self.mins, self.maxs, self.periods):
+      step_size = (ma - mi) / float(n_windows_per_cv)
+      spring_constant = 4.0 * kT / (step_size * step_size)
+      cv_list.append(siPMF.CollectiveVariable(name, mi, ma, step_size, bins_per_step * n_windows_per_cv,
+                                              spring_constant, 4.0 * spring_constant, periodicity=p if p else None,
+                                              units=self.units))
+    return cv_list
+
+
+class DoubleWell(Potential):
+  """
+  1D double well *barrier((x/width)^2-1)^2+tilt x*.
+  """
+
+  def __init__(self, barrier=5.0, width=1.0, tilt=0.5):
+    self.barrier = barrier
+    self.width = width
+    self.tilt = tilt
+    self.dimensionality = 1
+    self.names = ["x"]
+    self.mins = npy.array([-2.0 * width])
+    self.maxs = npy.array([2.0 * width])
+    self.periods = [0.0]
+    self.minimum = npy.array([-width])
+    self.stiffness = barrier * 44.0 / (width * width)
+
+  def Energy(self, x):
+    u = x[..., 0] / self.width
+    return self.barrier * (u * u - 1)**2 + self.tilt * x[..., 0]
+
+  def Gradient(self, x):
+    u = x[..., 0] / self.width
+    return (4 * self.barrier * u * (u * u - 1) / self.width + self.tilt)[..., None]
+
+
+class MullerBrown(Potential):
+  """
+  2D Muller-Brown potential, scaled by *scale*.
+  """
+  A = npy.array([-200.0, -100.0, -170.0, 15.0])
+  a = npy.array([-1.0, -1.0, -6.5, 0.7])
+  b = npy.array([0.0, 0.0, 11.0, 0.6])
+  c = npy.array([-10.0, -10.0, -6.5, 0.7])
+  x0 = npy.array([1.0, 0.0, -0.5, -1.0])
+  y0 = npy.array([0.0, 0.5, 1.5, 1.0])
+
+  def __init__(self, scale=0.1):
+    self.scale = scale
+    self.dimensionality = 2
+    self.names = ["x", "y"]
+    self.mins = npy.array([-1.5, -0.5])
+    self.maxs = npy.array([1.0, 2.0])
+    self.periods = [0.0, 0.0]
+    self.minimum = npy.array([-0.558, 1.442])
+    self.stiffness = 2500.0 * scale
+
+  def _Terms(self, x):
+    dx = x[..., 0, None] - self.x0
+    dy = x[..., 1, None] - self.y0
+    e = self.scale * self.A * \
+        npy.exp(self.a * dx * dx + self.b * dx * dy + self.c * dy * dy)
+    return dx, dy, e
+
+  def Energy(self, x):
+    return npy.sum(self._Terms(x)[2], axis=-1)
+
+  def Gradient(self, x):
+    dx, dy, e = self._Terms(x)
+    gx = npy.sum(e * (2 * self.a * dx + self.b * dy), axis=-1)
+    gy = npy.sum(e * (self.b * dx + 2 * self.c * dy), axis=-1)
+    return npy.concatenate([gx[..., None], gy[..., None]], axis=-1)
+
+
+class PeriodicCosine(Potential):
+  """
+  N-D periodic potential of dihedral-like CVs (in degrees),
+  *sum_i amplitude(1-cos(q_i))+coupling(1-cos(q_i-q_i+1))*.
+  """
+
+  def __init__(self, dimensionality=3, amplitude=2.0, coupling=0.5):
+    self.amplitude = amplitude
+    self.coupling = coupling
+    self.dimensionality = dimensionality
+    self.names = ["q" + str(i + 1) for i in range(dimensionality)]
+    self.mins = npy.array([-180.0] * dimensionality)
+    self.maxs = npy.array([180.0] * dimensionality)
+    self.periods = [360.0] * dimensionality
+    self.minimum = npy.zeros(dimensionality)
+    self.stiffness = (amplitude + 4 * coupling) * (npy.pi / 180.)**2
+    self.units = "deg"
+
+  def Energy(self, x):
+    q = npy.radians(x)
+    e = npy.sum(self.amplitude * (1 - npy.cos(q)), axis=-1)
+    if self.dimensionality > 1:
+      e += npy.sum(self.coupling *
+                   (1 - npy.cos(q[..., :-1] - q[..., 1:])), axis=-1)
+    return e
+
+  def Gradient(self, x):
+    q = npy.radians(x)
+    g = self.amplitude * npy.sin(q)
+    if self.dimensionality > 1:
+      s = self.coupling * npy.sin(q[..., :-1] - q[..., 1:])
+      g[..., :-1] += s
+      g[..., 1:] -= s
+    return g * npy.pi / 180.
+
+
+POTENTIALS = {"doublewell": DoubleWell, "mullerbrown": MullerBrown,
+              "cosine": PeriodicCosine}
+
+
+def SampleRestrained(potential, x0, centers, springs, kT, n_steps, stride, rng, step_fraction=0.5):
+  """
+  Metropolis-adjusted overdamped Langevin dynamics of independent particles on *potential* with harmonic
+  restraints *1/2 k (x-center)^2*, all propagated together. The Metropolis test removes the bias due to
+  the finite time step, so that the samples follow the restrained Boltzmann distribution exactly.
+  Returns the positions every *stride* steps, an array of shape *(n_steps/stride,n_particles,dimensionality)*.
+  """
+  x = potential.Wrap(npy.array(x0, dtype=float))
+  centers = npy.array(centers, dtype=float)
+  springs = npy.array(springs, dtype=float)
+  # Standard deviation of the random displacement per step
+  sigma = step_fraction * \
+      npy.sqrt(kT / npy.maximum(springs, potential.stiffness))
+  drift = sigma * sigma / (2 * kT)
+
+  def EnergyAndForce(x):
+    d = potential.Delta(x, centers)
+    e = potential.Energy(x) + 0.5 * npy.sum(springs * d * d, axis=-1)
+    return e, -potential.Gradient(x) - springs * d
+
+  def LogProposal(y, x, fx):
+    r = (potential.Delta(y, x) - drift * fx) / sigma
+    return -0.5 * npy.sum(r * r, axis=-1)
+  e, force = EnergyAndForce(x)
+  out = npy.empty([n_steps // stride, len(x), potential.dimensionality])
+  for step in range(n_steps // stride * stride):
+    y = potential.Wrap(x + drift * force + sigma *
+                       rng.standard_normal(x.shape))
+    ey, fy = EnergyAndForce(y)
+    log_acc = -(ey - e) / kT + LogProposal(x, y, fy) - LogProposal(y, x, force)
+    accept = npy.log(rng.uniform(size=len(x))) < log_acc
+    x[accept] = y[accept]
+    e[accept] = ey[accept]
+    force[accept] = fy[accept]
+    if (step + 1) % stride == 0:
+      out[(step + 1) // stride - 1] = x
+  return out
+
+
+def SampleReplicaExchange(potential, x0, centers, springs, kT, n_steps, stride, rng, pairs, exchange_stride=10):
+  """
+  Replica-exchange umbrella sampling: replica *i* starts in window *i* (restraint *centers[i]*, *springs[i]*)
+  and every *exchange_stride* samples, exchanges between the windows of the neighboring *pairs* are attempted
+  with the Metropolis criterion. Returns the positions of the replicas (as *SampleRestrained*) and the index of the
+  window of each replica for each sample, an array of shape *(n_steps/stride,n_replicas)*.
+  """
+  centers = npy.array(centers, dtype=float)
+  springs = npy.array(springs, dtype=float)
+  x = npy.array(x0, dtype=float)
+  n = len(x)
+  window = npy.arange(n)
+  n_samples = n_steps // stride
+  traj = npy.empty([n_samples, n, potential.dimensionality])
+  windows = npy.empty([n_samples, n], dtype=int)
+
+  def Bias(x, w):
+    d = potential.Delta(x, centers[w])
+    return 0.5 * npy.sum(springs[w] * d * d, axis=-1)
+  done = 0
+  while done < n_samples:
+    m = min(exchange_stride, n_samples - done)
+    segment = SampleRestrained(potential, x, centers[window], springs[window], kT, m * stride, stride, rng)
+    traj[done:done + m] = segment
+    windows[done:done + m] = window
+    x = segment[-1].copy()
+    done += m
+    replica = npy.argsort(window)
+    for a, b in pairs:
+      ra, rb = replica[a], replica[b]
+      delta = (Bias(x[ra], b) + Bias(x[rb], a) - Bias(x[ra], a) - Bias(x[rb], b)) / kT
+      if npy.log(rng.uniform()) < -delta:
+        window[ra], window[rb] = b, a
+        replica[a], replica[b] = rb, ra
+  return traj, windows
+
+
+def _WriteTemplates(basedir):
+  for fname in ["init.in", "run.in", "init.sh", "run.sh"]:
+    f = open(os.path.join(basedir, fname), "w")
+    f.write("# {OUTPUTDIR} restarted from {RESTARTDIR}\n")
+    f.close()
+  f = open(os.path.join(basedir, "bundle.sh"), "w")
+  f.write("# {BUNDLE} on {NCORES} cores\n{BUNDLE_COMMANDS}\n")
+  f.close()
+  f = open(os.path.join(basedir, "reus.in"), "w")
+  f.write("# {BLOCK} with {NREPLICAS} replicas\n{REPLICA_BEGIN}\nreplica {REPLICA} {OUTPUTDIR}\n{REPLICA_END}\n"
+          "pairs {EXCHANGE_PAIRS}\n")
+  f.close()
+  f = open(os.path.join(basedir, "reus.sh"), "w")
+  f.write("# {INPUTFILE}\n")
+  f.close()
+
+
+def WriteFakeWhamWrapper(directory):
+  """
+  *System.CalculatePMF* calls the WHAM executable directly, so *fake_wham.py* is wrapped
+  in a shell script running it with the current python interpreter. Returns the path to the script.
+  """
+  path = os.path.join(directory, "fake_wham.sh")
+  f = open(path, "w")
+  f.write("#!/bin/sh\nexec \"{0}\" \"{1}\" \"$@\"\n".format(sys.executable, FAKE_WHAM))
+  f.close()
+  os.chmod(path, 0o755)
+  return path
+
+
+class FakeEnvironment(siPMF.Environment):
+  """
+  Environment running the jobs in-process. A job waits *queue_delay* seconds in the queue and runs
+  for *run_delay* seconds plus *step_delay* seconds per MD step of its longest phase. When it is reported finished for the first time, the samples of all the
+  finished jobs are generated at once (*SampleRestrained*) and written to the datafiles of their phases.
+  Each phase also writes its last position to *fake_restart.txt*, which is the restart of the next phase.
+  """
+  RESTART_FNAME = "fake_restart.txt"
+
+  def __init__(self, system, potential, queue_delay=0.0, run_delay=0.0, output_stride=10, seed=1,
+               wham_executable=None, qstat_all=False, step_delay=0.0):
+    self.system = system
+    self.systems = [system]
+    self.potential = potential
+    self.queue_delay = queue_delay
+    self.run_delay = run_delay
+    self.step_delay = step_delay
+    self.output_stride = output_stride
+    self.rng = npy.random.RandomState(seed)
+    if not wham_executable:
+      wham_executable = WriteFakeWhamWrapper(system.basedir)
+    self.wham_executable = wham_executable
+    self.restart_extractor = self.ExtractRestart
+    self.jobs = {}
+    self.pending = []
+    self.simulation_time = 0.0
+    self.qsub = self.Qsub
+    self.qstat = self.Qstat
+    self.qdel = self.Qdel
+    self.qstat_all = self.QstatAll if qstat_all else None
+    self.n_qstat_calls = 0
+    self.max_unfinished = 0
+
+  def AddSystem(self, system):
+    """
+    Run the jobs of another system too.
+    """
+    self.systems.append(system)
+
+  def _FindPhase(self, outdir):
+    window_dir = os.path.dirname(os.path.normpath(outdir))
+    for system in self.systems:
+      if os.path.dirname(window_dir) == os.path.normpath(system.simu_dir):
+        return system.FindPhaseByName(os.path.basename(window_dir), os.path.basename(os.path.normpath(outdir)))
+    raise ValueError("No system with a window in {0}".format(window_dir))
+
+  def Qsub(self, outdir, path_to_job_file, hold_jid=None):
+    kind = os.path.basename(os.path.dirname(os.path.normpath(outdir)))
+    bundle = kind == "bundles"
+    pairs = None
+    if bundle:
+      # The phases of a bundle are found from the commands launching them
+      f = open(path_to_job_file)
+      phases = [self._FindPhase(d) for d in re.findall(r"cd (\S+) && ", f.read())]
+      f.close()
+    elif kind == "reus":
+      # The phases of a replica exchange block are found from its input
+      f = open(os.path.join(outdir, "reus.in"))
+      data = f.read()
+      f.close()
+      phases = [self._FindPhase(d) for d in re.findall(r"^replica \d+ (\S+)$", data, re.M)]
+      pairs = [tuple(int(i) for i in el.split("-")) for el in re.findall(r"\d+-\d+", data)]
+    else:
+      phases = [self._FindPhase(outdir)]
+    jid = str(len(self.jobs) + 1)
+    self.jobs[jid] = {"phases": phases, "bundle": bundle, "submit_time": time.time(), "done": False,
+                      "hold": hold_jid, "finish_time": None, "pairs": pairs}
+    self.pending.append(jid)
+    self.max_unfinished = max(self.max_unfinished, len(self.pending))
+    return jid
+
+  def Qdel(self, jid):
+    if jid in self.pending:
+      self.pending.remove(jid)
+    self.jobs[jid]["done"] = True
+    self.jobs[jid]["finish_time"] = time.time()
+
+  def _StartTime(self, jid):
+    """
+    Time from which the delays of a job count: its submission, or the end of the job it depends on.
+    Returns *None* if that job is not finished yet.
+    """
+    job = self.jobs[jid]
+    if job["hold"] is None:
+      return job["submit_time"]
+    hold = self.jobs[job["hold"]]
+    if not hold["done"]:
+      return None
+    return max(job["submit_time"], hold["finish_time"])
+
+  def _NSteps(self, phase):
+    system = phase.window.system
+    if getattr(phase, "nstep", None):
+      return phase.nstep
+    if phase.type == "initialization":
+      if getattr(phase, "restart_frame", None) is not None and system.nearest_restart_init_nstep:
+        return system.nearest_restart_init_nstep
+      return system.init_nstep
+    return system.run_nstep
+
+  def _Duration(self, jid):
+    """
+    Time a job spends in the queue and running.
+    """
+    n_steps = max([self._NSteps(p) for p in self.jobs[jid]["phases"]])
+    return self.queue_delay + self.run_delay + self.step_delay * n_steps
+
+  def Qstat(self, jid):
+    self.n_qstat_calls += 1
+    return self._Status(jid)
+
+  def QstatAll(self):
+    self.n_qstat_calls += 1
+    status = dict((jid, self._Status(jid)) for jid in list(self.pending))
+    return dict((jid, s) for jid, s in status.items() if s != "finished")
+
+  def _Status(self, jid):
+    job = self.jobs[jid]
+    if job["done"]:
+      return "finished"
+    start = self._StartTime(jid)
+    if start is None:
+      return "in queue"
+    t = time.time() - start
+    if t < self.queue_delay:
+      return "in queue"
+    if t < self._Duration(jid):
+      return "running"
+    if not job["done"]:
+      self.RunJobs(time.time())
+    return "finished"
+
+  def ExtractRestart(self, phase, frame, restartdir):
+    # The trajectory has one frame every *System.samples_per_frame* lines of the datafile
+    system = phase.window.system
+    cvs = phase.ReadDataFile()[1]
+    row = system.frame_offset + frame * system.samples_per_frame
+    npy.savetxt(os.path.join(restartdir, self.RESTART_FNAME),
+                npy.array([[cv[row] for cv in cvs]]))
+
+  def _StartingPoint(self, phase):
+    path = os.path.join(phase.restartdir or "", self.RESTART_FNAME)
+    if phase.restartdir and os.path.isfile(path):
+      return npy.loadtxt(path, ndmin=2)[-1]
+    return npy.array(phase.window.cv_values, dtype=float)
+
+  def RunJobs(self, now=None):
+    """
+    Generate the samples of all the pending jobs whose delays are over (all pending jobs if *now* is *None*).
+    """
+    t0 = time.time()
+    ready = [jid for jid in self.pending if self._StartTime(jid) is not None and (
+        now is None or now - self._StartTime(jid) >= self._Duration(jid))]
+    if not ready:
+      return
+    for jid in [jid for jid in ready if self.jobs[jid]["pairs"] is not None]:
+      self._RunReplicaExchange(self.jobs[jid])
+    groups = {}
+    for jid, phase in [(jid, p) for jid in ready if self.jobs[jid]["pairs"] is None
+                       for p in self.jobs[jid]["phases"]]:
+      groups.setdefault((phase.window.system.temperature, self._NSteps(phase)), []).append(phase)
+    for (temperature, n_steps), phases in groups.items():
+      kT = KB * temperature
+      x0 = npy.array([self._StartingPoint(p) for p in phases])
+      centers = npy.array([npy.array(p.window.cv_values) + npy.array(p.window.cv_shifts)
+                           for p in phases])
+      springs = npy.array([p.window.spring_constants for p in phases])
+      traj = SampleRestrained(self.potential, x0, centers, springs, kT, n_steps, self.output_stride,
+                              self.rng)
+      steps = npy.arange(1, len(traj) + 1) * self.output_stride
+      for i, p in enumerate(phases):
+        if p.type == "run" and len(traj):
+          npy.savetxt(p.path_to_datafile, npy.column_stack([steps, traj[:, i, :]]), fmt="%.6f",
+                      header="step " + " ".join(self.potential.names))
+        last = traj[-1, i] if len(traj) else x0[i]
+        npy.savetxt(os.path.join(p.outdir, self.RESTART_FNAME), last.reshape([1, -1]))
+    for jid in ready:
+      if self.jobs[jid]["bundle"]:
+        for p in self.jobs[jid]["phases"]:
+          open(os.path.join(p.outdir, _packing.JobPacker.FINISHED_FNAME), "w").close()
+      self.jobs[jid]["done"] = True
+      if now is None:
+        self.jobs[jid]["finish_time"] = time.time()
+      else:
+        self.jobs[jid]["finish_time"] = self._StartTime(jid) + self._Duration(jid)
+      self.pending.remove(jid)
+    self.simulation_time += time.time() - t0
+    # Jobs depending on the ones that just finished may be over too
+    self.RunJobs(now)
+
+
+  def _RunReplicaExchange(self, job):
+    phases = job["phases"]
+    system = phases[0].window.system
+    kT = KB * system.temperature
+    x0 = npy.array([self._StartingPoint(p) for p in phases])
+    centers = npy.array([npy.array(p.window.cv_values) + npy.array(p.window.cv_shifts) for p in phases])
+    springs = npy.array([p.window.spring_constants for p in phases])
+    traj, windows = SampleReplicaExchange(self.potential, x0, centers, springs, kT, self._NSteps(phases[0]),
+                                          self.output_stride, self.rng, job["pairs"])
+    steps = npy.arange(1, len(traj) + 1) * self.output_stride
+    for i, p in enumerate(phases):
+      npy.savetxt(p.path_to_datafile, npy.column_stack([steps, traj[:, i, :], windows[:, i]]), fmt="%.6f",
+                  header="step " + " ".join(self.potential.names) + " window")
+      npy.savetxt(os.path.join(p.outdir, self.RESTART_FNAME), traj[-1, i].reshape([1, -1]))
+    job["exchanges"] = int(npy.sum(windows[1:] != windows[:-1]))
+
+
+def CreateSystem(basedir, potential, n_windows_per_cv, temperature, n_data, output_stride=10, max_E1=None,
+                 max_E2=None, samples_per_phase=None, allocation=None, bins_per_step=4):
+  """
+  Create a :class:`~system.System` for *potential* in *basedir*. Each phase generates *samples_per_phase*
+  samples (by default *n_data*).
+  """
+  _WriteTemplates(basedir)
+  cv_list = potential.CVList(n_windows_per_cv, temperature, bins_per_step)
+  max_E1 = 4.0 if max_E1 is None else max_E1
+  max_E2 = 2 * max_E1 if max_E2 is None else max_E2
+  nstep = (samples_per_phase or n_data) * output_stride
+  return _system.System(basedir, cv_list, "init.in", "run.in", "init.sh", "run.sh", "colvars.traj",
+                        nstep, nstep, n_data, max_E1, max_E2, temperature,
+                        check_fnames=[FakeEnvironment.RESTART_FNAME], name=potential.__class__.__name__,
+                        allocation=allocation)
+
+
+def _LatticeCenters(potential, n_per_cv, max_energy):
+  axes = [mi + (npy.arange(n_per_cv) + 0.5) * (ma - mi) / float(n_per_cv)
+          for mi, ma in zip(potential.mins, potential.maxs)]
+  centers = npy.array(npy.meshgrid(*axes, indexing="ij")
+                      ).reshape([potential.dimensionality, -1]).T
+  e = potential.Energy(centers)
+  return centers[e - npy.min(e) < max_energy]
+
+
+def BuildLatticeSystem(basedir, potential, n_windows, temperature, n_data, output_stride=10, seed=1,
+                       max_energy=12.0):
+  """
+  Build a system with at least *n_windows* windows on a regular lattice covering the region of the box where
+  the potential is less than *max_energy* above its minimum, with one finished run phase per window.
+  Returns the system and the environment.
+  """
+  n_per_cv = max(1, int(n_windows**(1.0 / potential.dimensionality)))
+  while len(_LatticeCenters(potential, n_per_cv, max_energy)) < n_windows:
+    n_per_cv += 1
+  system = CreateSystem(basedir, potential, n_per_cv,
+                        temperature, n_data, output_stride)
+  env = FakeEnvironment(system, potential,
+                        output_stride=output_stride, seed=seed)
+  springs = [cv.min_spring_constant for cv in system.cv_list]
+  for center in _LatticeCenters(potential, n_per_cv, max_energy):
+    system.Initialize([round(float(el), 6) for el in center], springs, basedir)
+  system.SubmitNewJobs(env)
+  env.RunJobs()
+  system.UpdateUnfinishedJobList(env)
+  system.UpdateDataCounts()
+  return system, env
+
+
+def PMFError(system, potential, max_energy):
+  """
+  Error of the PMF of *system* with respect to the exact PMF (the potential), on the points of the PMF
+  where the exact free energy is below *max_energy*. The PMF is only defined up to a constant, so it is
+  shifted to have the same mean as the exact PMF on these points.
+  Returns the root mean square and maximal errors as well as the number of points compared.
+  """
+  pmf = system.pmf
+  points = npy.array(pmf.points, dtype=float).reshape(
+      [-1, potential.dimensionality])
+  values = npy.array(pmf.values, dtype=float)
+  exact = potential.Energy(potential.Wrap(points))
+  exact -= npy.min(exact)
+  inside = npy.all((points >= potential.mins) & (points <= potential.maxs), axis=1) | npy.array(
+      [all(potential.periods)] * len(points))
+  mask = inside & npy.isfinite(values) & (
+      values < pmf.max_E) & (exact < max_energy)
+  if not npy.any(mask):
+    return {"rmse": float("nan"), "max_error": float("nan"), "n_points": 0}
+  diff = values[mask] - exact[mask]
+  diff -= npy.mean(diff)
+  return {"rmse": float(npy.sqrt(npy.mean(diff * diff))), "max_error": float(npy.max(npy.abs(diff))),
+          "n_points": int(npy.sum(mask))}
+
+
+def _Timed(results, name, fn, *args, **kwargs):
+  t0 = time.time()
+  out = fn(*args, **kwargs)
+  results[name] = time.time() - t0
+  return out
+
+
+def _RunSystem(basedir, potential, args):
+  """
+  Create the system of the *run* benchmark in *basedir*, with the options given on the command line.
+  """
+  allocation = None
+  if args.allocation_target is not None:
+    allocation = _allocation.UncertaintyAllocation(
+        args.allocation_target, seed=args.seed)
+  system = CreateSystem(basedir, potential, args.windows_per_cv, args.temperature, args.n_data,
+                        args.output_stride, args.max_E1, args.max_E2, args.samples_per_phase, allocation,
+                        args.bins_per_step)
+  if args.pack_cores:
+    system.packing = _packing.JobPacker("bundle.sh", args.pack_cores)
+  system.chain_length = args.chain_length
+  system.n_walkers = args.walkers
+  system.samples_per_frame = args.samples_per_frame
+  system.restart_from_nearest_sample = args.nearest_restart
+  if args.reus:
+    system.reus = _reus.ReplicaExchange("reus.in", "reus.sh", args.reus)
+  system.min_overlap = args.min_overlap
+  system.adapt_poor_overlaps = args.adapt_overlap
+  if args.refine_grid:
+    system.grid_refinement = _wham.GridRefinement(args.refine_grid)
+  if args.target_walltime:
+    system.phase_sizing = _sizing.PhaseSizing(args.target_walltime, step_multiple=args.output_stride)
+  return system
+
+
+def RunBenchmark(basedir, potential, args):
+  """
+  Time *SiPMF.Run* exploring *potential* from a single window at its minimum. With *--systems*, as many
+  copies of the system are run by a single :class:`~multi.MultiSiPMF` sharing the environment.
+  """
+  if args.systems > 1:
+    basedirs = [os.path.join(basedir, "system{0}".format(i)) for i in range(args.systems)]
+    for d in basedirs:
+      os.mkdir(d)
+  else:
+    basedirs = [basedir]
+  systems = [_RunSystem(d, potential, args) for d in basedirs]
+  env = FakeEnvironment(systems[0], potential, args.queue_delay, args.run_delay, args.output_stride,
+                        args.seed, args.wham, args.qstat_all or args.count_queue, args.step_delay)
+  for system in systems[1:]:
+    env.AddSystem(system)
+  for system in systems:
+    # Start from the lattice point closest to the minimum. With box sizes and numbers of windows such that the
+    # step sizes are exact binary fractions, the CV values of all the windows are then exact.
+    start = [float(cv.min_value + (npy.floor((m - cv.min_value) / cv.step_size) + 0.5) * cv.step_size)
+             for m, cv in zip(potential.minimum, system.cv_list)]
+    system.Initialize(
+        start, [cv.min_spring_constant for cv in system.cv_list], system.basedir)
+  options = {"min_sleep_length": args.min_sleep_length, "compress_data": args.compress_data}
+  if len(systems) == 1:
+    supervisor = siPMF.SiPMF(systems[0], env)
+    options.update({"max_running_jobs": args.max_running_jobs, "count_queue": args.count_queue})
+  else:
+    supervisor = _multi.MultiSiPMF(systems, env, args.max_running_jobs, policy=args.policy,
+                                   count_queue=args.count_queue)
+  timings = {}
+  _Timed(timings, "run", supervisor.Run, args.max_time, args.max_jobs, args.sleep_length,
+         background_plotting=args.background_plotting, record_metrics=True, **options)
+  all_results = []
+  for system in systems:
+    jobs = [j for j in env.jobs.values() if j["phases"][0].window.system is system]
+    results = {"benchmark": "run", "potential": potential.__class__.__name__,
+               "dimensionality": potential.dimensionality, "run": timings["run"]}
+    results["n_windows"] = len(system.windows)
+    results["n_jobs"] = len(jobs)
+    results["n_phases"] = sum([len(j["phases"]) for j in jobs])
+    results["n_exchanges"] = sum([j.get("exchanges", 0) for j in jobs])
+    if args.min_overlap:
+      results["n_poor_overlaps"] = len(system.GetPoorOverlaps())
+    system.UpdateDataCounts()
+    results["n_samples"] = sum([w.n_data for w in system.windows])
+    results["max_window_samples"] = max([w.n_data for w in system.windows])
+    paths = [p.GetPathToDataFile() for w in system.windows for p in w.phases]
+    results["phase_datafile_bytes"] = sum([os.path.getsize(p) for p in paths if p])
+    results["simulation"] = env.simulation_time
+    results["supervisor"] = results["run"] - env.simulation_time
+    results["n_qstat_calls"] = env.n_qstat_calls
+    results["max_unfinished_jobs"] = env.max_unfinished
+    results["n_cycles"] = 0
+    for line in open(os.path.join(system.basedir, "metrics.jsonl")):
+      results["n_cycles"] += 1
+      for part, t in json.loads(line)["timings"].items():
+        if part != "cycle":
+          results["run/" + part] = results.get("run/" + part, 0.0) + t
+    results["pmf_error"] = PMFError(system, potential, system.max_E1)
+    all_results.append(results)
+  return all_results
+
+
+def MicroBenchmarks(basedir, potential, args):
+  """
+  Time the main operations of :class:`~system.System` on lattices of windows of increasing size.
+  """
+  all_results = []
+  for n in args.sizes:
+    d = os.path.join(basedir, "lattice_{0}".format(n))
+    os.mkdir(d)
+    t0 = time.time()
+    system, env = BuildLatticeSystem(d, potential, n, args.temperature, args.n_data, args.output_stride,
+                                     args.seed)
+    if args.wham:
+      env.wham_executable = args.wham
+    results = {"benchmark": "micro", "potential": potential.__class__.__name__,
+               "dimensionality": potential.dimensionality, "n_windows": len(system.windows),
+               "setup": time.time() - t0, "simulation": env.simulation_time}
+    _Timed(results, "UpdateDataFiles", system.UpdateDataFiles,
+           0, -1, False)
+    system.metrics = _metrics.MetricsRecorder(os.path.join(d, "metrics.jsonl"),
+                                              os.path.join(d, "metrics.prom"))
+    system.metrics.StartCycle()
+    _Timed(results, "UpdatePMF", system.UpdatePMF, env)
+    for part, t in system.metrics.timings.items():
+      results["UpdatePMF/" + part] = t
+    system.metrics = None
+    results["pmf_error"] = PMFError(system, potential, system.max_E2)
+    _Timed(results, "Save", system.Save, "siPMF_state")
+    _Timed(results, "LoadSystem", _system.LoadSystem,
+           os.path.join(d, "siPMF_state"))
+    rebuilt = _system.System(d, system.cv_list, "init.in", "run.in", "init.sh", "run.sh", "colvars.traj",
+                             system.init_nstep, system.run_nstep, system.n_data, system.max_E1,
+                             system.max_E2, system.temperature)
+    _Timed(results, "RebuildWindowsAndPhasesFromDirectoryTree",
+           _system.RebuildWindowsAndPhasesFromDirectoryTree, rebuilt)
+    n_new, threshold = _Timed(
+        results, "GenerateNewWindows", system.GenerateNewWindows, env)
+    results["n_new_windows"] = n_new
+    all_results.append(results)
+    shutil.rmtree(d)
+  return all_results
+
+
+def _Print(results):
+  for r in results:
+    print("{0} {1} ({2}D), {3} windows:".format(
+        r["benchmark"], r["potential"], r["dimensionality"], r["n_windows"]))
+    for key in sorted(r):
+      if isinstance(r[key], float):
+        print("  {0:45s} {1:10.3f}s".format(key, r[key]))
+    if "pmf_error" in r:
+      e = r["pmf_error"]
+      if "n_samples" in r:
+        print("  {0} jobs, {1} phases, {2} samples, at most {3} per window".format(
+            r["n_jobs"], r["n_phases"], r["n_samples"], r["max_window_samples"]))
+        if r.get("n_exchanges"):
+          print("  {0} replica exchanges".format(r["n_exchanges"]))
+        if "n_poor_overlaps" in r:
+          print("  {0} poorly overlapping neighbor pairs".format(r["n_poor_overlaps"]))
+        if "n_qstat_calls" in r:
+          print("  {0} cycles, {1} queue status calls, at most {2} unfinished jobs".format(
+              r["n_cycles"], r["n_qstat_calls"], r["max_unfinished_jobs"]))
+      print("  PMF error: rmse {0:.3f}, max {1:.3f} kcal/mol over {2} points".format(
+          e["rmse"], e["max_error"], e["n_points"]))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+  parser.add_argument("benchmark", choices=["run", "micro"])
+  parser.add_argument("--potential", choices=sorted(POTENTIALS), default="doublewell")
+  parser.add_argument("--dimensionality", type=int, default=3,
+                      help="number of CVs of the cosine potential")
+  parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000],
+                      help="numbers of windows for the micro benchmarks")
+  parser.add_argument("--windows-per-cv", type=int, default=32,
+                      help="number of windows spanning each CV for the run benchmark")
+  parser.add_argument("--background-plotting", action="store_true",
+                      help="render the plots in a background process during the run benchmark")
+  parser.add_argument("--n-data", type=int, default=200,
+                      help="number of samples per window (System.n_data)")
+  parser.add_argument("--samples-per-phase", type=int, default=None,
+                      help="number of samples per phase (default: --n-data)")
+  parser.add_argument("--allocation-target", type=float, default=None,
+                      help="run benchmark with an UncertaintyAllocation of this target error (kcal/mol)")
+  parser.add_argument("--pack-cores", type=int, default=None,
+                      help="run benchmark packing the phases in bundles of this many (1 core) phases")
+  parser.add_argument("--chain-length", type=int, default=1,
+                      help="run benchmark submitting up to this many phases of a window as a chain")
+  parser.add_argument("--samples-per-frame", type=int, default=1,
+                      help="number of datafile lines per frame of the (fake) trajectories")
+  parser.add_argument("--nearest-restart", action="store_true",
+                      help="start new windows from the nearest sampled frame")
+  parser.add_argument("--walkers", type=int, default=1,
+                      help="run benchmark with this many walkers per window")
+  parser.add_argument("--reus", type=int, default=None,
+                      help="run benchmark with replica exchange blocks of up to this many windows")
+  parser.add_argument("--min-overlap", type=float, default=None,
+                      help="run benchmark reporting neighbor windows whose overlap is below this (System.min_overlap)")
+  parser.add_argument("--adapt-overlap", action="store_true",
+                      help="run benchmark adding windows with adapted spring constants for poor overlaps")
+  parser.add_argument("--systems", type=int, default=1,
+                      help="run benchmark with this many systems supervised by one MultiSiPMF")
+  parser.add_argument("--max-running-jobs", type=int, default=None,
+                      help="limit on the jobs waiting in the queue or running (of all the systems together)")
+  parser.add_argument("--count-queue", action="store_true",
+                      help="count the jobs waiting in the queue or running from the listing of the queue")
+  parser.add_argument("--policy", choices=["fair", "priority"], default="fair",
+                      help="sharing of the job slots between the systems (MultiSiPMF)")
+  parser.add_argument("--qstat-all", action="store_true",
+                      help="poll the status of all the jobs with a single call per cycle")
+  parser.add_argument("--bins-per-step", type=int, default=4,
+                      help="number of bins of the PMF per step between windows along each CV")
+  parser.add_argument("--refine-grid", type=int, default=None,
+                      help="run benchmark calculating the PMF on a grid refined up to this many levels")
+  parser.add_argument("--output-stride", type=int, default=10,
+                      help="number of Langevin steps between two samples")
+  parser.add_argument("--temperature", type=float, default=300.0)
+  parser.add_argument("--max-E1", type=float, default=None)
+  parser.add_argument("--max-E2", type=float, default=None)
+  parser.add_argument("--queue-delay", type=float, default=0.0,
+                      help="time (in seconds) jobs wait in the fake queue")
+  parser.add_argument("--run-delay", type=float, default=0.0,
+                      help="time (in seconds) jobs run in the fake queue")
+  parser.add_argument("--step-delay", type=float, default=0.0,
+                      help="time (in seconds) jobs run in the fake queue per MD step")
+  parser.add_argument("--target-walltime", type=float, default=None,
+                      help="run benchmark sizing the phases to run for this long (in seconds) from the measured throughput")
+  parser.add_argument("--sleep-length", type=float, default=0.0)
+  parser.add_argument("--compress-data", choices=["gz", "zst"], default=None,
+                      help="compress the datafiles of the finished phases in a background process")
+  parser.add_argument("--min-sleep-length", type=float, default=None,
+                      help="sleep until the predicted completion of the jobs, at least this long (and at most --sleep-length)")
+  parser.add_argument("--max-time", type=float, default=3600.0)
+  parser.add_argument("--max-jobs", type=int, default=100000)
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--wham", default=None,
+                      help="WHAM executable (default: fake_wham.py)")
+  parser.add_argument("--max-error", type=float, default=None,
+                      help="fail if the rmse of the PMF (kcal/mol) exceeds this")
+  parser.add_argument("--max-window-samples", type=int, default=None,
+                      help="run: fail if a window collected more samples than this")
+  parser.add_argument("--json", default=None,
+                      help="append the results to this file (one JSON record per line)")
+  parser.add_argument("--keep", action="store_true",
+                      help="keep the directory of the benchmark")
+  args = parser.parse_args()
+  if args.potential == "cosine":
+    potential = PeriodicCosine(args.dimensionality)
+  else:
+    potential = POTENTIALS[args.potential]()
+  basedir = tempfile.mkdtemp(prefix="sipmf_bench_")
+  try:
+    if args.benchmark == "run":
+      results = RunBenchmark(basedir, potential, args)
+    else:
+      results = MicroBenchmarks(basedir, potential, args)
+  finally:
+    if args.keep:
+      print("Benchmark directory: {0}".format(basedir))
+    else:
+      shutil.rmtree(basedir)
+  _Print(results)
+  if args.json:
+    f = open(args.json, "a")
+    for r in results:
+      f.write(json.dumps(r, sort_keys=True) + "\n")
+    f.close()
+  if args.max_error is not None:
+    errors = [r["pmf_error"]["rmse"]
+              for r in results if "pmf_error" in r]
+    if any([not (e <= args.max_error) for e in errors]):
+      print("The error of the PMF exceeds {0} kcal/mol".format(args.max_error))
+      sys.exit(1)
+  if args.max_window_samples is not None:
+    if any([r["max_window_samples"] > args.max_window_samples for r in results if "max_window_samples" in r]):
+      print("A window collected more than {0} samples".format(args.max_window_samples))
+      sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
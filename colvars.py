@@ -0,0 +1,482 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+This module contains the :class:`ColvarFormat` class, which describes the layout of the datafiles written
+by the MD engine (e.g. NAMD *colvars.traj* or CHARMM output), and the functions reading such files
+in chunks into NumPy arrays. Datafiles compressed with gzip (*.gz*) or zstd (*.zst*, this requires the
+*zstandard* module) are decompressed as a stream while they are read. It also contains the
+:class:`CompressionWorker`, which compresses the datafiles of finished phases in a background process.
+"""
+import os
+import errno
+import shutil
+import gzip
+import zlib
+import warnings
+import logging
+import multiprocessing
+import numpy as npy
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+__all__ = ('ColvarFormat', 'ReadTable', 'CountRows', 'WriteTable', 'FindDataFile', 'CompressFile',
+           'CompressionWorker')
+
+# Format of the values written to the datafiles of the windows and of demultiplexed phases
+FLOAT_FORMAT = "%.12g"
+# Characters of the lines of numbers written by MD engines, used to count them without parsing them
+_NUMBER_CHARS = "0123456789.eE+- \t\r\n"
+# Extensions of the compressed datafiles, in the order in which they are looked for
+COMPRESSED_EXTENSIONS = (".gz", ".zst")
+
+
+def _HasColumns(lines, text, n_columns):
+  """
+  Whether each of the *lines* (whose concatenation is *text*) has *n_columns* whitespace separated tokens.
+  The tokens are counted on the bytes of the whole chunk at once.
+  """
+  b = npy.frombuffer(text, dtype=npy.uint8)
+  # Whitespace and control characters separate the tokens, which start after one of them
+  space = b <= ord(" ")
+  starts = npy.flatnonzero(space[:-1] & ~space[1:]) + 1
+  ends = npy.flatnonzero(b == ord("\n"))
+  if not text.endswith("\n"):
+    ends = npy.append(ends, len(b))
+  if len(ends) != len(lines):
+    # Other line breaks (e.g. a lone carriage return) split the lines differently
+    return False
+  counts = npy.diff(npy.concatenate([[0], npy.searchsorted(starts, ends)]))
+  if not space[0]:
+    counts[0] += 1
+  return bool((counts == n_columns).all())
+
+
+def _ParseLines(lines, min_columns, n_columns=None, truncate=False, text=None):
+  """
+  Parse data lines into a 2D array. Chunks in which all lines have the same number of columns are parsed at once,
+  other chunks (e.g. with header lines without comment character or truncated lines) line by line,
+  skipping the lines that cannot be parsed or that have less than *min_columns* columns. With *truncate*,
+  only the first *min_columns* columns are kept, otherwise lines with a different number of columns than
+  *n_columns* (by default the first line that can be parsed) are skipped. *text* is the concatenation of the lines,
+  if it is already known.
+  """
+  n_first = len(lines[0].split())
+  if text is None:
+    text = "".join(lines)
+  if n_first >= min_columns and (n_columns is None or n_first == n_columns) and _HasColumns(lines, text, n_first):
+    with warnings.catch_warnings():
+      # Parsing stops at the first token that is not a number, which is detected from the size
+      warnings.simplefilter("ignore")
+      values = npy.fromstring(text, sep=" ")
+    if values.size == n_first * len(lines):
+      values = values.reshape([len(lines), n_first])
+      return values[:, :min_columns] if truncate else values
+  width = min_columns if truncate else n_columns
+  rows = []
+  for line in lines:
+    s = line.split()
+    if len(s) < min_columns:
+      continue
+    try:
+      row = [float(x) for x in (s[:min_columns] if truncate else s)]
+    except ValueError:
+      continue
+    if width is None:
+      width = len(row)
+    elif len(row) != width:
+      continue
+    rows.append(row)
+  return npy.array(rows, dtype=float).reshape([-1, width or min_columns])
+
+
+def _CheckZstd():
+  if zstandard is None:
+    logging.error("The zstandard module is needed for zstd compressed datafiles")
+    raise IOError("The zstandard module is needed for zstd compressed datafiles")
+
+
+def FindDataFile(path):
+  """
+  Path of the datafile *path*, or if it does not exist, of its compressed version (*path.gz* or *path.zst*).
+  Returns *None* if none of them exists.
+
+  :param path: Path to the uncompressed datafile
+  :type path: :class:`str`
+  """
+  for p in [path] + [path + ext for ext in COMPRESSED_EXTENSIONS]:
+    if os.path.isfile(p):
+      return p
+  return None
+
+
+def _OpenDataFile(path):
+  """
+  Open a datafile (see :func:`FindDataFile`). If it was removed since its path was resolved, because it was
+  compressed in the meantime (see :class:`CompressionWorker`), its path is resolved again.
+  Returns the open file and its path.
+  """
+  try:
+    return open(path, "rb"), path
+  except IOError as e:
+    if e.errno != errno.ENOENT:
+      raise
+    base, ext = os.path.splitext(path)
+    found = FindDataFile(base if ext in COMPRESSED_EXTENSIONS else path)
+    if found is None or found == path:
+      raise
+    return open(found, "rb"), found
+
+
+def _ReadBlocks(path, chunk_size):
+  """
+  Yields the content of a file in blocks of about *chunk_size* bytes, decompressing gzip (*.gz*) and
+  zstd (*.zst*) files as a stream, so that the decompressed file is never held in memory or written to disk.
+  """
+  f, path = _OpenDataFile(path)
+  ext = os.path.splitext(path)[1]
+  try:
+    if ext == ".zst":
+      _CheckZstd()
+    if ext == ".gz":
+      # Concatenated gzip files (several members) are read one after the other
+      d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+      while True:
+        raw = f.read(chunk_size)
+        if not raw:
+          break
+        while raw:
+          text = d.decompress(raw, chunk_size)
+          if text:
+            yield text
+          if d.unconsumed_tail:
+            raw = d.unconsumed_tail
+          elif d.unused_data:
+            raw = d.unused_data
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+          else:
+            raw = ""
+      text = d.flush()
+      if text:
+        yield text
+    elif ext == ".zst":
+      for text in zstandard.ZstdDecompressor().read_to_iter(f, read_size=chunk_size, write_size=chunk_size):
+        yield text
+    else:
+      while True:
+        text = f.read(chunk_size)
+        if not text:
+          break
+        yield text
+  finally:
+    f.close()
+
+
+def _ReadChunks(path, comments, chunk_size):
+  """
+  Yields the data lines of a file (possibly compressed, see :func:`_ReadBlocks`) in chunks of about
+  *chunk_size* bytes, with their concatenation (*None* if it is not known), skipping comment lines.
+  """
+  rest = ""
+  for block in _ReadBlocks(path, chunk_size):
+    end = block.rfind("\n") + 1
+    if end == 0:
+      rest += block
+      continue
+    text = rest + block[:end]
+    rest = block[end:]
+    chunk = _FilterComments(text, comments)
+    if chunk:
+      yield chunk
+  if rest:
+    chunk = _FilterComments(rest, comments)
+    if chunk:
+      yield chunk
+
+
+def _FilterComments(text, comments):
+  lines = text.splitlines(True)
+  if any([c in text for c in comments]):
+    lines = [l for l in lines if l.lstrip()[:1] not in comments]
+    text = None
+  if lines:
+    return lines, text
+  return None
+
+
+def ReadTable(path, columns=None, comments="#*", chunk_size=1 << 20, max_rows=-1):
+  """
+  Read a whitespace separated table of numbers in chunks of about *chunk_size* bytes, so that the memory used does
+  not depend on the size of the file. Lines starting with one of the *comments* characters and empty lines are
+  skipped, as well as lines that cannot be parsed (e.g. header lines repeated when a simulation was restarted).
+  Yields one 2D array per chunk, with one row per data line. Files ending with *.gz* or *.zst* are
+  decompressed as a stream.
+
+  :param path: Path to the file
+  :param columns: Indices of the columns to return (non-negative). By default all the columns are returned and
+   lines with a different number of columns than the first data line are skipped.
+  :param comments: Characters starting comment lines
+  :param chunk_size: Approximate size (in bytes) of the chunks read at once
+  :param max_rows: Maximal number of data lines to read, -1 to read the whole file
+  :type path: :class:`str`
+  :type columns: :class:`list` (:class:`int`)
+  :type comments: :class:`str`
+  :type chunk_size: :class:`int`
+  :type max_rows: :class:`int`
+  """
+  min_columns = max(columns) + 1 if columns else 1
+  n_columns = None
+  n_rows = 0
+  for lines, text in _ReadChunks(path, comments, chunk_size):
+    if max_rows >= 0 and n_rows >= max_rows:
+      break
+    table = _ParseLines(lines, min_columns, n_columns, columns is not None, text)
+    if len(table) == 0:
+      continue
+    if columns is None:
+      n_columns = table.shape[1]
+    else:
+      table = table[:, columns]
+    if max_rows >= 0 and n_rows + len(table) > max_rows:
+      table = table[:max_rows - n_rows]
+    n_rows += len(table)
+    yield table
+
+
+def CountRows(path, columns, comments="#*", chunk_size=1 << 20):
+  """
+  Number of data lines of a file that :func:`ReadTable` would return for the given *columns*. Chunks whose lines
+  only contain plain numbers and all have the same number of columns are counted without parsing the numbers.
+  """
+  min_columns = max(columns) + 1
+  n_rows = 0
+  for lines, text in _ReadChunks(path, comments, chunk_size):
+    if text is None:
+      text = "".join(lines)
+    n_first = len(lines[0].split())
+    if n_first >= min_columns and not text.translate(None, _NUMBER_CHARS) and _HasColumns(lines, text, n_first):
+      n_rows += len(lines)
+    else:
+      n_rows += len(_ParseLines(lines, min_columns, truncate=True, text=text))
+  return n_rows
+
+
+def WriteTable(f, table):
+  """
+  Append the rows of a 2D array to an open file.
+  """
+  if len(table):
+    npy.savetxt(f, table, fmt=FLOAT_FORMAT)
+
+
+class ColvarFormat():
+  """
+  Layout of the datafiles of the phases: the column containing the time (or step) and the columns containing the
+  values of the CVs, by default the first column and the *dimensionality* following ones. Lines starting with one of
+  the *comments* characters (e.g. the headers of NAMD *colvars.traj*, repeated at each restart, or the title of
+  CHARMM output) are skipped, as are other lines that are not numbers. Files are parsed in chunks of *chunk_size* bytes
+  (see :func:`ReadTable`).
+
+  The datafiles of the windows are always written with the time in the first column followed by the CVs.
+  """
+
+  def __repr__(self):
+    return "ColvarFormat({0},{1},{2},{3})".format(self.cv_columns, self.time_column, repr(self.comments),
+                                                  self.chunk_size)
+
+  def __init__(self, cv_columns=None, time_column=0, comments="#*", chunk_size=1 << 20):
+    """
+    :param cv_columns: Index of the column of each CV (starting from 0), by default 1 to *dimensionality*.
+    :param time_column: Index of the column containing the time.
+    :param comments: Characters starting comment lines.
+    :param chunk_size: Approximate size (in bytes) of the chunks read at once.
+    :type cv_columns: :class:`list` (:class:`int`)
+    :type time_column: :class:`int`
+    :type comments: :class:`str`
+    :type chunk_size: :class:`int`
+    """
+    self.cv_columns = cv_columns
+    self.time_column = time_column
+    self.comments = comments
+    self.chunk_size = chunk_size
+
+  def GetColumns(self, dimensionality):
+    """
+    Indices of the time column followed by the columns of the CVs.
+    """
+    if self.cv_columns is None:
+      return [self.time_column] + range(1, dimensionality + 1)
+    if len(self.cv_columns) != dimensionality:
+      logging.error("The datafile format has {0} CV columns for {1} CVs".format(len(self.cv_columns), dimensionality))
+      raise ValueError("The datafile format has {0} CV columns for {1} CVs".format(len(self.cv_columns), dimensionality))
+    return [self.time_column] + list(self.cv_columns)
+
+  def ReadChunks(self, path, dimensionality, max_rows=-1):
+    """
+    Read a datafile in chunks. Yields 2D arrays with the time in the first column followed by the CVs.
+
+    :param path: Path to the datafile
+    :param dimensionality: Number of CVs
+    :param max_rows: Maximal number of data lines to read, -1 to read the whole file
+    :type path: :class:`str`
+    :type dimensionality: :class:`int`
+    :type max_rows: :class:`int`
+    """
+    return ReadTable(path, self.GetColumns(dimensionality), self.comments, self.chunk_size, max_rows)
+
+  def Read(self, path, dimensionality, max_rows=-1):
+    """
+    Read a datafile and return a tuple with the array of times and an array containing one row of values for each CV.
+
+    :param path: Path to the datafile
+    :param dimensionality: Number of CVs
+    :param max_rows: Maximal number of data lines to read, -1 to read the whole file
+    :type path: :class:`str`
+    :type dimensionality: :class:`int`
+    :type max_rows: :class:`int`
+    """
+    chunks = list(self.ReadChunks(path, dimensionality, max_rows))
+    if chunks:
+      data = npy.concatenate(chunks)
+    else:
+      data = npy.zeros([0, dimensionality + 1])
+    return data[:, 0], data[:, 1:].transpose()
+
+  def Count(self, path, dimensionality):
+    """
+    Number of data lines of a datafile.
+    """
+    return CountRows(path, self.GetColumns(dimensionality), self.comments, self.chunk_size)
+
+
+def CompressFile(path, codec="gz", level=None, chunk_size=1 << 20):
+  """
+  Compress a file as a stream to *path.gz* or *path.zst* and remove the uncompressed file. The compressed file
+  is written under a temporary name and renamed when it is complete, before the uncompressed file is removed,
+  so that one of them always exists (see :func:`FindDataFile`). A datafile removed between the resolution of its
+  path and its opening is found again by the readers. Returns the path to the compressed file.
+
+  :param path: Path to the file
+  :param codec: Either *gz* or *zst*
+  :param level: Compression level, by default 6 for gzip and 3 for zstd
+  :param chunk_size: Size (in bytes) of the blocks read at once
+  :type path: :class:`str`
+  :type codec: :class:`str`
+  :type level: :class:`int`
+  :type chunk_size: :class:`int`
+  """
+  if codec not in ["gz", "zst"]:
+    logging.error("Unknown compression {0}, use gz or zst".format(codec))
+    raise ValueError("Unknown compression {0}, use gz or zst".format(codec))
+  path_out = path + "." + codec
+  path_tmp = path_out + ".tmp"
+  f_in = open(path, "rb")
+  f_out = open(path_tmp, "wb")
+  try:
+    if codec == "gz":
+      gz = gzip.GzipFile(os.path.basename(path), "wb", 6 if level is None else level, f_out)
+      shutil.copyfileobj(f_in, gz, chunk_size)
+      gz.close()
+    else:
+      _CheckZstd()
+      cctx = zstandard.ZstdCompressor(level=3 if level is None else level)
+      cctx.copy_stream(f_in, f_out, read_size=chunk_size, write_size=chunk_size)
+  except:
+    f_out.close()
+    os.remove(path_tmp)
+    raise
+  finally:
+    f_in.close()
+  f_out.close()
+  os.rename(path_tmp, path_out)
+  os.remove(path)
+  return path_out
+
+
+def _CompressionWorkerLoop(queue, codec, level):
+  """
+  Main loop of the compression process. Files are compressed in the order in which they were submitted,
+  a *None* request stops the loop once all the previous files are compressed.
+  """
+  while True:
+    path = queue.get()
+    if path is None:
+      break
+    try:
+      CompressFile(path, codec, level)
+    except Exception as e:
+      logging.error("Could not compress {0}: {1}".format(path, e))
+
+
+class CompressionWorker():
+  """
+  This class represents a background process compressing the datafiles of the finished phases (see
+  :func:`CompressFile`), so that they take less space without the supervisor waiting on the compression.
+  The worker is attached to a :class:`~system.System` as *system.compression_worker*, in which case
+  *System.UpdateDataFiles* submits the datafiles of the phases whose data was added to their window.
+  The datafiles are read from their compressed version afterwards (see :func:`FindDataFile`).
+  """
+
+  def __repr__(self):
+    return "CompressionWorker({0},{1})".format(repr(self.codec), self.level)
+
+  def __init__(self, codec="gz", level=None):
+    """
+    :param codec: Either *gz* (gzip) or *zst* (zstd, this requires the *zstandard* module)
+    :param level: Compression level, by default 6 for gzip and 3 for zstd
+    :type codec: :class:`str`
+    :type level: :class:`int`
+    """
+    if codec not in ["gz", "zst"]:
+      logging.error("Unknown compression {0}, use gz or zst".format(codec))
+      raise ValueError("Unknown compression {0}, use gz or zst".format(codec))
+    if codec == "zst":
+      _CheckZstd()
+    self.codec = codec
+    self.level = level
+    self.queue = None
+    self.process = None
+    self.submitted = set()
+
+  def Start(self):
+    """
+    Start the compression process.
+    """
+    self.queue = multiprocessing.Queue()
+    self.process = multiprocessing.Process(
+        target=_CompressionWorkerLoop, args=(self.queue, self.codec, self.level))
+    self.process.daemon = True
+    self.process.start()
+
+  def IsRunning(self):
+    return self.process is not None and self.process.is_alive()
+
+  def Submit(self, path):
+    """
+    Request the compression of a file. This returns immediately. Files that were already submitted are ignored.
+
+    :param path: Path to the file
+    :type path: :class:`str`
+    """
+    if path in self.submitted:
+      return
+    self.submitted.add(path)
+    self.queue.put(path)
+
+  def Stop(self, timeout=None):
+    """
+    Compress the pending files and stop the compression process.
+
+    :param timeout: Maximal time (in seconds) to wait for the process to finish.
+    :type timeout: :class:`float`
+    """
+    if self.process is None:
+      return
+    self.queue.put(None)
+    self.process.join(timeout)
+    if self.process.is_alive():
+      logging.error("Compression process did not finish in time, terminating it.")
+      self.process.terminate()
+    self.process = None
+    self.queue = None
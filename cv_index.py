@@ -0,0 +1,228 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+This module contains the :class:`CVFrameIndex` class, a spatial index mapping every sample of the
+CVs in the datafiles of the phases to its location (phase and trajectory frame), as well as a function
+to load such an index from a file.
+"""
+import pickle
+import itertools
+import numpy as npy
+
+__all__ = ('CVFrameIndex', 'LoadCVFrameIndex')
+
+
+def LoadCVFrameIndex(filename):
+  """
+  Loads a :class:`CVFrameIndex` from a file (using pickle)
+
+  :param filename: The path to the file.
+  :type filename:  :class:`str`
+  """
+  f = open(filename, "rb")
+  index = pickle.load(f)
+  f.close()
+  return index
+
+
+class CVFrameIndex():
+  """
+  Grid-bucket index of the samples of the CVs. The CV space is divided into buckets of size *bucket_sizes*
+  and every sample is stored in its bucket together with the phase it comes from and the corresponding frame
+  in the trajectory of that phase. Phases are added incrementally (*AddPhase*) and the index can be queried
+  for the samples closest to any point in the CV space (*FindNearest*).
+  Distances are measured in units of the bucket size of each CV, taking periodicity into account.
+  Sample *i* of a datafile is mapped to frame *(i-frame_offset)/samples_per_frame* of the trajectory, and samples
+  that do not correspond to a frame are not indexed.
+  """
+
+  def __repr__(self):
+    return "CVFrameIndex({0},{1},{2},{3})".format(self.cv_list, self.bucket_sizes, self.samples_per_frame, self.frame_offset)
+
+  def __init__(self, cv_list, bucket_sizes=None, samples_per_frame=1, frame_offset=0):
+    """
+    :param cv_list: List of the CVs
+    :param bucket_sizes: Size of the buckets for each CV. By default the *step_size* of the CVs.
+    :param samples_per_frame: Number of lines in the datafiles for each frame in the trajectories.
+    :param frame_offset: Index of the sample corresponding to the first frame of the trajectories.
+    :type cv_list: :class:`list` (:class:`~colvar.CollectiveVariable`)
+    :type bucket_sizes: :class:`list` (:class:`float`)
+    :type samples_per_frame: :class:`int`
+    :type frame_offset: :class:`int`
+    """
+    self.cv_list = cv_list
+    self.dimensionality = len(cv_list)
+    if not bucket_sizes:
+      bucket_sizes = [cv.step_size for cv in cv_list]
+    self.n_periodic_buckets = []
+    sizes = []
+    for cv, b in zip(cv_list, bucket_sizes):
+      if cv.periodicity:
+        # Adjust the bucket size so that the buckets exactly tile one period
+        n = max(int(round(cv.periodicity / float(b))), 1)
+        self.n_periodic_buckets.append(n)
+        sizes.append(cv.periodicity / float(n))
+      else:
+        self.n_periodic_buckets.append(0)
+        sizes.append(float(b))
+    self.bucket_sizes = npy.array(sizes)
+    self.periods = npy.array(
+        [cv.periodicity if cv.periodicity else 0.0 for cv in cv_list], dtype=float)
+    self.samples_per_frame = samples_per_frame
+    self.frame_offset = frame_offset
+    self.phase_keys = []
+    self.phase_ids = {}
+    self.buckets = {}
+    self.n_samples = 0
+
+  def _Buckets(self, cv_values):
+    b = npy.floor(cv_values / self.bucket_sizes).astype(int)
+    for i, n in enumerate(self.n_periodic_buckets):
+      if n:
+        b[:, i] = b[:, i] % n
+    return b
+
+  def HasPhase(self, phase_key):
+    return phase_key in self.phase_ids
+
+  def AddPhase(self, phase_key, cv_values):
+    """
+    Add the samples of one phase to the index.
+
+    :param phase_key: Key identifying the phase, typically *(window name, phase name)*
+    :param cv_values: The values of the CVs, one row per line of the datafile of the phase.
+    :type phase_key: :class:`tuple`
+    :type cv_values: :class:`numpy.array`
+    """
+    if phase_key in self.phase_ids:
+      raise ValueError("Phase {0} is already in the index".format(phase_key))
+    cv_values = npy.array(cv_values, dtype=float).reshape(
+        [-1, self.dimensionality])
+    samples = npy.arange(self.frame_offset, len(cv_values), self.samples_per_frame)
+    cv_values = cv_values[samples]
+    frames = (samples - self.frame_offset) // self.samples_per_frame
+    phase_id = len(self.phase_keys)
+    self.phase_keys.append(phase_key)
+    self.phase_ids[phase_key] = phase_id
+    if len(cv_values) == 0:
+      return
+    buckets = self._Buckets(cv_values)
+    order = npy.lexsort(buckets.T[::-1])
+    buckets = buckets[order]
+    cv_values = cv_values[order]
+    frames = frames[order]
+    change = npy.nonzero(npy.any(buckets[1:] != buckets[:-1], axis=1))[0] + 1
+    starts = npy.concatenate([[0], change])
+    ends = npy.concatenate([change, [len(buckets)]])
+    for start, end in zip(starts, ends):
+      key = tuple(buckets[start])
+      chunk = (npy.repeat(phase_id, end - start), frames[start:end], cv_values[start:end])
+      if key not in self.buckets:
+        self.buckets[key] = [chunk]
+      else:
+        self.buckets[key].append(chunk)
+    self.n_samples += len(cv_values)
+
+  def _BucketContent(self, key):
+    chunks = self.buckets[key]
+    if len(chunks) > 1:
+      # Consolidate the chunks added by successive phases
+      chunks[:] = [(npy.concatenate([c[0] for c in chunks]), npy.concatenate([c[1] for c in chunks]),
+                    npy.concatenate([c[2] for c in chunks]))]
+    return chunks[0]
+
+  def _Shell(self, center, r):
+    """
+    Buckets at Chebyshev distance exactly *r* from the *center* bucket.
+    """
+    ranges = [range(-r, r + 1) for i in range(self.dimensionality)]
+    seen = set()
+    for delta in itertools.product(*ranges):
+      if max([abs(el) for el in delta]) != r:
+        continue
+      key = []
+      for c, d, n in zip(center, delta, self.n_periodic_buckets):
+        key.append((c + d) % n if n else c + d)
+      key = tuple(key)
+      if key not in seen:
+        seen.add(key)
+        yield key
+
+  def Distances(self, cv_values, point):
+    """
+    Distances (in units of the bucket sizes) between an array of CV values and a point, taking periodicity into account.
+    """
+    d = npy.abs(npy.array(cv_values, dtype=float) - npy.array(point, dtype=float))
+    periodic = self.periods > 0
+    if npy.any(periodic):
+      dp = d[:, periodic] % self.periods[periodic]
+      d[:, periodic] = npy.minimum(dp, self.periods[periodic] - dp)
+    return npy.sqrt(npy.sum((d / self.bucket_sizes)**2, axis=1))
+
+  def FindNearest(self, point, n=1, max_distance=None, exclude_phases=None):
+    """
+    Find the *n* samples closest to a point in the CV space.
+
+    :param point: Values of the CVs
+    :param n: Number of samples to return
+    :param max_distance: Only return samples closer than this distance (in units of the bucket sizes).
+    :param exclude_phases: Keys of phases whose samples should be ignored.
+    :type point: :class:`list` (:class:`float`)
+    :type n: :class:`int`
+    :type max_distance: :class:`float`
+    :type exclude_phases: :class:`list` (:class:`tuple`)
+
+    :returns: A list of tuples *(distance, phase_key, frame, cv_values)*, sorted by distance.
+    """
+    if not self.buckets:
+      return []
+    point = npy.array(point, dtype=float)
+    center = tuple(self._Buckets(point.reshape([1, -1]))[0])
+    excluded = set([self.phase_ids[k] for k in (exclude_phases or []) if k in self.phase_ids])
+    all_keys = npy.array(list(self.buckets.keys()))
+    max_r = int(npy.max(npy.abs(all_keys - npy.array(center)))) + 1
+    ids, frames, cvs = [], [], []
+    r = 0
+    while r <= max_r:
+      for key in self._Shell(center, r):
+        if key in self.buckets:
+          c = self._BucketContent(key)
+          ids.append(c[0])
+          frames.append(c[1])
+          cvs.append(c[2])
+      # Samples in buckets further than r are at least at a distance r from the point
+      if ids:
+        d = self.Distances(npy.concatenate(cvs), point)
+        if excluded:
+          d[npy.in1d(npy.concatenate(ids), list(excluded))] = npy.inf
+        if npy.sum(d <= r) >= n:
+          break
+        if max_distance is not None and r >= max_distance:
+          break
+      r += 1
+    if not ids:
+      return []
+    ids = npy.concatenate(ids)
+    frames = npy.concatenate(frames)
+    cvs = npy.concatenate(cvs)
+    d = self.Distances(cvs, point)
+    if excluded:
+      d[npy.in1d(ids, list(excluded))] = npy.inf
+    order = npy.argsort(d, kind="mergesort")[:n]
+    res = []
+    for i in order:
+      if not npy.isfinite(d[i]) or (max_distance is not None and d[i] > max_distance):
+        break
+      res.append((float(d[i]), self.phase_keys[ids[i]], int(frames[i]), cvs[i]))
+    return res
+
+  def Save(self, filename):
+    """
+    Save the index to a file using *pickle*.
+
+    :param filename: Path to the file
+    :type filename: :class:`str`
+    """
+    f = open(filename, "wb")
+    pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+    f.close()
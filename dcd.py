@@ -0,0 +1,171 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+This module contains the :class:`DCDIndex` class, used to read single frames or subsets of frames
+from a DCD trajectory (CHARMM and NAMD format) without loading the whole file.
+"""
+import os
+import struct
+import numpy as npy
+
+__all__ = ('DCDIndex',)
+
+
+class DCDIndex():
+  """
+  Frame-offset index of a DCD trajectory. The header of the file is parsed once, which gives the number
+  of atoms and whether frames contain a unit cell or a fourth dimension. As all frames have the same size,
+  the offset of any frame is then known and frames can be read by seeking directly to them.
+  The number of frames is determined from the size of the file, so that it is correct for trajectories
+  that are still being written (an incomplete last frame is ignored).
+  Trajectories with fixed atoms are not supported.
+  """
+
+  def __repr__(self):
+    return "DCDIndex({0})".format(self.path)
+
+  def __init__(self, path):
+    """
+    :param path: Path to the DCD file
+    :type path: :class:`str`
+    """
+    self.path = path
+    f = open(path, "rb")
+    try:
+      self._ReadHeader(f)
+    finally:
+      f.close()
+
+  def _ReadRecord(self, f):
+    n = struct.unpack(self.endian + "i", f.read(4))[0]
+    data = f.read(n)
+    if len(data) != n or struct.unpack(self.endian + "i", f.read(4))[0] != n:
+      raise IOError("Corrupted record in DCD file {0}".format(self.path))
+    return data
+
+  def _ReadHeader(self, f):
+    first = f.read(8)
+    if len(first) < 8:
+      raise IOError("{0} is not a DCD file".format(self.path))
+    if struct.unpack("<i", first[:4])[0] == 84 and first[4:8] == b"CORD":
+      self.endian = "<"
+    elif struct.unpack(">i", first[:4])[0] == 84 and first[4:8] == b"CORD":
+      self.endian = ">"
+    else:
+      raise IOError(
+          "{0} is not a DCD file with 32 bit record markers".format(self.path))
+    f.seek(0)
+    header = self._ReadRecord(f)
+    icntrl = struct.unpack(self.endian + "20i", header[4:84])
+    self.header_n_frames = icntrl[0]
+    self.first_step = icntrl[1]
+    self.step_stride = icntrl[2]
+    n_fixed = icntrl[8]
+    is_charmm = icntrl[19] != 0
+    self.has_unit_cell = is_charmm and icntrl[10] != 0
+    self.has_4d = is_charmm and icntrl[11] != 0
+    if n_fixed != 0:
+      raise IOError(
+          "DCD files with fixed atoms are not supported ({0})".format(self.path))
+    self._ReadRecord(f)  # title
+    self.n_atoms = struct.unpack(self.endian + "i", self._ReadRecord(f))[0]
+    self.first_frame_offset = f.tell()
+    coord_record_size = 8 + 4 * self.n_atoms
+    self.frame_size = 3 * coord_record_size
+    if self.has_unit_cell:
+      self.frame_size += 8 + 48
+    if self.has_4d:
+      self.frame_size += coord_record_size
+
+  def GetFrameCount(self):
+    """
+    Number of complete frames currently in the file.
+    """
+    size = os.path.getsize(self.path)
+    return max(size - self.first_frame_offset, 0) // self.frame_size
+
+  def GetFrameOffset(self, frame, n_frames=None):
+    """
+    Offset in bytes of a frame in the file.
+
+    :param frame: Index of the frame. Negative indices count from the end.
+    :param n_frames: Number of frames in the file, by default obtained with *GetFrameCount*
+    :type frame: :class:`int`
+    :type n_frames: :class:`int`
+    """
+    if n_frames is None:
+      n_frames = self.GetFrameCount()
+    if frame < 0:
+      frame += n_frames
+    if frame < 0 or frame >= n_frames:
+      raise IndexError("Frame {0} out of range for {1} ({2} frames)".format(
+          frame, self.path, n_frames))
+    return self.first_frame_offset + frame * self.frame_size
+
+  def _ReadFrameAt(self, f, offset):
+    f.seek(offset)
+    data = f.read(self.frame_size)
+    if len(data) != self.frame_size:
+      raise IOError("Incomplete frame in DCD file {0}".format(self.path))
+    pos = 0
+    if self.has_unit_cell:
+      pos += 8 + 48
+    xyz = npy.empty([self.n_atoms, 3], dtype=npy.float32)
+    dtype = npy.dtype(self.endian + "f4")
+    for i in range(3):
+      xyz[:, i] = npy.frombuffer(
+          data, dtype=dtype, count=self.n_atoms, offset=pos + 4)
+      pos += 8 + 4 * self.n_atoms
+    return xyz
+
+  def ReadFrame(self, frame):
+    """
+    Read the positions of the atoms for one frame.
+
+    :param frame: Index of the frame. Negative indices count from the end.
+    :type frame: :class:`int`
+    :returns: An array of shape *(n_atoms,3)*
+    """
+    f = open(self.path, "rb")
+    try:
+      return self._ReadFrameAt(f, self.GetFrameOffset(frame))
+    finally:
+      f.close()
+
+  def ReadFrames(self, frames):
+    """
+    Read the positions of the atoms for a list of frames, for example a strided subset
+    of the trajectory (*range(first, n_frames, stride)*).
+
+    :param frames: Indices of the frames. Negative indices count from the end.
+    :type frames: :class:`list` (:class:`int`)
+    :returns: An array of shape *(n_frames,n_atoms,3)*
+    """
+    # The size of the file is only queried once, which matters on parallel file systems
+    n_frames = self.GetFrameCount()
+    offsets = [self.GetFrameOffset(frame, n_frames) for frame in frames]
+    xyz = npy.empty([len(offsets), self.n_atoms, 3], dtype=npy.float32)
+    f = open(self.path, "rb")
+    try:
+      for i, offset in enumerate(offsets):
+        xyz[i] = self._ReadFrameAt(f, offset)
+    finally:
+      f.close()
+    return xyz
+
+  def ReadUnitCell(self, frame):
+    """
+    Read the unit cell of a frame as stored in the file (6 values, *A, gamma, B, beta, alpha, C*
+    in the CHARMM convention). Returns *None* if the trajectory does not contain unit cells.
+
+    :param frame: Index of the frame. Negative indices count from the end.
+    :type frame: :class:`int`
+    """
+    if not self.has_unit_cell:
+      return None
+    f = open(self.path, "rb")
+    try:
+      f.seek(self.GetFrameOffset(frame) + 4)
+      return npy.array(struct.unpack(self.endian + "6d", f.read(48)))
+    finally:
+      f.close()
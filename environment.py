@@ -3,7 +3,7 @@
 
 This file contains the :class:`Environment` object which represents the computational environment.
 """
-import os,subprocess
+import os,subprocess,logging
 
 class Environment():
   """
@@ -11,7 +11,7 @@ class Environment():
   It defines the functions used to communicate with the queuing system and the path to
   the WHAM executable.
   """
-  def __init__(self,qsub_command,jid_pos,qstat_command,jid_flag,wham_executable):
+  def __init__(self,qsub_command,jid_pos,qstat_command,jid_flag,wham_executable,restart_extractor=None,running_string=None,dependency_option=None,qdel_command=None,qstat_all_command=None):
     """
     :param qsub_command: Command used to submit a job to the queuing system. On SGE this should be "qsub"
     :param jid_pos: Position of the job ID in the string returned by the *qsub_command*
@@ -19,30 +19,119 @@ class Environment():
     :param jid_flag: Flag that should be added to the *qstat_command* to check the status of a job with 
      a specific job ID. On SGE this should be "-j"
     :param wham_executable: Path to the wham executable (either the 1D wham or 2D wham, depending on the number of CVs in the system)
+    :param restart_extractor: Function writing the files needed to restart a simulation from any frame of a phase.
+     It is called as *restart_extractor(phase,frame,restartdir)* and should write the restart files (e.g. coordinates,
+     velocities and unit cell) corresponding to frame *frame* of the trajectory of *phase* in the directory *restartdir*.
+     It is needed to start new windows from the closest sampled frame (see *System.restart_from_nearest_sample*).
+    :param running_string: If this string is found in the output of the *qstat_command*, the job is considered
+     to be running rather than waiting in the queue. This is only used to measure the queue wait and run times of the jobs.
+    :param dependency_option: Option added to the *qsub_command* to submit a job that can only start once another job
+     has finished successfully, with {JID} replaced by the job ID of that job. On SGE this should be "-hold_jid {JID}"
+     and on SLURM "--dependency=afterok:{JID}". It is needed to submit chains of phases (see *System.chain_length*).
+    :param qdel_command: Command used to cancel a job, followed by the job ID. On SGE this should be "qdel".
+    :param qstat_all_command: Command listing all the jobs in the queue, one line per job starting with its job ID.
+     On SGE this can be "qstat" and on SLURM "squeue -h -u USER -o %i %T". If it is set, the status of all the jobs
+     is obtained with a single call per cycle (see :func:`ListQueue`), and a job is running if *running_string*
+     is found in its line.
     :type qsub_command: :class:`str`
     :type jid_pos: :class:`int`
     :type qstat_command: :class:`str`
     :type jid_flag: :class:`str`
     :type wham_executable: :class:`str`
+    :type restart_extractor: :class:`function`
+    :type running_string: :class:`str`
+    :type dependency_option: :class:`str`
+    :type qdel_command: :class:`str`
+    :type qstat_all_command: :class:`str`
     """
-    self.qsub=self.DefineQsub(qsub_command,jid_pos)
-    self.qstat=self.DefineQstat(qstat_command,jid_flag)
+    self.qsub=self.DefineQsub(qsub_command,jid_pos,dependency_option)
+    self.qstat=self.DefineQstat(qstat_command,jid_flag,running_string)
+    self.qdel=self.DefineQdel(qdel_command)
+    self.qstat_all=self.DefineQstatAll(qstat_all_command,running_string)
     self.wham_executable=wham_executable
+    self.restart_extractor=restart_extractor
   
-  def DefineQsub(self,qsub_command,jid_pos):
-    def qsub(run_directory,path_to_job_file):
+  def DefineQsub(self,qsub_command,jid_pos,dependency_option=None):
+    def qsub(run_directory,path_to_job_file,hold_jid=None):
       #os.chdir(run_directory)
-      out=subprocess.check_output([qsub_command,path_to_job_file],cwd=run_directory)
+      cmd=[qsub_command]
+      if hold_jid is not None:
+        if not dependency_option:
+          raise ValueError("A dependency_option is needed to submit jobs depending on other jobs")
+        cmd.extend(dependency_option.replace("{JID}",str(hold_jid)).split())
+      cmd.append(path_to_job_file)
+      out=subprocess.check_output(cmd,cwd=run_directory)
       jid=out.split()[jid_pos]
       return jid
     return qsub
 
-  def DefineQstat(self,qstat_command,jid_flag):
+  def DefineQstat(self,qstat_command,jid_flag,running_string=None):
     def qstat(jid):
       try:
         out=subprocess.check_output([qstat_command,jid_flag,jid])
       except:
         return "finished"
+      if running_string and running_string in out:
+        return "running"
       return "in queue"
     return qstat
 
+  def DefineQdel(self,qdel_command):
+    if not qdel_command:
+      return None
+    def qdel(jid):
+      return subprocess.call([qdel_command,jid])
+    return qdel
+
+  def DefineQstatAll(self,qstat_all_command,running_string=None):
+    if not qstat_all_command:
+      return None
+    def qstat_all():
+      out=subprocess.check_output(qstat_all_command.split())
+      status={}
+      for line in out.splitlines():
+        s=line.split()
+        if not s:continue
+        if running_string and running_string in line:status[s[0]]="running"
+        else:status[s[0]]="in queue"
+      return status
+    return qstat_all
+
+def ListQueue(environment):
+  """
+  Status of all the jobs in the queue by job ID, from a single call to the *qstat_all* command of the environment.
+  Returns *None* if the environment has no *qstat_all* command or if the command fails.
+
+  :param environment: The environment
+  :type environment: :class:`Environment`
+  """
+  qstat_all=getattr(environment,"qstat_all",None)
+  if not qstat_all:
+    return None
+  try:
+    return qstat_all()
+  except Exception as e:
+    logging.warning("Could not list the jobs in the queue ({0}), checking them one by one".format(e))
+    return None
+
+def GetQueueStatusCache(environment,jobs,queue=None):
+  """
+  Status of the given jobs from the listing of the queue (see :func:`ListQueue`), as a dictionary
+  from job ID to status that can be passed to *System.UpdateUnfinishedJobList*. The jobs that are not listed
+  by the queuing system are finished. Returns an empty dictionary if the queue cannot be listed,
+  in which case the status of each job is checked with *qstat*.
+
+  :param environment: The environment
+  :param jobs: The jobs
+  :param queue: The listing of the queue, if it was already obtained. By default the queue is listed.
+  :type environment: :class:`Environment`
+  :type jobs: :class:`list` (:class:`~job.Job`)
+  :type queue: :class:`dict`
+  """
+  if not jobs:
+    return {}
+  if queue is None:
+    queue=ListQueue(environment)
+  if queue is None:
+    return {}
+  return dict((job.jid,queue.get(job.jid,"finished")) for job in jobs)
@@ -0,0 +1,158 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+This module contains the :class:`FileSystemSnapshot` class, which answers the existence queries of a supervisor
+cycle from one listing of each directory and creates, moves and removes files and directories in process.
+"""
+import os
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+__all__ = ('FileSystemSnapshot',)
+
+
+class FileSystemSnapshot():
+  """
+  Snapshot of the content of the directories queried during a cycle of the supervisor. Each directory is listed
+  once (with *scandir* if it is available, i.e. with Python 3 or the *scandir* module, else with *os.listdir*)
+  and the following queries on its entries are answered from the listing, instead of one *stat* per query,
+  which is slow on parallel file systems such as Lustre or GPFS. With *os.listdir*, whether an entry is a directory
+  is only checked (and remembered) by *IsDir*.
+
+  The directories and files created, moved and removed through the snapshot (*MakeDirs*, *Move*, *Remove*, *AddFile*)
+  are updated in the listings. Changes made by other processes (e.g. the jobs) are only seen once the directory
+  is listed again, i.e. after *Clear* (called at the start of each cycle, see *System.UpdateUnfinishedJobList*)
+  or *Forget*.
+  """
+
+  def __repr__(self):
+    return "FileSystemSnapshot()"
+
+  def __init__(self):
+    # Content of the listed directories: name of each entry and whether it is a directory (None if not known yet)
+    self.listings = {}
+
+  def __getstate__(self):
+    # The listings are out of date once the system is loaded again
+    return {"listings": {}}
+
+  def Clear(self):
+    """
+    Forget all the listings, so that the directories are listed again when they are queried.
+    """
+    self.listings = {}
+
+  def Forget(self, directory):
+    """
+    Forget the listing of one directory, e.g. after a job wrote its output to it.
+    """
+    self.listings.pop(os.path.normpath(directory), None)
+
+  def List(self, directory):
+    """
+    Content of a directory, as a dictionary with the name of each entry as key and whether it is a directory
+    as value (*None* if not known). Returns *None* if the directory does not exist.
+
+    :param directory: Path to the directory
+    :type directory: :class:`str`
+    """
+    directory = os.path.normpath(directory)
+    if directory in self.listings:
+      return self.listings[directory]
+    try:
+      if scandir is not None:
+        listing = dict([(entry.name, entry.is_dir()) for entry in scandir(directory)])
+      else:
+        listing = dict([(name, None) for name in os.listdir(directory)])
+    except OSError:
+      listing = None
+    self.listings[directory] = listing
+    return listing
+
+  def _Entry(self, path):
+    directory, name = os.path.split(os.path.normpath(path))
+    listing = self.List(directory or os.curdir)
+    if listing is None or name not in listing:
+      return None, name
+    return listing, name
+
+  def Exists(self, path):
+    """
+    Whether a file or directory exists.
+    """
+    return self._Entry(path)[0] is not None
+
+  def IsFile(self, path):
+    """
+    Whether a file exists. With *os.listdir*, any entry that is not known to be a directory is taken as a file,
+    so that the query does not need a *stat*.
+    """
+    listing, name = self._Entry(path)
+    return listing is not None and listing[name] is not True
+
+  def IsDir(self, path):
+    """
+    Whether a directory exists.
+    """
+    listing, name = self._Entry(path)
+    if listing is None:
+      return False
+    if listing[name] is None:
+      listing[name] = os.path.isdir(path)
+    return listing[name]
+
+  def _Record(self, path, is_dir):
+    directory, name = os.path.split(os.path.normpath(path))
+    listing = self.listings.get(os.path.normpath(directory or os.curdir))
+    if listing is not None:
+      listing[name] = is_dir
+
+  def _Unrecord(self, path):
+    directory, name = os.path.split(os.path.normpath(path))
+    listing = self.listings.get(os.path.normpath(directory or os.curdir))
+    if listing is not None:
+      listing.pop(name, None)
+    self.Forget(path)
+
+  def AddFile(self, path):
+    """
+    Record a file created by the supervisor (e.g. a datafile of a window), so that it exists in the snapshot.
+    """
+    self._Record(path, False)
+
+  def MakeDirs(self, paths, exist_ok=False):
+    """
+    Create directories, in the given order (parents first). Raises an *OSError* if a directory cannot be created.
+
+    :param paths: Paths to the directories
+    :param exist_ok: Skip the directories that already exist, instead of raising an *OSError*.
+    :type paths: :class:`list` (:class:`str`)
+    :type exist_ok: :class:`bool`
+    """
+    for path in paths:
+      if exist_ok and self.IsDir(path):
+        continue
+      os.mkdir(path)
+      self._Record(path, True)
+
+  def Move(self, src, dst):
+    """
+    Move (rename) a file or directory. Raises an *OSError* if it cannot be moved.
+    """
+    is_dir = self.IsDir(src)
+    os.rename(src, dst)
+    self._Unrecord(src)
+    self._Unrecord(dst)
+    self._Record(dst, is_dir)
+
+  def Remove(self, path):
+    """
+    Remove a file. Raises an *OSError* if it cannot be removed.
+    """
+    os.remove(path)
+    self._Unrecord(path)
@@ -4,6 +4,10 @@
 This file contains the :class:`Job` object which represents a job on a cluster.
 """
 import os
+import time
+import logging
+from metrics import Timer
+from packing import JobPacker
 
 
 class Job():
@@ -24,8 +28,14 @@ class Job():
     self.phase = phase
     self.queue_status = "To submit"
     self.success = None
-    self.GenerateInputFile()
-    self.GenerateJobFile()
+    self.submit_time = None
+    self.start_time = None
+    self.finish_time = None
+    self.bundle = None
+    self.reus_block = None
+    with Timer(self.phase.window.system.metrics, "render"):
+      self.GenerateInputFile()
+      self.GenerateJobFile()
 
   def GenerateJobFile(self):
     """
@@ -74,7 +84,7 @@ class Job():
     This function returns a dictionary containing the fields that will be replaced only in the
     initialization Job submission files.
     """
-    to_replace = {"{PARENT_WINDOW}": self.phase.window.parent.name,
+    to_replace = {"{PARENT_WINDOW}": self.phase.parent_phase.window.name,
                   "{PARENT_PHASE}": self.phase.parent_phase.name}
     return to_replace
 
@@ -94,8 +104,8 @@ class Job():
     for each CV a field containing its name ({cvname}) is replaced by its value and {cvname_K} is replaced 
     by the spring constant. For the initialization we also replace fields for the collective variables
     from the parent phase {PARENT_cvname} by the value.
-    Finally in the initialization input, {INIT_NSTEP} will be replaced by its value (system.init_nstep)
-    and for a run phase {RUN_NSTEP} is replaced by system.run_nstep.
+    Finally in the initialization input, {INIT_NSTEP} and in the run input, {RUN_NSTEP} are replaced by the
+    number of steps of the phase (see *System.GetPhaseNstep*).
     """
     to_replace = self.GetInputReplacementDict()
     if self.phase.type == "initialization":
@@ -137,10 +147,19 @@ class Job():
   def GetInitInputReplacementDict(self):
     """
     This function returns a dictionary containing the fields that will be replaced only in the
-    initialization MD input files.
+    initialization MD input files. The parent fields refer to the window of the parent phase, except
+    when the phase is restarted from a specific frame (see *Phase.SetRestartFrame*), in which case
+    {PARENT_cvname} is the value of the CV in that frame.
     """
-    to_replace = {"{INIT_NSTEP}": self.phase.window.system.init_nstep}
-    for pcvn, pcvv, pcvs, cvv, cvs, cv in zip(self.phase.window.parent.cv_names, self.phase.window.parent.cv_values, self.phase.window.parent.cv_shifts, self.phase.window.cv_values, self.phase.window.cv_shifts, self.phase.window.system.cv_list):
+    system = self.phase.window.system
+    parent = self.phase.parent_phase.window
+    pcv_values = parent.cv_values
+    pcv_shifts = parent.cv_shifts
+    to_replace = {"{INIT_NSTEP}": getattr(self.phase, "nstep", None) or system.GetPhaseNstep(self.phase)}
+    if getattr(self.phase, "restart_frame", None) is not None:
+      pcv_values = self.phase.restart_cv_values
+      pcv_shifts = [0.0 for cvv in pcv_values]
+    for pcvn, pcvv, pcvs, cvv, cvs, cv in zip(parent.cv_names, pcv_values, pcv_shifts, self.phase.window.cv_values, self.phase.window.cv_shifts, system.cv_list):
       if not cv.periodicity:
         to_replace["{PARENT_" + pcvn + "}"] = pcvv + pcvs
       else:
@@ -151,7 +170,7 @@ class Job():
           to_replace["{PARENT_" + pcvn + "}"] = pcvv + pcvs - cv.periodicity
         elif cvv - pcvv > cv.periodicity / 2.0:
           to_replace["{PARENT_" + pcvn + "}"] = pcvv + pcvs + cv.periodicity
-    for cvn, cvk in zip(self.phase.window.parent.cv_names, self.phase.window.parent.spring_constants):
+    for cvn, cvk in zip(parent.cv_names, parent.spring_constants):
       to_replace["{PARENT_" + cvn + "_K}"] = cvk
     return to_replace
 
@@ -160,34 +179,155 @@ class Job():
     This function returns a dictionary containing the fields that will be replaced only in the
     run MD input files.
     """
-    to_replace = {"{RUN_NSTEP}": self.phase.window.system.run_nstep}
+    to_replace = {"{RUN_NSTEP}": getattr(self.phase, "nstep", None) or self.phase.window.system.run_nstep}
     return to_replace
 
-  def Submit(self, environment):
+  def Submit(self, environment, hold_jid=None):
     """
     Submit the job to the cluster
 
     :param environment: The environment used to submit the job
+    :param hold_jid: Job ID of a job that has to finish successfully before this job can start
+     (see *Environment.dependency_option*).
     :type environment: :class:`~environment.Environment`
+    :type hold_jid: :class:`str`
+    """
+    with Timer(self.phase.window.system.metrics, "qsub"):
+      if hold_jid is None:
+        self.jid = environment.qsub(self.phase.outdir, self.path_to_job_file)
+      else:
+        self.jid = environment.qsub(self.phase.outdir, self.path_to_job_file, hold_jid)
+    self.status = "submitted"
+    self.submit_time = time.time()
+    self.phase.window.system.unfinished_jobs.append(self)
+
+  def SubmitInBundle(self, jid, bundle=None):
+    """
+    Register the job as submitted within a job shared with other phases, either a bundle of jobs
+    (see :class:`~packing.JobPacker`) or a replica exchange block (see :class:`~reus.ReplicaExchange`).
+
+    :param jid: The job ID of the shared job
+    :param bundle: The name of the bundle, if the job is part of a bundle
+    :type jid: :class:`str`
+    :type bundle: :class:`str`
     """
-    self.jid = environment.qsub(self.phase.outdir, self.path_to_job_file)
+    self.jid = jid
+    self.bundle = bundle
     self.status = "submitted"
+    self.submit_time = time.time()
     self.phase.window.system.unfinished_jobs.append(self)
 
-  def UpdateStatus(self, environment):
+  def Cancel(self, environment):
+    """
+    Cancel the job. It is removed from the queue (if the environment has a *qdel* command) and considered
+    finished and unsuccessful.
+
+    :param environment: The environment used to cancel the job
+    :type environment: :class:`~environment.Environment`
+    """
+    if self.queue_status != "finished":
+      qdel = getattr(environment, "qdel", None)
+      if qdel:
+        qdel(self.jid)
+      else:
+        logging.warning("The environment cannot cancel jobs, {0} stays in the queue".format(self.jid))
+    self.queue_status = "finished"
+    self.success = False
+    self.cancelled = True
+    self.finish_time = time.time()
+
+  def GetQueueStatus(self, environment, status_cache=None):
+    """
+    Get the status of the job from the queuing system. For a job submitted in a bundle, the phase is
+    finished as soon as its *bundle_finished* file exists, and waits in the queue until its *bundle_started* file exists.
+
+    :param environment: The environment used to check the job status
+    :param status_cache: Dictionary of the status of the job IDs already checked, so that the queuing
+     system is only asked once for jobs sharing a job ID.
+    :type environment: :class:`~environment.Environment`
+    :type status_cache: :class:`dict`
+    """
+    bundle = getattr(self, "bundle", None)
+    fs_snapshot = self.phase.window.system.fs_snapshot
+    if bundle and fs_snapshot.IsFile(os.path.join(self.phase.outdir, JobPacker.FINISHED_FNAME)):
+      return "finished"
+    if status_cache is not None and self.jid in status_cache:
+      status = status_cache[self.jid]
+    else:
+      status = environment.qstat(self.jid)
+      if status_cache is not None:
+        status_cache[self.jid] = status
+    if bundle and status == "running" and not fs_snapshot.IsFile(os.path.join(self.phase.outdir, JobPacker.STARTED_FNAME)):
+      return "in queue"
+    return status
+
+  def UpdateStatus(self, environment, status_cache=None):
     """
     Check whether the job is still in the queue
 
     :param environment: The environment used to check the job status
+    :param status_cache: Dictionary of the status of the job IDs already checked (see *GetQueueStatus*)
     :type environment: :class:`~environment.Environment`
+    :type status_cache: :class:`dict`
     """
     if self.queue_status != "finished":
-      self.queue_status = environment.qstat(self.jid)
+      self.queue_status = self.GetQueueStatus(environment, status_cache)
+      now = time.time()
+      if self.queue_status == "in queue":
+        self.last_queued_time = now
+      if self.queue_status != "finished":
+        self.last_unfinished_time = now
+      if self.queue_status == "running" and getattr(self, "start_time", None) is None:
+        self.start_time = now
       if self.queue_status == "finished":
+        self.finish_time = now
+        if getattr(self, "reus_block", None):
+          self.reus_block.Demultiplex(self.phase.window.system)
         self.success = True
+        # The output directory is listed again, as the job may have written to it since it was last listed
+        fs_snapshot = self.phase.window.system.fs_snapshot
+        fs_snapshot.Forget(self.phase.outdir)
         for fname in self.phase.window.system.check_fnames:
-          if not os.path.isfile(os.path.join(self.phase.outdir, fname)):
+          if not fs_snapshot.IsFile(os.path.join(self.phase.outdir, fname)):
             self.success = False
             break
         if self.success and self.phase.type == "run":
           self.phase.window.n_run_phases += 1
+
+  def GetQueueWaitAndRunTime(self):
+    """
+    Returns the time (in seconds) the job waited in the queue and the time it ran. These are measured
+    from the times at which the job was submitted, seen running for the first time and seen finished,
+    so their precision is limited by the polling interval. If the job was never seen running, the queue wait
+    is *None* and the run time is the time between submission and completion. Times that are not known are *None*.
+    """
+    submit_time = getattr(self, "submit_time", None)
+    start_time = getattr(self, "start_time", None)
+    finish_time = getattr(self, "finish_time", None)
+    if submit_time is None:
+      return None, None
+    if start_time is None:
+      if finish_time is None:
+        return None, None
+      return None, finish_time - submit_time
+    if finish_time is None:
+      return start_time - submit_time, None
+    return start_time - submit_time, finish_time - start_time
+
+  def GetEstimatedQueueWaitAndRunTime(self):
+    """
+    Returns estimates of the time (in seconds) the job waited in the queue and the time it ran. Unlike
+    *GetQueueWaitAndRunTime*, the job is considered to have started (finished) halfway between the last time it was
+    seen in the queue (unfinished) and the first time it was seen running (finished), so that the estimates do
+    not grow with the polling interval. Times that are not known are *None*.
+    """
+    submit_time = getattr(self, "submit_time", None)
+    start_time = getattr(self, "start_time", None)
+    finish_time = getattr(self, "finish_time", None)
+    if submit_time is None or finish_time is None:
+      return None, None
+    finish_time = 0.5 * (finish_time + (getattr(self, "last_unfinished_time", None) or submit_time))
+    if start_time is None:
+      return None, finish_time - submit_time
+    start_time = 0.5 * (start_time + (getattr(self, "last_queued_time", None) or submit_time))
+    return start_time - submit_time, max(finish_time - start_time, 0.0)
@@ -0,0 +1,176 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+This module contains the :class:`MetricsRecorder` class, which records where the supervisor
+spends its time in each cycle, as well as job counts and queue wait and run times of the jobs.
+The metrics are written to a JSON lines file (one record per cycle) and to a file in the Prometheus
+text format, which can for example be exported with the textfile collector of the node exporter.
+"""
+import os
+import time
+import json
+import contextlib
+
+__all__ = ('MetricsRecorder', 'Timer')
+
+
+@contextlib.contextmanager
+def Timer(recorder, name):
+  """
+  Context manager adding the time spent in its block to the timing *name* of the current cycle
+  of *recorder*. Does nothing if *recorder* is *None*, so that it can be used unconditionally.
+
+  :param recorder: The recorder or *None*
+  :param name: Name of the timing
+  :type recorder: :class:`MetricsRecorder`
+  :type name: :class:`str`
+  """
+  if recorder is None:
+    yield
+    return
+  t0 = time.time()
+  try:
+    yield
+  finally:
+    recorder.AddTime(name, time.time() - t0)
+
+
+def _Escape(value):
+  return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class MetricsRecorder():
+  """
+  Records per-cycle metrics of the supervisor. A cycle is started with *StartCycle* and ended with
+  *EndCycle*, which appends the record of the cycle to the JSON lines file and rewrites the Prometheus file.
+  In between, timings are accumulated with :func:`Timer` or *AddTime*, counters with *Count* and finished
+  jobs with *RecordFinishedJob*. A recorder is attached to a :class:`~system.System` as *system.metrics*.
+  The summaries of the queue wait and run times of the jobs are those of the system (*System.job_durations*,
+  see :class:`~polling.JobDurations`).
+  """
+
+  def __repr__(self):
+    return "MetricsRecorder({0},{1},{2})".format(self.path_to_jsonl, self.path_to_prometheus, self.name)
+
+  def __init__(self, path_to_jsonl, path_to_prometheus, name=""):
+    """
+    :param path_to_jsonl: Path to the JSON lines file to which one record is appended per cycle
+    :param path_to_prometheus: Path to the Prometheus text file, rewritten at the end of every cycle
+    :param name: Name of the system, used as label in the Prometheus file
+    :type path_to_jsonl: :class:`str`
+    :type path_to_prometheus: :class:`str`
+    :type name: :class:`str`
+    """
+    self.path_to_jsonl = path_to_jsonl
+    self.path_to_prometheus = path_to_prometheus
+    self.name = name
+    self.cycle = 0
+    self.timings = {}
+    self.counts = {}
+    self.gauges = {}
+    self.finished_jobs = []
+    self.total_timings = {}
+    self.total_counts = {}
+    self.cycle_start = None
+
+  def StartCycle(self):
+    """
+    Start a new cycle.
+    """
+    self.cycle += 1
+    self.timings = {}
+    self.counts = {}
+    self.finished_jobs = []
+    self.cycle_start = time.time()
+
+  def AddTime(self, name, seconds):
+    self.timings[name] = self.timings.get(name, 0.0) + seconds
+    self.total_timings[name] = self.total_timings.get(
+        name, 0.0) + seconds
+
+  def Count(self, name, n=1):
+    self.counts[name] = self.counts.get(name, 0) + n
+    self.total_counts[name] = self.total_counts.get(name, 0) + n
+
+  def SetGauge(self, name, value):
+    self.gauges[name] = value
+
+  def RecordFinishedJob(self, job):
+    """
+    Record the queue wait and run times of a finished job in the record of the cycle. If the start of the job was
+    not observed (see *Environment*), the queue wait is unknown and the run time is the time from submission to completion.
+
+    :param job: The finished job
+    :type job: :class:`~job.Job`
+    """
+    queue_wait, run_time = job.GetQueueWaitAndRunTime()
+    phase_type = job.phase.type
+    self.finished_jobs.append({"window": job.phase.window.name, "phase": job.phase.name, "type": phase_type,
+                               "success": bool(job.success), "queue_wait": queue_wait, "run_time": run_time})
+    self.Count("jobs_finished")
+    if not job.success:
+      self.Count("jobs_crashed")
+
+  def EndCycle(self, job_durations=None):
+    """
+    End the current cycle and write the metrics.
+
+    :param job_durations: Statistics of the jobs of the system, written as summaries to the Prometheus file
+    :type job_durations: :class:`~polling.JobDurations`
+    """
+    self.AddTime("cycle", time.time() - self.cycle_start)
+    record = {"cycle": self.cycle, "time": time.time(), "system": self.name, "timings": self.timings,
+              "counts": self.counts, "gauges": self.gauges, "finished_jobs": self.finished_jobs}
+    f = open(self.path_to_jsonl, "a")
+    f.write(json.dumps(record, sort_keys=True) + "\n")
+    f.close()
+    self.WritePrometheus(job_durations)
+
+  def WritePrometheus(self, job_durations=None):
+    """
+    Write the Prometheus text file. The file is written to a temporary file and then renamed, so
+    that readers never see a partially written file.
+
+    :param job_durations: Statistics of the jobs of the system, written as summaries of the queue wait and run times
+    :type job_durations: :class:`~polling.JobDurations`
+    """
+    job_stats = job_durations.stats if job_durations is not None else {}
+    label = "system=\"{0}\"".format(_Escape(self.name))
+    lines = ["# HELP sipmf_cycles_total Number of supervisor cycles.",
+             "# TYPE sipmf_cycles_total counter",
+             "sipmf_cycles_total{{{0}}} {1}".format(label, self.cycle),
+             "# HELP sipmf_cycle_seconds Time spent in each part of the last supervisor cycle.",
+             "# TYPE sipmf_cycle_seconds gauge"]
+    for name in sorted(self.timings):
+      lines.append("sipmf_cycle_seconds{{{0},part=\"{1}\"}} {2}".format(
+          label, _Escape(name), self.timings[name]))
+    lines.extend(["# HELP sipmf_seconds_total Total time spent in each part of the supervisor cycles.",
+                  "# TYPE sipmf_seconds_total counter"])
+    for name in sorted(self.total_timings):
+      lines.append("sipmf_seconds_total{{{0},part=\"{1}\"}} {2}".format(
+          label, _Escape(name), self.total_timings[name]))
+    lines.extend(["# HELP sipmf_events_total Number of events (jobs submitted, finished, crashed, ...).",
+                  "# TYPE sipmf_events_total counter"])
+    for name in sorted(self.total_counts):
+      lines.append("sipmf_events_total{{{0},event=\"{1}\"}} {2}".format(
+          label, _Escape(name), self.total_counts[name]))
+    lines.extend(["# HELP sipmf_state Current state of the system (running jobs, windows, ...).",
+                  "# TYPE sipmf_state gauge"])
+    for name in sorted(self.gauges):
+      lines.append("sipmf_state{{{0},quantity=\"{1}\"}} {2}".format(
+          label, _Escape(name), self.gauges[name]))
+    for metric, key, help_text in [("sipmf_job_queue_wait_seconds", "queue_wait", "Time jobs spent waiting in the queue."),
+                                   ("sipmf_job_run_seconds", "run_time", "Time jobs spent running.")]:
+      lines.extend(["# HELP {0} {1}".format(metric, help_text),
+                    "# TYPE {0} summary".format(metric)])
+      for phase_type in sorted(job_stats):
+        stats = job_stats[phase_type]
+        l = "{0},phase_type=\"{1}\"".format(label, _Escape(phase_type))
+        lines.append("{0}_sum{{{1}}} {2}".format(
+            metric, l, stats[key + "_sum"]))
+        lines.append("{0}_count{{{1}}} {2}".format(
+            metric, l, stats[key + "_count"]))
+    f = open(self.path_to_prometheus + ".tmp", "w")
+    f.write("\n".join(lines) + "\n")
+    f.close()
+    os.rename(self.path_to_prometheus + ".tmp", self.path_to_prometheus)
@@ -0,0 +1,298 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+This module contains the :class:`MultiSiPMF` class, which supervises the calculation of the PMFs
+of several systems from a single process.
+"""
+import os
+import time
+import logging
+from sipmf import SiPMF
+from plotting import PlotWorker
+from colvars import CompressionWorker
+from metrics import MetricsRecorder, Timer
+from throttle import SubmissionThrottle
+from polling import PollSchedule
+from environment import ListQueue, GetQueueStatusCache
+
+__all__ = ('MultiSiPMF',)
+
+
+class MultiSiPMF():
+  """
+  The :class:`MultiSiPMF` class supervises the calculation of the PMFs of several systems (e.g. mutants or ligands)
+  sharing one :class:`~environment.Environment`, from a single loop instead of one :class:`~sipmf.SiPMF` process per
+  system. Each system goes through the same steps as with :class:`~sipmf.SiPMF`, with the following differences:
+
+   - The number of unfinished jobs of all the systems together is limited to *max_running_jobs*. Windows that
+     cannot get a job because of this limit get one in a later cycle, those with the lowest free energy first
+     (see :class:`~throttle.SubmissionThrottle`).
+   - The free job slots are shared between the systems that need jobs, either in proportion to their *shares*,
+     taking the jobs they already have into account (*policy* "fair"), or by decreasing share (*policy* "priority").
+   - The queuing system is polled once per cycle for the jobs of all the systems if the environment has a
+     *qstat_all_command* (see :func:`~environment.ListQueue`), rather than once per job.
+  """
+
+  def __repr__(self):
+    return "MultiSiPMF({0},{1})".format([s.system for s in self.supervisors], self.environment)
+
+  def __init__(self, systems, environment, max_running_jobs=None, shares=None, policy="fair", count_queue=False):
+    """
+    :param systems: The systems that will be studied
+    :param environment: The environment shared by all the systems
+    :param max_running_jobs: Maximal number of unfinished jobs (waiting in the queue or running) of all the systems
+     together. By default there is no limit.
+    :param shares: Share of the job slots of each system (by default all systems have the same share).
+     With the "priority" *policy*, systems with a higher share get their jobs first.
+    :param policy: How free job slots are shared between systems, either "fair" or "priority".
+    :param count_queue: Count the jobs waiting in the queue or running from the queuing system, including the jobs
+     of other processes, rather than from the jobs of the systems (see :class:`~throttle.SubmissionThrottle`).
+    :type systems: :class:`list` (:class:`~system.System`)
+    :type environment: :class:`~environment.Environment`
+    :type max_running_jobs: :class:`int`
+    :type shares: :class:`list` (:class:`float`)
+    :type policy: :class:`str`
+    :type count_queue: :class:`bool`
+    """
+    if policy not in ["fair", "priority"]:
+      logging.error("Unknown policy {0}, should be fair or priority".format(policy))
+      raise ValueError("Unknown policy {0}, should be fair or priority".format(policy))
+    if shares is None:
+      shares = [1.0 for system in systems]
+    if len(shares) != len(systems):
+      logging.error("One share is needed for each system")
+      raise ValueError("One share is needed for each system")
+    self.supervisors = [SiPMF(system, environment) for system in systems]
+    self.environment = environment
+    self.max_running_jobs = max_running_jobs
+    self.throttle = None
+    if max_running_jobs is not None:
+      self.throttle = SubmissionThrottle(max_running_jobs, count_queue)
+    self.shares = [float(s) for s in shares]
+    self.policy = policy
+
+  def GetNRunningJobs(self):
+    """
+    Number of unfinished jobs of all the systems.
+    """
+    return sum([len(s.system.unfinished_jobs) for s in self.supervisors])
+
+  def GetQuotas(self, indices, n_slots):
+    """
+    Share *n_slots* free job slots between the systems with the given indices. With the "fair" policy,
+    slots are given one at a time to the system with the fewest jobs (unfinished jobs and slots already given)
+    relative to its share. With the "priority" policy, all slots go to the system with the highest share.
+    Returns the number of slots of each system, *None* meaning that there is no limit.
+
+    :param indices: Indices of the systems
+    :param n_slots: The number of free slots, *None* if there is no limit
+    :type indices: :class:`list` (:class:`int`)
+    :type n_slots: :class:`int`
+    """
+    if n_slots is None:
+      return [None for i in indices]
+    quotas = [0 for i in indices]
+    if self.policy == "priority":
+      quotas[max(range(len(indices)), key=lambda k: self.shares[indices[k]])] = n_slots
+      return quotas
+    loads = [len(self.supervisors[i].system.unfinished_jobs) for i in indices]
+    for slot in range(n_slots):
+      k = min(range(len(indices)), key=lambda k: (loads[k] + quotas[k] + 1) / self.shares[indices[k]])
+      quotas[k] += 1
+    return quotas
+
+  def SubmitNewJobs(self, indices, n_jobs, max_jobs):
+    """
+    Submit jobs for the updated windows of the systems with the given indices, within the limit on the number
+    of unfinished jobs. Systems that do not use all their slots leave them to the others.
+    The updated windows of each system are ordered by priority before submitting (see *SubmissionThrottle.Order*).
+    Returns the number of jobs submitted for each system.
+
+    :param indices: Indices of the systems
+    :param n_jobs: Number of jobs submitted so far by each system
+    :param max_jobs: Maximal number of jobs submitted by each system
+    :type indices: :class:`list` (:class:`int`)
+    :type n_jobs: :class:`list` (:class:`int`)
+    :type max_jobs: :class:`int`
+    """
+    submitted = [0 for s in self.supervisors]
+    pending = [i for i in indices if self.supervisors[i].system.updated_windows and n_jobs[i] < max_jobs]
+    while pending:
+      n_slots = None
+      if self.throttle:
+        n_slots = self.throttle.GetFreeSlots([s.system for s in self.supervisors])
+        if n_slots <= 0:
+          break
+      quotas = self.GetQuotas(pending, n_slots)
+      still_pending = []
+      for i, quota in zip(pending, quotas):
+        if quota == 0:
+          still_pending.append(i)
+          continue
+        system = self.supervisors[i].system
+        limit = max_jobs - n_jobs[i] if quota is None else min(quota, max_jobs - n_jobs[i])
+        if self.throttle:
+          self.throttle.Order(system)
+        nj = system.SubmitNewJobs(self.environment, limit)
+        if self.throttle:
+          self.throttle.RecordSubmitted(nj)
+        n_jobs[i] += nj
+        submitted[i] += nj
+        if nj >= limit and system.updated_windows and n_jobs[i] < max_jobs:
+          still_pending.append(i)
+      # Each round either fills slots or drops the systems that did not use theirs
+      if n_slots is None:
+        break
+      pending = still_pending
+    return submitted
+
+  def Run(self, max_time, max_jobs, sleep_length, generate_new_windows=True, background_plotting=False,
+          plot_interval=0.0, record_metrics=False, min_sleep_length=None, compress_data=None):
+    """
+    Run the process exploring the free energy landscapes of all the systems, as *SiPMF.Run* does for one system.
+    The process stops once no system has jobs left and no system can create new windows. The state of each
+    system is saved in its own base directory.
+
+    :param max_time: Maximal time (in seconds) the process will run for
+    :param max_jobs: Maximal number of jobs the process will submit for each system
+    :param sleep_length: time (in seconds) the process will sleep between two cycles.
+    :param generate_new_windows: Whether new windows should be generated when all jobs of a system are finished.
+    :param background_plotting: Render the plots of the PMFs and histograms in a background process
+     (:class:`~plotting.PlotWorker`) shared by all the systems.
+    :param plot_interval: Minimal time (in seconds) between two rendering rounds of the background process.
+    :param record_metrics: Record the metrics of each system in its base directory (see *SiPMF.Run*).
+    :param min_sleep_length: If set, the process sleeps until the earliest predicted completion of the jobs of all
+     the systems, but at least *min_sleep_length* and at most *sleep_length* seconds (see :class:`~polling.PollSchedule`).
+    :param compress_data: If set (*gz* or *zst*), the datafiles of the finished phases of all the systems are compressed
+     in a background process (:class:`~colvars.CompressionWorker`) shared by all the systems.
+    :type max_time: :class:`int`
+    :type max_jobs: :class:`int`
+    :type sleep_length: :class:`int`
+    :type generate_new_windows: :class:`bool`
+    :type background_plotting: :class:`bool`
+    :type plot_interval: :class:`float`
+    :type record_metrics: :class:`bool`
+    :type min_sleep_length: :class:`float`
+    :type compress_data: :class:`str`
+    """
+    systems = [s.system for s in self.supervisors]
+    for system in systems:
+      if len(system.windows) == 0:
+        print "System {0} does not contain any Window.".format(system.basedir)
+        print "Make sure to initialize the systems before running them."
+        return
+    if background_plotting:
+      plot_worker = PlotWorker(plot_interval)
+      plot_worker.Start()
+      for system in systems:
+        system.plot_worker = plot_worker
+    if compress_data:
+      compression_worker = CompressionWorker(compress_data)
+      compression_worker.Start()
+      for system in systems:
+        system.compression_worker = compression_worker
+    if record_metrics:
+      for system in systems:
+        system.metrics = MetricsRecorder(os.path.join(system.basedir, "metrics.jsonl"),
+                                         os.path.join(system.basedir, "metrics.prom"),
+                                         os.path.basename(os.path.normpath(system.basedir)))
+    schedule = None
+    if min_sleep_length is not None:
+      schedule = PollSchedule(min_sleep_length, sleep_length)
+    try:
+      self._Run(max_time, max_jobs, sleep_length, generate_new_windows, schedule)
+    finally:
+      for system in systems:
+        system.metrics = None
+      if background_plotting:
+        for system in systems:
+          system.plot_worker = None
+        logging.info("Waiting for the plotting process to finish.")
+        plot_worker.Stop()
+      if compress_data:
+        for system in systems:
+          system.compression_worker = None
+        logging.info("Waiting for the compression process to finish.")
+        compression_worker.Stop()
+
+  def _Run(self, max_time, max_jobs, sleep_length, generate_new_windows, schedule=None):
+    systems = [s.system for s in self.supervisors]
+    n = len(systems)
+    n_jobs = [0 for i in range(n)]
+    finished = [False for i in range(n)]
+    t0 = time.time()
+    continue_flag = True
+    logging.info("Starting the calculation of {0} systems with max_time={1}s,max_jobs={2},sleep_length={3}s,"
+                 "max_running_jobs={4}".format(n, max_time, max_jobs, sleep_length, self.max_running_jobs))
+    while continue_flag:
+      for system in systems:
+        if system.metrics:
+          system.metrics.StartCycle()
+      submit_flag = time.time() - t0 < max_time
+      save = [False for i in range(n)]
+      # The queue is polled once for all the systems
+      queue = ListQueue(self.environment)
+      if self.throttle:
+        self.throttle.StartCycle(queue)
+      status_cache = GetQueueStatusCache(self.environment,
+                                         [job for system in systems for job in system.unfinished_jobs], queue)
+      for system in systems:
+        with Timer(system.metrics, "poll"):
+          n_crashed_jobs = system.UpdateUnfinishedJobList(self.environment, status_cache)[1]
+        if n_crashed_jobs > 0:
+          logging.info("{0}: {1} jobs crashed".format(system.name or system.basedir, n_crashed_jobs))
+      submitted = [0 for i in range(n)]
+      if submit_flag:
+        submitted = self.SubmitNewJobs([i for i in range(n) if not finished[i]], n_jobs, max_jobs)
+      # Systems without jobs nor windows waiting for a job explore further
+      generated = []
+      for i in range(n):
+        system = systems[i]
+        if finished[i] or system.unfinished_jobs or system.updated_windows:
+          continue
+        n_new_windows = 0
+        if generate_new_windows and submit_flag and n_jobs[i] < max_jobs:
+          with Timer(system.metrics, "generate_windows"):
+            n_new_windows, fe_threshold = system.GenerateNewWindows(self.environment)
+        if n_new_windows:
+          logging.info("{0}: generated {1} new windows with free energy threshold={2}. Total of {3} windows".format(
+              system.name or system.basedir, n_new_windows, fe_threshold, len(system.windows)))
+          generated.append(i)
+          save[i] = True
+        else:
+          logging.info("{0}: no new windows were generated, the system is finished".format(
+              system.name or system.basedir))
+          finished[i] = True
+      if generated:
+        for i, nj in enumerate(self.SubmitNewJobs(generated, n_jobs, max_jobs)):
+          submitted[i] += nj
+      if self.throttle:
+        self.throttle.EndCycle(systems)
+      continue_flag = False
+      for i in range(n):
+        system = systems[i]
+        if submitted[i]:
+          save[i] = True
+        if system.unfinished_jobs or (system.updated_windows and submit_flag and n_jobs[i] < max_jobs):
+          continue_flag = True
+        if save[i]:
+          system.Save("siPMF_state")
+        if system.metrics:
+          system.metrics.SetGauge("unfinished_jobs", len(system.unfinished_jobs))
+          system.metrics.SetGauge("windows", len(system.windows))
+          system.metrics.SetGauge("submitted_jobs", n_jobs[i])
+          system.metrics.EndCycle(system.job_durations)
+      if sum(submitted):
+        logging.info("Submitted {0} new jobs, {1} jobs are running or in the queue".format(
+            sum(submitted), self.GetNRunningJobs()))
+      if continue_flag:
+        time.sleep(schedule.GetSleepLength(systems) if schedule else sleep_length)
+    # Make sure the PMFs are up to date before saving and stopping
+    for system in systems:
+      if system.metrics:
+        system.metrics.StartCycle()
+      system.UpdatePMF(self.environment)
+      system.Save("siPMF_state")
+      if system.metrics:
+        system.metrics.EndCycle(system.job_durations)
+    logging.info("Stopping.")
@@ -0,0 +1,130 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+This module contains the :class:`OverlapMatrix` class, a sparse matrix of the overlaps between the sample
+distributions of neighboring windows, which is updated incrementally as phases finish.
+"""
+import logging
+import numpy as npy
+from allocation import SampleHistogram, HistogramOverlap
+
+__all__ = ('OverlapMatrix',)
+
+
+class OverlapMatrix():
+  """
+  Sparse matrix of the overlaps between the histograms of the samples of neighboring windows
+  (see *System.GetNeighborWindows*). The overlap of two windows is the sum over the bins of the minimum of their
+  normalized histograms (see :func:`~allocation.HistogramOverlap`), so that it is 1 for identical and 0 for disjoint
+  distributions. Poorly overlapping neighbors leave a gap in the data used by WHAM.
+
+  The histogram of each window (on the bins used for the PMF) is accumulated from the finished run phases of the window,
+  so that each phase is only read once, and only the overlaps of windows whose histogram changed are recomputed.
+  Overlaps are stored with the names of both windows as key, in alphabetical order.
+  """
+
+  def __repr__(self):
+    return "OverlapMatrix({0} windows, {1} pairs)".format(len(self.histograms), len(self.overlaps))
+
+  def __init__(self):
+    self.histograms = {}
+    self.n_samples = {}
+    self.phases = {}
+    self.means = {}
+    self.overlaps = {}
+
+  def AddPhase(self, system, phase):
+    """
+    Add the samples of a phase to the histogram of its window. Returns *False* if the phase was already added.
+
+    :param system: The system
+    :param phase: The phase
+    :type system: :class:`~system.System`
+    :type phase: :class:`~phase.Phase`
+    """
+    name = phase.window.name
+    added = self.phases.setdefault(name, set())
+    if phase.name in added:
+      return False
+    added.add(phase.name)
+    t, cvs = phase.ReadDataFile()
+    data = npy.array(cvs, dtype=float).reshape([system.dimensionality, -1]).transpose()
+    n = len(data)
+    if n == 0:
+      return True
+    h = SampleHistogram(data, system.cv_list)
+    n_old = self.n_samples.get(name, 0)
+    old = self.histograms.get(name, {})
+    n_tot = float(n_old + n)
+    merged = dict((k, p * n_old / n_tot) for k, p in old.iteritems())
+    for k, p in h.iteritems():
+      merged[k] = merged.get(k, 0.0) + p * n / n_tot
+    self.histograms[name] = merged
+    self.n_samples[name] = n_old + n
+    # Mean deviation from the restraint center, unwrapped for periodic CVs
+    dx = data - npy.array(phase.window.cv_values, dtype=float) - npy.array(phase.window.cv_shifts, dtype=float)
+    for i, cv in enumerate(system.cv_list):
+      if cv.periodicity:
+        dx[:, i] = (dx[:, i] + cv.periodicity / 2.0) % cv.periodicity - cv.periodicity / 2.0
+    self.means[name] = (self.means.get(name, npy.zeros(system.dimensionality)) * n_old + dx.sum(axis=0)) / n_tot
+    return True
+
+  def Update(self, system):
+    """
+    Add the finished run phases that were not added yet and recompute the overlaps of the windows whose
+    histogram changed with their neighbors. Returns the number of phases added.
+
+    :param system: The system
+    :type system: :class:`~system.System`
+    """
+    running_phases = set([job.phase for job in system.unfinished_jobs])
+    updated = []
+    n_phases = 0
+    for window in system.windows:
+      phases = [p for p in window.phases if p.type == "run" and p not in running_phases
+                and p.name not in self.phases.get(window.name, ()) and p.n_data > 0]
+      for phase in phases:
+        self.AddPhase(system, phase)
+        n_phases += 1
+      if phases:
+        updated.append(window)
+    if updated:
+      neighbors = system.GetNeighborWindows(updated)
+      for window in updated:
+        for n in neighbors[window]:
+          if window.name in self.histograms and n.name in self.histograms:
+            self.overlaps[_Key(window, n)] = HistogramOverlap(
+                self.histograms[window.name], self.histograms[n.name])
+    logging.info("Overlap matrix updated with {0} phases from {1} windows".format(n_phases, len(updated)))
+    return n_phases
+
+  def GetOverlap(self, window1, window2):
+    """
+    Overlap of two neighboring windows, *None* if it is not known (e.g. if one of the windows has no data yet).
+    """
+    return self.overlaps.get(_Key(window1, window2))
+
+  def GetPoorOverlaps(self, system, min_overlap):
+    """
+    Find the pairs of neighboring windows whose overlap is below *min_overlap*.
+    Returns a list of tuples *(window1, window2, overlap)*, sorted by increasing overlap.
+
+    :param system: The system
+    :param min_overlap: The minimal overlap
+    :type system: :class:`~system.System`
+    :type min_overlap: :class:`float`
+    """
+    windows = dict((w.name, w) for w in system.windows)
+    poor = [(windows[k[0]], windows[k[1]], o) for k, o in self.overlaps.iteritems()
+            if o < min_overlap and k[0] in windows and k[1] in windows]
+    return sorted(poor, key=lambda el: el[2])
+
+  def GetMeanDeviation(self, window):
+    """
+    Mean deviation of the samples of a window from the center of its restraint, *None* if the window has no data.
+    """
+    return self.means.get(window.name)
+
+
+def _Key(window1, window2):
+  return tuple(sorted([window1.name, window2.name]))
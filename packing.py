@@ -0,0 +1,161 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+This module contains the :class:`JobPacker` class, which bundles the jobs of several phases
+into a single job submitted to the queuing system.
+"""
+import os
+import logging
+from metrics import Timer
+
+__all__ = ('JobPacker',)
+
+
+class JobPacker():
+  """
+  Packs the jobs of several phases (usually from different windows) into bundles, each submitted to the
+  queuing system as one job. This avoids paying the queue wait and startup cost of the queuing system
+  for every short phase. A bundle has *cores_per_job/cores_per_phase* lanes running in parallel, and each lane
+  runs phases one after the other as long as they fit in *walltime*.
+
+  The job file of each phase is rendered as usual (see :class:`~job.Job`) and launched from the directory of the phase
+  by the bundle job file, which is generated from the template *basedir/bundle_job_fname* by replacing
+  {BUNDLE_COMMANDS} with the commands launching the phases, as well as {BASEDIR}, {BUNDLE} (name of the bundle),
+  {OUTPUTDIR} (directory of the bundle), {NCORES} (number of cores needed by the bundle) and {NPHASES}.
+  Bundles are written to *basedir/bundles*.
+
+  When a phase of a bundle starts (finishes), the file *bundle_started* (*bundle_finished*) is written to its
+  directory, so that each phase is considered finished as soon as it is done, even if the bundle is still running.
+  Whether a phase finished properly is then checked with the *check_fnames* of the :class:`~system.System`, as for any other phase.
+  """
+  STARTED_FNAME = "bundle_started"
+  FINISHED_FNAME = "bundle_finished"
+
+  def __repr__(self):
+    return "JobPacker({0},{1},{2},{3},{4})".format(self.bundle_job_fname, self.cores_per_job, self.cores_per_phase, self.walltime, self.phase_walltime)
+
+  def __init__(self, bundle_job_fname, cores_per_job, cores_per_phase=1, walltime=None, phase_walltime=None, launcher="sh"):
+    """
+    :param bundle_job_fname: *basedir/bundle_job_fname* is the template job file used to submit bundles.
+    :param cores_per_job: Number of cores requested by a bundle.
+    :param cores_per_phase: Number of cores used by each phase.
+    :param walltime: Target wall time (in seconds) of a bundle. By default each lane runs a single phase.
+    :param phase_walltime: Wall time (in seconds) of one phase. By default, the average run time of the finished
+     jobs of the same type is used when available (see *System.job_durations*).
+    :param launcher: Command used to run the job file of a phase from within the bundle.
+    :type bundle_job_fname: :class:`str`
+    :type cores_per_job: :class:`int`
+    :type cores_per_phase: :class:`int`
+    :type walltime: :class:`float`
+    :type phase_walltime: :class:`float`
+    :type launcher: :class:`str`
+    """
+    self.bundle_job_fname = bundle_job_fname
+    self.cores_per_job = cores_per_job
+    self.cores_per_phase = cores_per_phase
+    self.walltime = walltime
+    self.phase_walltime = phase_walltime
+    self.launcher = launcher
+    self.n_bundles = 0
+
+  def GetPhaseWalltime(self, system, phase_type):
+    """
+    Wall time of a phase of type *phase_type*: *phase_walltime* if it is set, else the mean run time of the finished
+    jobs of that type (see :class:`~polling.JobDurations`), *None* if it is not known.
+    """
+    if self.phase_walltime:
+      return self.phase_walltime
+    return system.job_durations.GetMeanRunTime(phase_type)
+
+  def GetLanes(self):
+    return max(self.cores_per_job // self.cores_per_phase, 1)
+
+  def GetDepth(self, system, phase_type):
+    """
+    Number of phases of type *phase_type* that fit one after the other in a lane.
+    """
+    phase_walltime = self.GetPhaseWalltime(system, phase_type)
+    if not self.walltime or not phase_walltime:
+      return 1
+    return max(int(self.walltime // phase_walltime), 1)
+
+  def Pack(self, system, jobs):
+    """
+    Split the jobs into bundles. Returns a list of bundles, each being a list of lanes (lists of jobs).
+    Jobs of different types are packed separately as their run times are different.
+    """
+    bundles = []
+    lanes = self.GetLanes()
+    for phase_type in ["initialization", "run"]:
+      jl = [job for job in jobs if job.phase.type == phase_type]
+      size = lanes * self.GetDepth(system, phase_type)
+      for start in range(0, len(jl), size):
+        chunk = jl[start:start + size]
+        # Fill the lanes in turn so that they all have the same length
+        bundles.append([chunk[i::lanes] for i in range(min(lanes, len(chunk)))])
+    return bundles
+
+  def GetBundleCommands(self, lanes):
+    commands = []
+    for lane in lanes:
+      steps = []
+      for job in lane:
+        outdir = job.phase.outdir
+        steps.append("cd {0} && touch {1} && {2} {3} > bundle.log 2>&1; touch {0}/{4}".format(
+            outdir, self.STARTED_FNAME, self.launcher, os.path.basename(job.path_to_job_file), self.FINISHED_FNAME))
+      commands.append("( " + "; ".join(steps) + " ) &")
+    commands.append("wait")
+    return "\n".join(commands)
+
+  def Submit(self, system, environment, jobs):
+    """
+    Pack the jobs into bundles, write the bundle job files and submit them.
+
+    :param system: The system to which the jobs belong
+    :param environment: The environment used to submit the bundles
+    :param jobs: The jobs to submit. Their input and job files must already have been generated.
+    :type system: :class:`~system.System`
+    :type environment: :class:`~environment.Environment`
+    :type jobs: :class:`list` (:class:`~job.Job`)
+
+    :returns: The number of bundles submitted
+    """
+    bundle_dir = os.path.join(system.basedir, "bundles")
+    if not os.path.isdir(bundle_dir):
+      os.mkdir(bundle_dir)
+    f = open(os.path.join(system.basedir, self.bundle_job_fname), "r")
+    template = f.read()
+    f.close()
+    bundles = self.Pack(system, jobs)
+    for lanes in bundles:
+      self.n_bundles += 1
+      name = "bundle{0}".format(self.n_bundles)
+      outdir = os.path.join(bundle_dir, name)
+      if os.path.isdir(outdir):
+        logging.error(
+            "Directory already exists, program stops to avoid overwriting {0}.".format(outdir))
+        raise IOError(
+            "Directory already exists, program stops to avoid overwriting {0}.".format(outdir))
+      os.mkdir(outdir)
+      n_phases = sum([len(lane) for lane in lanes])
+      to_replace = {"{BASEDIR}": system.basedir,
+                    "{BUNDLE}": name,
+                    "{OUTPUTDIR}": outdir,
+                    "{NCORES}": len(lanes) * self.cores_per_phase,
+                    "{NPHASES}": n_phases,
+                    "{BUNDLE_COMMANDS}": self.GetBundleCommands(lanes)}
+      data = template
+      for key in to_replace:
+        data = data.replace(key, str(to_replace[key]))
+      path_to_job_file = os.path.join(outdir, self.bundle_job_fname)
+      f = open(path_to_job_file, "w")
+      f.write(data)
+      f.close()
+      with Timer(system.metrics, "qsub"):
+        jid = environment.qsub(outdir, path_to_job_file)
+      for lane in lanes:
+        for job in lane:
+          job.SubmitInBundle(jid, name)
+      logging.info("Submitted {0} with {1} phases in {2} lanes".format(
+          name, n_phases, len(lanes)))
+    return len(bundles)
@@ -4,10 +4,10 @@
 This file contains the :class:`Phase` object which represents a simulation phase.
 """
 import os
-import subprocess
 from job import Job
 import logging
 import pickle
+from colvars import WriteTable, FindDataFile
 
 
 class Phase():
@@ -29,20 +29,24 @@ class Phase():
     else:
       return "{0} with {1}".format(self.name, cvs)
 
-  def __init__(self, window, phase_name, phase_type, parent_phase=None):
+  def __init__(self, window, phase_name, phase_type, parent_phase=None, walker=0):
     """
     :param window:  The window to which the phase belongs
     :param phase_name:  The name of the phase
     :param phase_type:  Either *Initialization* or *run* phase.
     :param parent_phase: The phase from which this one is restarted.
+    :param walker: Index of the walker (chain of phases of the window) to which the phase belongs
+     (see *System.n_walkers*).
     :type window: :class:`~window.Window`
     :type phase_name: :class:`str`
     :type phase_type: :class:`str`
     :type parent_phase: :class:`~phase.Phase`
+    :type walker: :class:`int`
     """
     self.window = window
     self.name = phase_name
     self.type = phase_type
+    self.walker = walker
     self.n_data = 0
     self.parent_phase = parent_phase
     if self.parent_phase:
@@ -56,49 +60,106 @@ class Phase():
         self.outdir, self.window.system.data_filename)
     # self.outname=self.name
     self.data_added_to_window = False
+    # Frame of the parent phase from which the phase is restarted, None for the last frame
+    self.restart_frame = None
+    self.restart_cv_values = None
+    # Number of MD steps, set when the phase is initialized (see *System.GetPhaseNstep*)
+    self.nstep = None
+
+  def SetRestartFrame(self, frame, cv_values):
+    """
+    Restart this phase from a given frame of its parent phase instead of from the end of the parent phase.
+    The restart files are then read from *outdir/restart*, where they have to be written
+    with the *restart_extractor* of the :class:`~environment.Environment` (see *ExtractRestart*).
+
+    :param frame: Index of the frame in the trajectory of the parent phase
+    :param cv_values: Values of the CVs for that frame
+    :type frame: :class:`int`
+    :type cv_values: :class:`list` (:class:`float`)
+    """
+    self.restart_frame = frame
+    self.restart_cv_values = list(cv_values)
+    self.restartdir = os.path.join(self.outdir, "restart")
+
+  def ExtractRestart(self, environment):
+    """
+    Write the restart files for the frame of the parent phase from which this phase is restarted
+    (see *SetRestartFrame*), using the *restart_extractor* of the environment.
+
+    :param environment: The environment
+    :type environment: :class:`~environment.Environment`
+    """
+    if not os.path.isdir(self.restartdir):
+      os.mkdir(self.restartdir)
+    environment.restart_extractor(
+        self.parent_phase, self.restart_frame, self.restartdir)
 
   def Initialize(self):
     """
-    Initialize the phase by creating its output directory, and setting up the simulation :class:`Job`, i.e.
-    preparing the MD input file.
+    Initialize the phase by creating its output directory, choosing its number of MD steps and setting up
+    the simulation :class:`Job`, i.e. preparing the MD input file.
     """
     logging.info("New phase: {0}".format(self))
-    if os.path.isdir(self.outdir):
+    fs_snapshot = self.window.system.fs_snapshot
+    if fs_snapshot.IsDir(self.outdir):
       logging.error(
           "Directory already exists, program stops to avoid overwriting {0}.".format(self.outdir))
       raise IOError(
           "Directory already exists, program stops to avoid overwriting {0}.".format(self.outdir))
-    r = subprocess.call(["mkdir", self.outdir])
-    if r != 0:
+    try:
+      fs_snapshot.MakeDirs([self.outdir])
+    except OSError:
       logging.error(
           "Problem creating output directory {0}.".format(self.outdir))
       raise IOError(
           "Problem creating output directory {0}.".format(self.outdir))
+    self.nstep = self.window.system.GetPhaseNstep(self)
     self.job = Job(self)
 
-    if self.type == "initialization":
+    # The first phase of an additional walker is restarted from a phase of the first walker
+    if self.type == "initialization" or (self.walker > 0 and getattr(self.parent_phase, "walker", 0) != self.walker):
       d = {"parent cv values": self.parent_phase.window.cv_values}
       d.update(
           {"parent spring constants": self.parent_phase.window.spring_constants})
       d.update({"parent phase": self.parent_phase.name})
+      if getattr(self, "restart_frame", None) is not None:
+        d.update({"restart frame": self.restart_frame})
+        d.update({"restart cv values": self.restart_cv_values})
       f = open(os.path.join(self.outdir, "info.pkl"), "w")
       pickle.dump(d, f)
       f.close()
 
   def UpdateDataCount(self):
     """
-    Count how much data has been accumulated in this phase (number of lines in its *datafile*).
+    Count how much data has been accumulated in this phase (number of data lines in its *datafile*,
+    see *System.data_format*).
     """
     if self.type == "initialization":
       self.n_data = 0
     else:
-      if not os.path.isfile(self.path_to_datafile):
+      path = self.GetPathToDataFile()
+      if not path:
         self.n_data = 0
       else:
-        f = open(self.path_to_datafile, "r")
-        self.n_data = len([1 for line in f if not (
-            line.startswith("#") or line.startswith("*"))])
-        f.close()
+        system = self.window.system
+        self.n_data = system.data_format.Count(path, system.dimensionality)
+
+  def GetPathToDataFile(self):
+    """
+    Path to the datafile of the phase, or to its compressed version if it was compressed
+    (see :class:`~colvars.CompressionWorker`). Returns *None* if the datafile does not exist.
+    """
+    return FindDataFile(self.path_to_datafile)
+
+  def ReadDataFile(self):
+    """
+    Reads the datafile of the phase (see *System.data_format*) and returns a tuple with
+    the array of times as the first element. The second element in
+    the tuple is an array containing one row of values for each CV.
+    Comment lines (starting with # or \*) are skipped. Compressed datafiles are decompressed as a stream.
+    """
+    system = self.window.system
+    return system.data_format.Read(self.GetPathToDataFile() or self.path_to_datafile, system.dimensionality)
 
   def GetDataCount(self):
     """
@@ -108,7 +169,7 @@ class Phase():
 
   def AddDataToWindow(self, n_skip=0, n_tot=-1, new_only=True):
     """
-    Add the data of this phase to the data file of the window.
+    Add the data of this phase to the data file of the window, with the time in the first column followed by the CVs.
     *n_tot=-1* means there is no maximal number of data points added.
 
     :param n_skip: The number of data points to skip.
@@ -120,23 +181,24 @@ class Phase():
     """
     if self.type == "initialization":
       return
-    elif not os.path.isfile(self.path_to_datafile):
-      return
     elif new_only and self.data_added_to_window == True:
       return
+    path = self.GetPathToDataFile()
+    if not path:
+      return
+    system = self.window.system
     f_out = open(self.window.path_to_datafile, "a")
-    f_in = open(self.path_to_datafile, "r")
-    for line in f_in:
-      if line.startswith("#") or line.startswith("*"):
-        continue
-      elif self.window.datafile_n_data_skipped < n_skip:
-        self.window.datafile_n_data_skipped += 1
-      elif n_tot > 0 and self.window.datafile_n_data_tot >= n_tot:
-        break
-      else:
-        f_out.write(line)
-        self.window.datafile_n_data_tot += 1
-    f_in.close()
+    system.fs_snapshot.AddFile(self.window.path_to_datafile)
+    for data in system.data_format.ReadChunks(path, system.dimensionality):
+      n = min(max(n_skip - self.window.datafile_n_data_skipped, 0), len(data))
+      self.window.datafile_n_data_skipped += n
+      data = data[n:]
+      if n_tot > 0:
+        if self.window.datafile_n_data_tot >= n_tot:
+          break
+        data = data[:n_tot - self.window.datafile_n_data_tot]
+      WriteTable(f_out, data)
+      self.window.datafile_n_data_tot += len(data)
     f_out.close()
     self.data_added_to_window = True
     return
@@ -0,0 +1,290 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+This module contains the functions used to render the plots of the PMF and of the histogram
+of the sampled data, as well as the :class:`PlotWorker`, which renders these plots in a
+background process so that the supervisor never waits on matplotlib.
+All the plotting functions work on snapshots (plain arrays and :class:`~colvar.CollectiveVariable`),
+which can be sent to another process. Matplotlib is only imported when a plot is rendered.
+"""
+import os
+import time
+import logging
+import multiprocessing
+import Queue
+import numpy as npy
+from colvars import ColvarFormat
+
+__all__ = ('PlotWorker', 'PlotPMFSnapshot', 'PlotHistogramSnapshot')
+
+
+def _AxisLabel(cv):
+  if cv.units:
+    return "{0} [{1}]".format(cv.name, cv.units)
+  else:
+    return "{0}".format(cv.name)
+
+
+def ParentArrows(windows, cv_list):
+  """
+  Returns an array with one row *(xp,yp,x,y)* for every window that has a parent,
+  going from the parent window to the window. For periodic CVs, the parent
+  is shifted by one period when the arrow would cross the whole range.
+
+  :param windows: The windows
+  :param cv_list: The two collective variables
+  :type windows: :class:`list` (:class:`~window.Window`)
+  :type cv_list: :class:`list` (:class:`~colvar.CollectiveVariable`)
+  """
+  p1 = cv_list[0].periodicity
+  p2 = cv_list[1].periodicity
+  arrows = []
+  for w in windows:
+    if not w.parent:
+      continue
+    x, y = w.cv_values[0], w.cv_values[1]
+    xp, yp = w.parent.cv_values[0], w.parent.cv_values[1]
+    if p1 and x - xp > p1 / 2.:
+      xp += p1
+    if p1 and x - xp < -p1 / 2.:
+      xp -= p1
+    if p2 and y - yp > p2 / 2.:
+      yp += p2
+    if p2 and y - yp < -p2 / 2.:
+      yp -= p2
+    arrows.append((xp, yp, x, y))
+  return npy.array(arrows, dtype=float).reshape([-1, 4])
+
+
+def PlotPMFSnapshot(snapshot, outputdir, filename):
+  """
+  Plot a PMF from a snapshot. The snapshot is a dictionary with keys *points*, *values*,
+  *cv_list*, *max_E*, *n_levels*, *arrows* (see :func:`ParentArrows`), *energy_units*,
+  *title*, *xlim* and *ylim*. This is what :meth:`~pmf.PMF.Plot` uses to render the PMF.
+
+  :param snapshot: The snapshot of the PMF
+  :param outputdir: Output directory to which the plot is saved
+  :param filename: name of the file to which the plot is saved
+  :type snapshot: :class:`dict`
+  :type outputdir: :class:`str`
+  :type filename: :class:`str`
+  """
+  import matplotlib.pyplot as plt
+  cv_list = snapshot["cv_list"]
+  max_E = snapshot["max_E"]
+  n_levels = snapshot["n_levels"]
+  if len(cv_list) == 2:
+    points = snapshot["points"]
+    X = points[:, 0]
+    Y = points[:, 1]
+    Z = npy.array(snapshot["values"])
+    if max_E:
+      Z = npy.minimum(Z, max_E)
+    num_pads = max([cv_list[0].num_pads, cv_list[1].num_pads])
+    nb_x = cv_list[0].wham_num_bins + 2 * num_pads
+    nb_y = cv_list[1].wham_num_bins + 2 * num_pads
+    X = X.reshape([nb_x, nb_y])
+    Y = Y.reshape([nb_x, nb_y])
+    Z = Z.reshape([nb_x, nb_y])
+    plt.figure()
+    plt.contourf(X, Y, Z, n_levels)
+    plt.colorbar(label=snapshot["energy_units"])
+    plt.contour(X, Y, Z, n_levels, colors="k")
+    plt.xlabel(_AxisLabel(cv_list[0]))
+    plt.ylabel(_AxisLabel(cv_list[1]))
+    arrows = snapshot["arrows"]
+    if arrows is not None and len(arrows) > 0:
+      # One quiver for all the windows is much faster than one annotation per window
+      plt.quiver(arrows[:, 0], arrows[:, 1], arrows[:, 2] - arrows[:, 0], arrows[:, 3] - arrows[:, 1],
+                 angles="xy", scale_units="xy", scale=1, color="k", width=0.003, headwidth=4)
+    if snapshot["xlim"]:
+      plt.xlim(snapshot["xlim"])
+    if snapshot["ylim"]:
+      plt.ylim(snapshot["ylim"])
+  elif len(cv_list) == 1:
+    plt.figure()
+    plt.plot(snapshot["points"], snapshot["values"])
+    if max_E:
+      plt.ylim([0, max_E])
+    plt.xlabel(_AxisLabel(cv_list[0]))
+    plt.ylabel("Free Energy")
+    if snapshot["xlim"]:
+      plt.xlim(snapshot["xlim"])
+  if snapshot["title"]:
+    plt.title(snapshot["title"])
+  plt.savefig(os.path.join(outputdir, filename))
+  plt.close()
+
+
+def ReadHistogramData(datafiles, dimensionality):
+  """
+  Read the values of the CVs from a list of datafiles. Each element of *datafiles*
+  is a tuple *(path, n_lines)* and only the first *n_lines* lines of the file are read,
+  so that data appended to the file after the snapshot was taken is ignored.
+
+  :param datafiles: The datafiles and number of lines to read from each of them.
+  :param dimensionality: Number of CVs
+  :type datafiles: :class:`list` (:class:`tuple`)
+  :type dimensionality: :class:`int`
+  """
+  data_format = ColvarFormat()
+  data = [npy.zeros([dimensionality, 0])]
+  for path, n_lines in datafiles:
+    try:
+      data.append(data_format.Read(path, dimensionality, n_lines)[1])
+    except IOError:
+      # The datafile of the window was removed (e.g. rewritten by *System.UpdateDataFiles*) meanwhile
+      continue
+  return npy.concatenate(data, axis=1)
+
+
+def PlotHistogramSnapshot(snapshot, outputdir, filename):
+  """
+  Plot the histogram of the accumulated data from a snapshot. The snapshot is a dictionary
+  with keys *datafiles* (see :func:`ReadHistogramData`), *cv_list* and *title*.
+  For more than two CVs, the histogram of the first two CVs is plotted.
+
+  :param snapshot: The snapshot of the histogram
+  :param outputdir: Output directory to which the plot is saved
+  :param filename: name of the file to which the plot is saved
+  :type snapshot: :class:`dict`
+  :type outputdir: :class:`str`
+  :type filename: :class:`str`
+  """
+  import matplotlib.pyplot as plt
+  cv_list = snapshot["cv_list"]
+  data = ReadHistogramData(snapshot["datafiles"], len(cv_list))
+  hist_range = [(cv.min_value, cv.max_value) for cv in cv_list]
+  plt.figure()
+  if len(cv_list) >= 2:
+    bins = [cv_list[0].num_bins, cv_list[1].num_bins]
+    plt.hist2d(data[0], data[1], range=hist_range[:2], bins=bins)
+    plt.xlabel(_AxisLabel(cv_list[0]))
+    plt.ylabel(_AxisLabel(cv_list[1]))
+    plt.colorbar()
+  elif len(cv_list) == 1:
+    plt.hist(data[0], bins=cv_list[0].num_bins, range=hist_range[0])
+    plt.xlabel(_AxisLabel(cv_list[0]))
+    plt.ylabel("Count")
+  plt.title(snapshot["title"])
+  plt.savefig(os.path.join(outputdir, filename))
+  plt.close()
+
+
+_RENDERERS = {"pmf": PlotPMFSnapshot, "histogram": PlotHistogramSnapshot}
+
+
+def _PlotWorkerLoop(queue, min_interval):
+  """
+  Main loop of the plotting process. Requests that accumulate while a plot is being rendered
+  (or while waiting for *min_interval*) are coalesced: for each kind of plot and output directory only
+  the most recent request is rendered. A *None* request renders what is pending and stops the loop.
+  """
+  pending = {}
+  order = []
+  stop = False
+  last_render = 0.0
+  while not stop:
+    if not pending:
+      item = queue.get()
+    else:
+      timeout = max(min_interval - (time.time() - last_render), 0.0)
+      try:
+        item = queue.get(timeout=timeout) if timeout > 0 else queue.get_nowait()
+      except Queue.Empty:
+        item = False
+    while item is not False:
+      if item is None:
+        stop = True
+      else:
+        kind, snapshot, outputdir, filename = item
+        key = (kind, outputdir)
+        if key not in pending:
+          order.append(key)
+        pending[key] = (kind, snapshot, outputdir, filename)
+      try:
+        item = queue.get_nowait()
+      except Queue.Empty:
+        item = False
+    if not stop and time.time() - last_render < min_interval:
+      continue
+    for key in order:
+      kind, snapshot, outputdir, filename = pending[key]
+      try:
+        _RENDERERS[kind](snapshot, outputdir, filename)
+      except Exception as e:
+        logging.error("Could not render {0}: {1}".format(
+            os.path.join(outputdir, filename), e))
+    pending = {}
+    order = []
+    last_render = time.time()
+
+
+class PlotWorker():
+  """
+  This class represents a background process rendering the plots of the PMF and of the histogram.
+  Plots are requested by sending a snapshot of the data to the process through a queue, so that
+  the supervisor does not wait on figure rendering. Requests are coalesced (only the latest request
+  of each kind is rendered when several are waiting) and rendering is rate-limited to once every
+  *min_interval* seconds. The worker is attached to a :class:`~system.System` as *system.plot_worker*,
+  in which case *System.PlotPMF* and *System.PlotHistogram* send their snapshots to it.
+  """
+
+  def __repr__(self):
+    return "PlotWorker({0})".format(self.min_interval)
+
+  def __init__(self, min_interval=0.0):
+    """
+    :param min_interval: Minimal time (in seconds) between two rendering rounds.
+    :type min_interval: :class:`float`
+    """
+    self.min_interval = min_interval
+    self.queue = None
+    self.process = None
+
+  def Start(self):
+    """
+    Start the plotting process.
+    """
+    self.queue = multiprocessing.Queue()
+    self.process = multiprocessing.Process(
+        target=_PlotWorkerLoop, args=(self.queue, self.min_interval))
+    self.process.daemon = True
+    self.process.start()
+
+  def IsRunning(self):
+    return self.process is not None and self.process.is_alive()
+
+  def Submit(self, kind, snapshot, outputdir, filename):
+    """
+    Request a plot. This returns immediately.
+
+    :param kind: Either *pmf* or *histogram*
+    :param snapshot: The snapshot of the data (see :func:`PlotPMFSnapshot` and :func:`PlotHistogramSnapshot`)
+    :param outputdir: Output directory to which the plot is saved
+    :param filename: name of the file to which the plot is saved
+    :type kind: :class:`str`
+    :type snapshot: :class:`dict`
+    :type outputdir: :class:`str`
+    :type filename: :class:`str`
+    """
+    if kind not in _RENDERERS:
+      raise ValueError("Unknown kind of plot {0}".format(kind))
+    self.queue.put((kind, snapshot, outputdir, filename))
+
+  def Stop(self, timeout=None):
+    """
+    Render the pending plots and stop the plotting process.
+
+    :param timeout: Maximal time (in seconds) to wait for the process to finish.
+    :type timeout: :class:`float`
+    """
+    if self.process is None:
+      return
+    self.queue.put(None)
+    self.process.join(timeout)
+    if self.process.is_alive():
+      logging.error("Plotting process did not finish in time, terminating it.")
+      self.process.terminate()
+    self.process = None
+    self.queue = None
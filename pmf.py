@@ -1,13 +1,14 @@
 """
 .. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
 
-This file contains the :class:`PMF` class.
+This file contains the :class:`PMF` class and the :class:`SparsePMF` class used for more than two CVs
+and for multi-resolution grids.
 """
 import os
-import scipy.interpolate
-import matplotlib.pyplot as plt
 import numpy as npy
 import logging
+import plotting
+from wham import BinGrid, kB
 
 
 class PMF():
@@ -29,11 +30,27 @@ class PMF():
     self.cv_list = cv_list
     self.dimensionality = len(self.cv_list)
     self.max_E = max_E
+
+  def __getattr__(self, name):
+    # The interpolator is only built (and scipy imported) the first time it is used
+    if name == "interpolator":
+      self.interpolator = self._BuildInterpolator()
+      return self.interpolator
+    raise AttributeError(name)
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    # The interpolator is rebuilt when needed, which avoids importing scipy when loading a system
+    state.pop("interpolator", None)
+    return state
+
+  def _BuildInterpolator(self):
+    import scipy.interpolate
     if self.dimensionality == 1:
-      self.interpolator = scipy.interpolate.InterpolatedUnivariateSpline(
+      return scipy.interpolate.InterpolatedUnivariateSpline(
           self.points, self.values)
     else:
-      self.interpolator = scipy.interpolate.interpnd.LinearNDInterpolator(
+      return scipy.interpolate.interpnd.LinearNDInterpolator(
           self.points, self.values)
 
   def GetValue(self, point):
@@ -44,14 +61,27 @@ class PMF():
     """
     return float(self.interpolator(tuple(point)))
 
+  def GetValues(self, points):
+    """
+    Free energy at many positions on the free energy surface, evaluated
+    with a single call to the interpolator.
+
+    :param points: values of the CVs, one row per point.
+    :type points: :class:`numpy.array`
+    """
+    points = npy.array(points, dtype=float)
+    if self.dimensionality == 1:
+      return npy.array(self.interpolator(points.ravel()), dtype=float).ravel()
+    return npy.array(self.interpolator(points.reshape([-1, self.dimensionality])), dtype=float).ravel()
+
   def GetCurvatures(self, point, steps):
-    curvatures = []
-    for i in range(self.dimensionality):
-      step = npy.zeros(self.dimensionality)
-      step[i] = steps[i]
-      curvatures.append((self.GetValue(point + step) + self.GetValue(point -
-                                                                     step) - 2 * self.GetValue(point)) / (steps[i] * steps[i]))
-    return curvatures
+    # The point and its neighbors along each CV are interpolated at once
+    d = self.dimensionality
+    steps = npy.array(steps, dtype=float)
+    shifts = npy.diag(steps)
+    point = npy.array(point, dtype=float)
+    E = self.GetValues(npy.vstack([point, point + shifts, point - shifts]))
+    return [float(el) for el in (E[1:d + 1] + E[d + 1:] - 2 * E[0]) / (steps * steps)]
     """
     curvatures=[self.GetValue(point+steps)+self.GetValue(point-steps)-2*self.GetValue(point)]
     if self.dimensionality==1:
@@ -64,6 +94,23 @@ class PMF():
       return 0.5*(k1+k2)
     """
 
+  def GetPlotSnapshot(self, n_levels=None, max_E=None, windows=None, energy_units="", title="", xlim=None, ylim=None):
+    """
+    Snapshot of the PMF used for plotting, see :func:`~plotting.PlotPMFSnapshot`. The snapshot
+    only contains copies of the data, so that it can be rendered in another process.
+    The parameters are the same as for *Plot*.
+    """
+    if not max_E:
+      max_E = self.max_E
+    if not n_levels:
+      n_levels = int(max_E)
+    arrows = None
+    if windows and self.dimensionality == 2:
+      arrows = plotting.ParentArrows(windows, self.cv_list)
+    return {"points": npy.array(self.points, dtype=float), "values": npy.array(self.values, dtype=float),
+            "cv_list": self.cv_list, "max_E": max_E, "n_levels": n_levels, "arrows": arrows,
+            "energy_units": energy_units, "title": title, "xlim": xlim, "ylim": ylim}
+
   def Plot(self, outputdir, filename, n_levels=None, max_E=None, windows=None, energy_units="", title="", xlim=None, ylim=None):
     """
     Plot the PMF.
@@ -78,78 +125,147 @@ class PMF():
     if self.dimensionality not in [1, 2]:
       logging.info("can only plot PMF for 1 or 2 dimensional systems")
       return
+    plotting.PlotPMFSnapshot(self.GetPlotSnapshot(n_levels, max_E, windows, energy_units, title, xlim, ylim),
+                             outputdir, filename)
+
+
+class SparsePMF(PMF):
+  """
+  PMF stored only on the bins of the histogram that contain data (see :class:`~wham.BinGrid`), as calculated by
+  :func:`~wham.SparseWham`. For more than two CVs only a small part of the histogram is sampled, so that memory and time
+  scale with the sampled volume rather than with the volume of the histogram. The bins are kept sorted by code
+  (their flat index for a :class:`~wham.BinGrid`), with their center (*points*), free energy (*values*) and number of
+  samples (*counts*). The histogram can also be a multi-resolution :class:`~wham.AdaptiveGrid`.
+  The PMF is interpolated multilinearly between the centers of the neighboring bins, using only the bins that contain data,
+  and is *nan* where none of the neighboring bins contains data.
+  """
+
+  def __repr__(self):
+    return "SparsePMF({0} bins,{1})".format(len(self.codes), self.cv_list)
+
+  def __init__(self, points, values, counts, cv_list, max_E, temperature, grid=None):
+    """
+    :param points: Values of the CVs at the centers of the bins, one row per bin.
+    :param values: Free energy of each bin
+    :param counts: Number of samples in each bin
+    :param cv_list: List of the CVs
+    :param max_E: Maximal free energy
+    :param temperature: The temperature, used to project the PMF on fewer CVs.
+    :param grid: The histogram. By default the :class:`~wham.BinGrid` of the CVs.
+    :type points: :class:`numpy.array`
+    :type values: :class:`numpy.array`
+    :type counts: :class:`numpy.array`
+    :type cv_list: :class:`list` (:class:`~other.CollectiveVariable`)
+    :type max_E: :class:`float`
+    :type temperature: :class:`float`
+    :type grid: :class:`~wham.BinGrid` or :class:`~wham.AdaptiveGrid`
+    """
+    PMF.__init__(self, points, values, cv_list, max_E)
+    self.temperature = temperature
+    if grid is None:
+      grid = BinGrid(cv_list)
+    self.grid = grid
+    points = npy.array(points, dtype=float).reshape([-1, self.dimensionality])
+    codes = self.grid.GetCodes(points)
+    order = npy.argsort(codes)
+    self.codes = codes[order]
+    self.points = points[order]
+    self.values = npy.array(self.values, dtype=float)[order]
+    self.counts = npy.array(counts, dtype=float)[order]
+
+  def _BuildInterpolator(self):
+    return self.Interpolate
+
+  def Interpolate(self, points):
+    """
+    Free energy at the given points (one row per point), interpolated multilinearly between the centers of
+    the bins that contain data.
+    """
+    x = npy.array(points, dtype=float).reshape([-1, self.dimensionality])
+    num = npy.zeros(len(x))
+    den = npy.zeros(len(x))
+    if len(self.codes):
+      corner_codes, weights = self.grid.GetCornerCodes(x)
+      for flat, w in zip(corner_codes, weights):
+        pos = npy.minimum(npy.searchsorted(self.codes, flat), len(self.codes) - 1)
+        found = (flat >= 0) & (self.codes[pos] == flat) & (w > 0)
+        num[found] += w[found] * self.values[pos[found]]
+        den[found] += w[found]
+    out = npy.full(len(x), npy.nan)
+    ok = den > 0
+    out[ok] = num[ok] / den[ok]
+    return out
+
+  def Project(self, cv_indices=(0, 1)):
+    """
+    Marginal PMF on the CVs with indices *cv_indices*, *-kT ln(sum exp(-F/kT))* summed over the bins along the other CVs.
+    Returns a dense array with one axis per selected CV, with *nan* for the bins without data.
+    The bins of a multi-resolution grid are summed into the bins of level 0, weighted by their volume.
+
+    :param cv_indices: Indices of the CVs on which to project
+    :type cv_indices: :class:`tuple` (:class:`int`)
+    """
+    kT = kB * self.temperature
+    cv_indices = list(cv_indices)
+    shape = tuple(self.grid.num_bins[cv_indices])
+    idx = self.grid.GetBaseIndices(self.codes)
+    flat = npy.ravel_multi_index(tuple(idx[:, cv_indices].T), shape)
+    a = -self.values / kT + npy.log(self.grid.GetBinVolumes(self.codes))
+    m = npy.full(int(npy.prod(shape)), -npy.inf)
+    npy.maximum.at(m, flat, a)
+    s = npy.zeros(len(m))
+    npy.add.at(s, flat, npy.exp(a - m[flat]))
+    out = npy.full(len(m), npy.nan)
+    sampled = s > 0
+    out[sampled] = -kT * (m[sampled] + npy.log(s[sampled]))
+    out -= npy.nanmin(out) if npy.any(sampled) else 0.0
+    return out.reshape(shape)
+
+  def GetPlotSnapshot(self, n_levels=None, max_E=None, windows=None, energy_units="", title="", xlim=None, ylim=None):
+    """
+    Snapshot of the projection of the PMF on the first two CVs (see *Project*), in the format of the snapshots of 2D PMFs
+    (see :func:`~plotting.PlotPMFSnapshot`). For one CV, the snapshot contains the bins with data, sorted by value of the CV.
+    The parameters are the same as for *Plot*.
+    """
     if not max_E:
       max_E = self.max_E
     if not n_levels:
       n_levels = int(max_E)
-    if self.dimensionality == 2:
-      X = self.points[:, 0]
-      Y = self.points[:, 1]
-      Z = self.values
-      if max_E:
-        Z = npy.array([min(el, max_E) for el in Z])
-      num_pads = max([self.cv_list[0].num_pads, self.cv_list[1].num_pads])
-      nb_x = self.cv_list[0].wham_num_bins + 2 * num_pads
-      nb_y = self.cv_list[1].wham_num_bins + 2 * num_pads
-      X = X.reshape([nb_x, nb_y])
-      Y = Y.reshape([nb_x, nb_y])
-      Z = Z.reshape([nb_x, nb_y])
-      plt.figure()
-      plt.contourf(X, Y, Z, n_levels)
-      plt.colorbar(label=energy_units)
-      plt.contour(X, Y, Z, n_levels, colors="k")
-      if self.cv_list[0].units:
-        plt.xlabel("{0} [{1}]".format(
-            self.cv_list[0].name, self.cv_list[0].units))
-      else:
-        plt.xlabel("{0}".format(self.cv_list[0].name))
-      if self.cv_list[1].units:
-        plt.ylabel("{0} [{1}]".format(
-            self.cv_list[1].name, self.cv_list[1].units))
-      else:
-        plt.ylabel("{0}".format(self.cv_list[1].name))
-      if windows:
-        p1 = self.cv_list[0].periodicity
-        p2 = self.cv_list[1].periodicity
-        if not p1:
-          p1 = 0
-        if not p2:
-          p2 = 0
-        for w in windows:
-          if w.parent:
-            p = w.parent
-            x = w.cv_values[0]
-            y = w.cv_values[1]
-            xp = p.cv_values[0]
-            yp = p.cv_values[1]
-            if p1 and x - xp > p1 / 2.:
-              xp += p1
-            if p1 and x - xp < -p1 / 2.:
-              xp -= p1
-            if p2 and y - yp > p2 / 2.:
-              yp += p2
-            if p2 and y - yp < -p2 / 2.:
-              yp -= p2
-            plt.annotate("", xy=(x, y), xytext=(xp, yp), arrowprops=dict(
-                facecolor="k", width=0.5, frac=0.2, headwidth=4), annotation_clip=False)
-      if xlim:
-        plt.xlim(xlim)
-      if ylim:
-        plt.ylim(ylim)
-    elif self.dimensionality == 1:
-      plt.figure()
-      plt.plot(self.points, self.values)
-      if max_E:
-        plt.ylim([0, max_E])
-      if self.cv_list[0].units:
-        plt.xlabel("{0} [{1}]".format(
-            self.cv_list[0].name, self.cv_list[0].units))
-      else:
-        plt.xlabel("{0}".format(self.cv_list[0].name))
-      plt.ylabel("Free Energy")
-      if xlim:
-        plt.xlim(xlim)
-    if title:
-      plt.title(title)
-    plt.savefig(os.path.join(outputdir, filename))
-    plt.close()
+    if self.dimensionality == 1:
+      order = npy.argsort(self.points[:, 0])
+      return {"points": self.points[order, 0], "values": npy.minimum(self.values[order], max_E),
+              "cv_list": self.cv_list, "max_E": max_E, "n_levels": n_levels, "arrows": None,
+              "energy_units": energy_units, "title": title, "xlim": xlim, "ylim": ylim}
+    cv_list = self.cv_list[:2]
+    projection = self.Project((0, 1))
+    num_pads = max([cv.num_pads for cv in cv_list])
+    axes = []
+    for i, cv in enumerate(cv_list):
+      n = self.grid.num_bins[i]
+      bins = npy.arange(-num_pads, n + num_pads)
+      centers = self.grid.mins[i] + (bins + 0.5) * self.grid.widths[i]
+      if cv.periodicity:
+        bins = bins % n
+      axes.append((centers, bins, (bins >= 0) & (bins < n)))
+    X, Y = npy.meshgrid(axes[0][0], axes[1][0], indexing="ij")
+    Z = npy.full(X.shape, max_E)
+    valid = npy.outer(axes[0][2], axes[1][2])
+    Z[valid] = projection[npy.ix_(axes[0][1][axes[0][2]], axes[1][1][axes[1][2]])].ravel()
+    Z[npy.isnan(Z)] = max_E
+    arrows = None
+    if windows:
+      arrows = plotting.ParentArrows(windows, cv_list)
+    if self.dimensionality > 2:
+      if title:
+        title += " "
+      title += "(projection on {0} and {1})".format(cv_list[0].name, cv_list[1].name)
+    return {"points": npy.column_stack([X.ravel(), Y.ravel()]), "values": Z.ravel(),
+            "cv_list": cv_list, "max_E": max_E, "n_levels": n_levels, "arrows": arrows,
+            "energy_units": energy_units, "title": title, "xlim": xlim, "ylim": ylim}
+
+  def Plot(self, outputdir, filename, n_levels=None, max_E=None, windows=None, energy_units="", title="", xlim=None, ylim=None):
+    """
+    Plot the PMF, projected on the first two CVs for more than two CVs. The parameters are the same as for :meth:`PMF.Plot`.
+    """
+    plotting.PlotPMFSnapshot(self.GetPlotSnapshot(n_levels, max_E, windows, energy_units, title, xlim, ylim),
+                             outputdir, filename)
@@ -0,0 +1,174 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+This module contains the :class:`JobDurations` class, which keeps statistics of the queue wait and run times
+and of the throughput of the jobs of a system, and the :class:`PollSchedule` class, which uses them to decide how long the supervising
+process sleeps between two cycles.
+"""
+import time
+import logging
+
+__all__ = ('JobDurations', 'PollSchedule')
+
+
+class JobDurations():
+  """
+  Statistics of the time the jobs of a system waited in the queue and ran, and of the number of MD steps they ran
+  per second, for each type of phase ("initialization" or "run"). They are saved with the :class:`~system.System`
+  and used to predict when the unfinished jobs will finish (see *PredictCompletion*), to choose the number of steps
+  of new phases (see :class:`~sizing.PhaseSizing`), to estimate the wall time of packed phases
+  (see :class:`~packing.JobPacker`) and for the summaries of the Prometheus file (see :class:`~metrics.MetricsRecorder`).
+  """
+
+  def __repr__(self):
+    return "JobDurations({0})".format(self.stats)
+
+  def __init__(self):
+    self.stats = {}
+
+  def Record(self, job):
+    """
+    Record the queue wait and run times of a finished job (see *Job.GetEstimatedQueueWaitAndRunTime*), and
+    the number of MD steps of its phase. The run time of crashed jobs is not recorded, as they usually stop early.
+
+    :param job: The finished job
+    :type job: :class:`~job.Job`
+    """
+    queue_wait, run_time = job.GetEstimatedQueueWaitAndRunTime()
+    stats = self.stats.setdefault(job.phase.type, {"queue_wait_sum": 0.0, "queue_wait_count": 0,
+                                                   "run_time_sum": 0.0, "run_time_count": 0})
+    if queue_wait is not None:
+      stats["queue_wait_sum"] += queue_wait
+      stats["queue_wait_count"] += 1
+    if run_time is not None and job.success:
+      stats["run_time_sum"] += run_time
+      stats["run_time_count"] += 1
+      nstep = getattr(job.phase, "nstep", None)
+      if nstep and run_time > 0:
+        stats["steps_sum"] = stats.get("steps_sum", 0) + nstep
+        stats["steps_time_sum"] = stats.get("steps_time_sum", 0.0) + run_time
+
+  def GetMeanQueueWait(self, phase_type):
+    """
+    Mean time (in seconds) the jobs of phases of type *phase_type* waited in the queue, *None* if it is not known.
+    """
+    stats = self.stats.get(phase_type)
+    if not stats or stats["queue_wait_count"] == 0:
+      return None
+    return stats["queue_wait_sum"] / stats["queue_wait_count"]
+
+  def GetMeanRunTime(self, phase_type):
+    """
+    Mean time (in seconds) the jobs of phases of type *phase_type* ran, *None* if it is not known.
+    If the environment never reported the jobs as running, this is the time from submission to completion.
+    """
+    stats = self.stats.get(phase_type)
+    if not stats or stats["run_time_count"] == 0:
+      return None
+    return stats["run_time_sum"] / stats["run_time_count"]
+
+  def GetThroughput(self, phase_type):
+    """
+    Number of MD steps per second of wall time of the phases of type *phase_type*, *None* if it is not known.
+    It includes the overhead of the jobs (e.g. starting the MD engine), and if the environment never reported
+    the jobs as running, their time in the queue.
+    """
+    stats = self.stats.get(phase_type)
+    if not stats or not stats.get("steps_time_sum"):
+      return None
+    return stats["steps_sum"] / stats["steps_time_sum"]
+
+  def PredictCompletion(self, job):
+    """
+    Predict the time (as given by *time.time*) at which an unfinished job will finish, from the time it
+    started running, or if it is still in the queue, from the time it was submitted and the mean queue wait.
+    The run time is the number of steps of the phase divided by the throughput if both are known, else the mean run time.
+    Returns *None* if no job of the same type finished yet.
+
+    :param job: The unfinished job
+    :type job: :class:`~job.Job`
+    """
+    run_time = self.GetMeanRunTime(job.phase.type)
+    throughput = self.GetThroughput(job.phase.type)
+    if throughput and getattr(job.phase, "nstep", None):
+      run_time = job.phase.nstep / throughput
+    if run_time is None or getattr(job, "submit_time", None) is None:
+      return None
+    start_time = getattr(job, "start_time", None)
+    if start_time is not None:
+      return start_time + run_time
+    queue_wait = self.GetMeanQueueWait(job.phase.type) or 0.0
+    return job.submit_time + queue_wait + run_time
+
+
+class PollSchedule():
+  """
+  Polling schedule of the supervising process (see *SiPMF.Run* and *MultiSiPMF.Run*). Instead of sleeping for a
+  fixed time, the process sleeps until the earliest predicted completion of the unfinished jobs
+  (see *JobDurations.PredictCompletion*), but at least *min_sleep_length* and at most *max_sleep_length* seconds.
+  The queue is thus polled often when jobs are about to finish and rarely otherwise.
+
+  Jobs that are late on their prediction are expected to finish after a delay proportional to how late
+  they are (*backoff* times the delay), so that a job running much longer than the others does not keep
+  the process polling at the shortest interval.
+  """
+
+  def __repr__(self):
+    return "PollSchedule({0},{1},{2})".format(self.min_sleep_length, self.max_sleep_length, self.backoff)
+
+  def __init__(self, min_sleep_length, max_sleep_length, backoff=0.5):
+    """
+    :param min_sleep_length: Minimal time (in seconds) between two cycles.
+    :param max_sleep_length: Maximal time (in seconds) between two cycles, also used when no completion
+     can be predicted.
+    :param backoff: Fraction of the delay of a late job after which it is expected to finish.
+    :type min_sleep_length: :class:`float`
+    :type max_sleep_length: :class:`float`
+    :type backoff: :class:`float`
+    """
+    if min_sleep_length > max_sleep_length:
+      logging.error("The minimal sleep length cannot be larger than the maximal sleep length")
+      raise ValueError("The minimal sleep length cannot be larger than the maximal sleep length")
+    self.min_sleep_length = min_sleep_length
+    self.max_sleep_length = max_sleep_length
+    self.backoff = backoff
+
+  def GetNextCompletion(self, systems, now=None):
+    """
+    Earliest predicted completion (as given by *time.time*) of the unfinished jobs of the systems,
+    *None* if it cannot be predicted.
+
+    :param systems: The supervised systems
+    :param now: The current time, by default *time.time()*
+    :type systems: :class:`list` (:class:`~system.System`)
+    :type now: :class:`float`
+    """
+    if now is None:
+      now = time.time()
+    earliest = None
+    for system in systems:
+      for job in system.unfinished_jobs:
+        t = system.job_durations.PredictCompletion(job)
+        if t is None:
+          continue
+        if t < now:
+          t = now + self.backoff * (now - t)
+        if earliest is None or t < earliest:
+          earliest = t
+    return earliest
+
+  def GetSleepLength(self, systems, now=None):
+    """
+    Time (in seconds) to sleep before the next cycle.
+
+    :param systems: The supervised systems
+    :param now: The current time, by default *time.time()*
+    :type systems: :class:`list` (:class:`~system.System`)
+    :type now: :class:`float`
+    """
+    if now is None:
+      now = time.time()
+    earliest = self.GetNextCompletion(systems, now)
+    if earliest is None:
+      return self.max_sleep_length
+    return min(max(earliest - now, self.min_sleep_length), self.max_sleep_length)
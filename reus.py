@@ -0,0 +1,405 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+This module contains the :class:`ReplicaExchange` class, which samples neighboring windows together
+with replica-exchange umbrella sampling (REUS), and the :class:`ReplicaExchangeBlock` class representing
+one group of windows simulated in a single multi-replica job, as well as the functions mapping the samples
+of the windows to the frames of the trajectories of the replicas.
+"""
+import os
+import logging
+import numpy as npy
+from metrics import Timer
+from colvars import ReadTable, WriteTable
+
+__all__ = ('ReplicaExchange', 'ReplicaExchangeBlock', 'ReadReplicaDataFile', 'FindReplicaFrame')
+
+# Extension of the raw datafile of a replica, kept in the directory of its phase
+REPLICA_EXTENSION = ".replica"
+# Extension of the file giving, for each line of a demultiplexed datafile, the replica and the line of its raw datafile
+FRAMES_EXTENSION = ".frames"
+
+
+class ReplicaExchange():
+  """
+  Replica-exchange umbrella sampling mode. When set as *System.reus*, the windows that are ready for a new run
+  phase at the same time are grouped into exchange blocks of lattice-adjacent windows (see *System.GetNeighborWindows*),
+  with between *min_replicas* and *max_replicas* windows. Each block is simulated in a single job, one replica per window,
+  replicas exchanging their configurations. Every window still gets its own run phase (with its own directory,
+  input file and datafile), so that the bookkeeping and the calculation of the PMF are unchanged.
+  Windows that are not part of a block (e.g. windows that still have to be initialized) are submitted as usual.
+  As windows rarely need a new phase at the same time as their neighbors, idle neighboring windows (initialized windows
+  without running phases, including windows that already have enough data) are added to the blocks when *include_idle* is set,
+  so that each block samples a connected region of the lattice of windows. This improves the sampling of these regions
+  at the cost of running more phases, which is limited with *max_replicas*.
+
+  The multi-replica MD input is generated from the template *basedir/reus_input_fname*. The lines between a line
+  containing {REPLICA_BEGIN} and a line containing {REPLICA_END} are repeated for each replica, replacing the fields
+  of the run input of the phase of the corresponding window ({cvname}, {cvname_K}, {RESTARTDIR}, {OUTPUTDIR},
+  {RUN_NSTEP}, ...) as well as {REPLICA} (index of the replica) and {NEIGHBORS} (indices of the replicas of
+  the neighboring windows). In the rest of the template {BASEDIR}, {TEMPERATURE}, {RUN_NSTEP}, {BLOCK} (name of the block),
+  {OUTPUTDIR} (directory of the block), {NREPLICAS} and {EXCHANGE_PAIRS} (pairs of neighboring replicas, e.g. "0-1 1-2")
+  are replaced. The job file is generated in the same way from *basedir/reus_job_fname*, with {INPUTFILE} being the path
+  to the multi-replica input. Blocks are written to *basedir/reus*.
+
+  Replica *i* starts from the last phase of window *i* and has to write its datafile to the directory of the phase of window *i*,
+  with one additional column (by default the last one, see *window_column*) giving the index of the window in which it was when
+  the sample was recorded. When the job is finished, these datafiles are demultiplexed (see *ReplicaExchangeBlock.Demultiplex*),
+  so that the datafile of each phase contains the samples recorded in its window, and the files listed in *System.check_fnames*
+  (the restart files) are moved to the phase of the window in which the replica finished.
+
+  The trajectory in the directory of each phase remains that of the replica that started there, which also visited
+  other windows. It corresponds to the raw datafile of the replica, kept with a *.replica* extension
+  (see :func:`ReadReplicaDataFile`), which is the one used by the index of the CV samples (*System.UpdateCVIndex*).
+  For each line of the demultiplexed datafile of a phase, the replica and the line of its raw datafile are written
+  to the datafile with a *.frames* extension (see :func:`FindReplicaFrame`).
+  """
+
+  def __repr__(self):
+    return "ReplicaExchange({0},{1},{2},{3},{4})".format(self.reus_input_fname, self.reus_job_fname, self.max_replicas, self.min_replicas, self.include_idle)
+
+  def __init__(self, reus_input_fname, reus_job_fname, max_replicas=8, min_replicas=2, window_column=-1, include_idle=True):
+    """
+    :param reus_input_fname: *basedir/reus_input_fname* is the template of the multi-replica MD input file.
+    :param reus_job_fname: *basedir/reus_job_fname* is the template of the job file used to submit the blocks.
+    :param max_replicas: Maximal number of windows in an exchange block.
+    :param min_replicas: Minimal number of windows in an exchange block.
+    :param window_column: Column of the raw datafiles containing the index of the window of each sample.
+    :param include_idle: Whether idle neighboring windows are added to the blocks.
+    :type reus_input_fname: :class:`str`
+    :type reus_job_fname: :class:`str`
+    :type max_replicas: :class:`int`
+    :type min_replicas: :class:`int`
+    :type window_column: :class:`int`
+    :type include_idle: :class:`bool`
+    """
+    self.reus_input_fname = reus_input_fname
+    self.reus_job_fname = reus_job_fname
+    self.max_replicas = max_replicas
+    self.min_replicas = max(min_replicas, 2)
+    self.window_column = window_column
+    self.include_idle = include_idle
+    self.n_blocks = 0
+
+  def GroupWindows(self, system, windows, extra_windows=()):
+    """
+    Group windows into blocks of lattice-adjacent windows. Each block is grown from one of the *windows* by adding
+    neighbors (from *windows* and *extra_windows*) in breadth-first order, so that all blocks are connected on the
+    lattice of windows. Returns the list of blocks (lists of windows) with at least *min_replicas* windows.
+
+    :param system: The system
+    :param windows: The windows to group
+    :param extra_windows: Other windows that can be added to the blocks
+    :type system: :class:`~system.System`
+    :type windows: :class:`list` (:class:`~window.Window`)
+    :type extra_windows: :class:`list` (:class:`~window.Window`)
+    """
+    candidates = set(windows) | set(extra_windows)
+    neighbors = system.GetNeighborWindows(list(candidates))
+    assigned = set()
+    blocks = []
+    for seed in windows:
+      if seed in assigned:
+        continue
+      block = [seed]
+      assigned.add(seed)
+      i = 0
+      while i < len(block) and len(block) < self.max_replicas:
+        for n in neighbors[block[i]]:
+          if n in candidates and n not in assigned and len(block) < self.max_replicas:
+            block.append(n)
+            assigned.add(n)
+        i += 1
+      blocks.append(block)
+    return [b for b in blocks if len(b) >= self.min_replicas]
+
+  def Submit(self, system, environment, windows, max_windows=None):
+    """
+    Submit the next run phase of the windows that can be grouped into exchange blocks.
+    Returns the list of windows submitted in blocks (which can include idle windows not in *windows*),
+    the other windows have to be submitted as usual.
+
+    :param system: The system
+    :param environment: The environment used to submit the jobs
+    :param windows: The windows that need a new phase
+    :param max_windows: Maximal number of windows in all the blocks, including the idle windows. Blocks are
+     truncated (keeping the windows closest to their first window) or left out to stay within the limit.
+    :type system: :class:`~system.System`
+    :type environment: :class:`~environment.Environment`
+    :type windows: :class:`list` (:class:`~window.Window`)
+    :type max_windows: :class:`int`
+    """
+    ready = [w for w in windows if not w.is_new and w.phases]
+    idle = []
+    if self.include_idle and ready:
+      running_phases = set([job.phase for job in system.unfinished_jobs])
+      idle = [w for w in system.windows if w not in windows and not w.is_new and w.phases
+              and not any([p in running_phases for p in w.phases])]
+    blocks = self.GroupWindows(system, ready, idle)
+    if max_windows is not None:
+      capped = []
+      for block_windows in blocks:
+        block_windows = block_windows[:max_windows - sum([len(b) for b in capped])]
+        if len(block_windows) >= self.min_replicas:
+          capped.append(block_windows)
+      blocks = capped
+    if not blocks:
+      return []
+    reus_dir = os.path.join(system.basedir, "reus")
+    if not os.path.isdir(reus_dir):
+      os.mkdir(reus_dir)
+    submitted = []
+    for block_windows in blocks:
+      self.n_blocks += 1
+      name = "block{0}".format(self.n_blocks)
+      outdir = os.path.join(reus_dir, name)
+      if os.path.isdir(outdir):
+        logging.error(
+            "Directory already exists, program stops to avoid overwriting {0}.".format(outdir))
+        raise IOError(
+            "Directory already exists, program stops to avoid overwriting {0}.".format(outdir))
+      os.mkdir(outdir)
+      phases = [w.SubmitNextPhase(environment, submit=False) for w in block_windows]
+      block = ReplicaExchangeBlock(name, outdir, phases, self.window_column)
+      with Timer(system.metrics, "render"):
+        path_to_job_file = block.GenerateFiles(system, phases, self.reus_input_fname, self.reus_job_fname)
+      with Timer(system.metrics, "qsub"):
+        jid = environment.qsub(outdir, path_to_job_file)
+      for phase in phases:
+        phase.job.SubmitInBundle(jid)
+        phase.job.reus_block = block
+      logging.info("Submitted replica exchange {0} with {1} windows".format(
+          name, len(phases)))
+      submitted.extend(block_windows)
+    if system.metrics:
+      system.metrics.Count("reus_blocks_submitted", len(blocks))
+    return submitted
+
+
+class ReplicaExchangeBlock():
+  """
+  A group of windows simulated together in one replica-exchange job (see :class:`ReplicaExchange`).
+  Only the directories and datafiles of the phases are kept, so that the block does not link the phases
+  of different windows together.
+  """
+
+  def __repr__(self):
+    return "ReplicaExchangeBlock({0},{1})".format(self.name, self.outdirs)
+
+  def __init__(self, name, outdir, phases, window_column=-1):
+    """
+    :param name: Name of the block
+    :param outdir: Directory of the block
+    :param phases: The run phases of the windows of the block, replica *i* corresponding to *phases[i]*
+    :param window_column: Column of the raw datafiles containing the index of the window of each sample.
+    :type name: :class:`str`
+    :type outdir: :class:`str`
+    :type phases: :class:`list` (:class:`~phase.Phase`)
+    :type window_column: :class:`int`
+    """
+    self.name = name
+    self.outdir = outdir
+    self.outdirs = [p.outdir for p in phases]
+    self.datafiles = [p.path_to_datafile for p in phases]
+    self.phase_keys = [(p.window.name, p.name) for p in phases]
+    self.window_column = window_column
+    self.demultiplexed = False
+
+  def GetNeighborReplicas(self, system, phases):
+    windows = [p.window for p in phases]
+    neighbors = system.GetNeighborWindows(windows)
+    return [[j for j, w2 in enumerate(windows) if w2 in neighbors[w]] for w in windows]
+
+  def GenerateFiles(self, system, phases, reus_input_fname, reus_job_fname):
+    """
+    Generate the multi-replica MD input file and the job file of the block. Returns the path to the job file.
+    """
+    neighbors = self.GetNeighborReplicas(system, phases)
+    # All the replicas run the same number of steps
+    nstep = max([getattr(p, "nstep", None) or system.run_nstep for p in phases])
+    for phase in phases:
+      phase.nstep = nstep
+    pairs = " ".join(["{0}-{1}".format(i, j) for i, nl in enumerate(neighbors) for j in nl if j > i])
+    to_replace = {"{BASEDIR}": system.basedir,
+                  "{OUTPUTDIR}": self.outdir,
+                  "{TEMPERATURE}": system.temperature,
+                  "{RUN_NSTEP}": nstep,
+                  "{BLOCK}": self.name,
+                  "{NREPLICAS}": len(phases),
+                  "{EXCHANGE_PAIRS}": pairs}
+    f = open(os.path.join(system.basedir, reus_input_fname), "r")
+    lines = f.readlines()
+    f.close()
+    out = []
+    replica_lines = None
+    for line in lines:
+      if "{REPLICA_BEGIN}" in line:
+        replica_lines = []
+      elif "{REPLICA_END}" in line:
+        for i, phase in enumerate(phases):
+          r = phase.job.GetInputReplacementDict()
+          r.update(phase.job.GetRunInputReplacementDict())
+          r.update({"{REPLICA}": i, "{NEIGHBORS}": " ".join([str(j) for j in neighbors[i]])})
+          for l in replica_lines:
+            for key in r:
+              l = l.replace(key, str(r[key]))
+            out.append(l)
+        replica_lines = None
+      elif replica_lines is not None:
+        replica_lines.append(line)
+      else:
+        out.append(line)
+    self.path_to_input_file = os.path.join(self.outdir, reus_input_fname)
+    outf = open(self.path_to_input_file, "w")
+    outf.write(_Replace("".join(out), to_replace))
+    outf.close()
+    to_replace["{INPUTFILE}"] = self.path_to_input_file
+    f = open(os.path.join(system.basedir, reus_job_fname), "r")
+    data = f.read()
+    f.close()
+    self.path_to_job_file = os.path.join(self.outdir, reus_job_fname)
+    outf = open(self.path_to_job_file, "w")
+    outf.write(_Replace(data, to_replace))
+    outf.close()
+    return self.path_to_job_file
+
+  def Demultiplex(self, system):
+    """
+    Sort the samples written by the replicas into the datafiles of the phases of the windows in which they were
+    recorded, and move the restart files (*System.check_fnames*) of each replica to the phase of the window in which it finished.
+    The raw datafile of each replica is kept with a *.replica* extension, and the origin of each sample (index of the replica and
+    line of its raw datafile) is written next to the demultiplexed datafile with a *.frames* extension. This is only done once.
+
+    :param system: The system
+    :type system: :class:`~system.System`
+    """
+    if self.demultiplexed:
+      return
+    self.demultiplexed = True
+    n = len(self.outdirs)
+    samples = [[] for i in range(n)]
+    origins = [[] for i in range(n)]
+    final_window = [None for i in range(n)]
+    time_column = system.data_format.time_column
+    for k, datafile in enumerate(self.datafiles):
+      raw = datafile + REPLICA_EXTENSION
+      if not os.path.isfile(datafile):
+        logging.warning("Missing datafile for replica {0} of {1}: {2}".format(
+            k, self.name, datafile))
+        continue
+      os.rename(datafile, raw)
+      n_rows = 0
+      for table in ReadTable(raw, comments=system.data_format.comments, chunk_size=system.data_format.chunk_size):
+        if table.shape[1] < system.dimensionality + 2:
+          break
+        rows = npy.arange(n_rows, n_rows + len(table))
+        n_rows += len(table)
+        windows = npy.round(table[:, self.window_column]).astype(int)
+        window_column = self.window_column % table.shape[1]
+        table = npy.delete(table, window_column, axis=1)
+        time_column = system.data_format.time_column - (window_column < system.data_format.time_column)
+        valid = (windows >= 0) & (windows < n)
+        if not valid.any():
+          continue
+        for j in npy.unique(windows[valid]):
+          samples[j].append(table[windows == j])
+          origins[j].append(npy.column_stack([npy.repeat(k, len(samples[j][-1])), rows[windows == j]]))
+        final_window[k] = int(windows[valid][-1])
+    for j, datafile in enumerate(self.datafiles):
+      f = open(datafile, "w")
+      f_frames = open(datafile + FRAMES_EXTENSION, "w")
+      if samples[j]:
+        data = npy.concatenate(samples[j])
+        # At any time each window holds exactly one replica, so sorting by time gives its time series
+        order = npy.argsort(data[:, time_column], kind="mergesort")
+        WriteTable(f, data[order])
+        WriteTable(f_frames, npy.concatenate(origins[j])[order])
+      f.close()
+      f_frames.close()
+    if sorted(final_window) != range(n):
+      logging.warning("The replicas of {0} do not end in distinct windows, restart files are left in place".format(self.name))
+      return
+    # Move the restart files in two steps, as replicas may have swapped windows
+    for k, outdir in enumerate(self.outdirs):
+      for fname in system.check_fnames:
+        path = os.path.join(outdir, fname)
+        if os.path.isfile(path):
+          os.rename(path, path + ".reus{0}".format(k))
+    for k, outdir in enumerate(self.outdirs):
+      dest = self.outdirs[final_window[k]]
+      for fname in system.check_fnames:
+        path = os.path.join(outdir, fname + ".reus{0}".format(k))
+        if os.path.isfile(path):
+          os.rename(path, os.path.join(dest, fname))
+
+
+def _Replace(data, to_replace):
+  for key in to_replace:
+    data = data.replace(key, str(to_replace[key]))
+  return data
+
+
+def _GetBlock(phase):
+  return getattr(getattr(phase, "job", None), "reus_block", None)
+
+
+def ReadReplicaDataFile(system, phase):
+  """
+  Read the raw datafile of the replica whose trajectory is in the directory of *phase*, i.e. the values of the CVs
+  corresponding to the frames of that trajectory, rather than the samples recorded in the window of the phase.
+  Returns a tuple with the array of times and an array containing one row of values for each CV
+  (as *Phase.ReadDataFile*), or *None* if the phase was not sampled in a replica-exchange block.
+
+  :param system: The system
+  :param phase: The phase
+  :type system: :class:`~system.System`
+  :type phase: :class:`~phase.Phase`
+  """
+  block = _GetBlock(phase)
+  raw = phase.path_to_datafile + REPLICA_EXTENSION
+  if block is None or not os.path.isfile(raw):
+    return None
+  data_format = system.data_format
+  columns = data_format.GetColumns(system.dimensionality)
+  chunks = []
+  for table in ReadTable(raw, comments=data_format.comments, chunk_size=data_format.chunk_size):
+    if table.shape[1] < system.dimensionality + 2:
+      break
+    table = npy.delete(table, block.window_column % table.shape[1], axis=1)
+    chunks.append(table[:, columns])
+  if chunks:
+    data = npy.concatenate(chunks)
+  else:
+    data = npy.zeros([0, system.dimensionality + 1])
+  return data[:, 0], data[:, 1:].transpose()
+
+
+def FindReplicaFrame(system, phase, line=-1):
+  """
+  Find the trajectory frame corresponding to a line of the demultiplexed datafile of a phase sampled in a
+  replica-exchange block. The sample was recorded by a replica whose trajectory is in the directory of another phase
+  of the block. Returns a tuple with that phase and the frame of its trajectory (see *System.samples_per_frame*),
+  or *None* if the phase was not sampled in a replica-exchange block or if the line is not known.
+
+  :param system: The system
+  :param phase: The phase
+  :param line: Index of the line in the datafile of the phase, by default the last one
+  :type system: :class:`~system.System`
+  :type phase: :class:`~phase.Phase`
+  :type line: :class:`int`
+  """
+  block = _GetBlock(phase)
+  path = phase.path_to_datafile + FRAMES_EXTENSION
+  if block is None or not getattr(block, "phase_keys", None) or not os.path.isfile(path):
+    return None
+  chunks = list(ReadTable(path, [0, 1]))
+  if not chunks:
+    return None
+  origins = npy.concatenate(chunks).astype(int)
+  if not -len(origins) <= line < len(origins):
+    return None
+  k, row = origins[line]
+  replica_phase = system.FindPhaseByName(*block.phase_keys[k])
+  if replica_phase is None:
+    return None
+  return replica_phase, max(row - system.frame_offset, 0) // system.samples_per_frame
@@ -3,8 +3,15 @@
 
 This module contains the :class:`siPMF` class
 """
+import os
 import time
 import logging
+from plotting import PlotWorker
+from colvars import CompressionWorker
+from metrics import MetricsRecorder, Timer
+from throttle import SubmissionThrottle
+from polling import PollSchedule
+from environment import ListQueue, GetQueueStatusCache
 
 
 class SiPMF():
@@ -39,7 +46,8 @@ class SiPMF():
         continue
       self.system.updated_windows.append(w)
 
-  def Run(self, max_time, max_jobs, sleep_length, generate_new_windows=True):
+  def Run(self, max_time, max_jobs, sleep_length, generate_new_windows=True, background_plotting=False, plot_interval=0.0,
+          record_metrics=False, max_running_jobs=None, count_queue=False, min_sleep_length=None, compress_data=None):
     """
     Run the process to explore the free energy landscape. The process is an infinite loop in which
     it will sleep for some time, then when it wakes up it checks the status of the jobs in the queue.
@@ -56,31 +64,109 @@ class SiPMF():
     :param max_time: Maximal time (in seconds) the process will run for
     :param max_jobs: Maximal number of jobs the process will submit
     :param sleep_length: time (in seconds) the process will sleep between two cycles.
+    :param generate_new_windows: Whether new windows should be generated when all jobs are finished.
+    :param background_plotting: Render the plots of the PMF and histogram in a background
+     process (:class:`~plotting.PlotWorker`), so that the loop never waits on figure rendering.
+    :param plot_interval: Minimal time (in seconds) between two rendering rounds of the background process.
+     Plots requested in the meantime are coalesced and only the latest one is rendered.
+    :param record_metrics: Record the time spent in each part of every cycle, the job counts and the
+     queue wait and run times of the jobs (:class:`~metrics.MetricsRecorder`). They are appended to
+     *metrics.jsonl* and written in the Prometheus text format to *metrics.prom* in the base directory of the system.
+    :param max_running_jobs: Maximal number of jobs waiting in the queue or running at any time. Windows that need a job
+     while the limit is reached wait for a free slot, those with the lowest free energy first
+     (see :class:`~throttle.SubmissionThrottle`). By default there is no limit.
+    :param count_queue: Count the jobs waiting in the queue or running from the queuing system, including the jobs
+     of other processes, rather than from the jobs of the system. This requires a *qstat_all_command* in
+     the :class:`~environment.Environment`.
+    :param min_sleep_length: If set, the process sleeps until the earliest predicted completion of the running jobs,
+     from the queue wait and run times of the jobs that already finished (see :class:`~polling.PollSchedule`),
+     but at least *min_sleep_length* and at most *sleep_length* seconds.
+    :param compress_data: If set (*gz* or *zst*), the datafiles of the finished phases are compressed in a background
+     process once their data was added to the datafile of their window (see :class:`~colvars.CompressionWorker`).
+     Compressed datafiles are decompressed as a stream when they are read.
     :type max_time: :class:`int`
     :type max_jobs: :class:`int`
     :type sleep_length: :class:`int`
+    :type generate_new_windows: :class:`bool`
+    :type background_plotting: :class:`bool`
+    :type plot_interval: :class:`float`
+    :type record_metrics: :class:`bool`
+    :type max_running_jobs: :class:`int`
+    :type count_queue: :class:`bool`
+    :type min_sleep_length: :class:`float`
+    :type compress_data: :class:`str`
     """
+    if len(self.system.windows) == 0:
+      print "System does not contain any Window."
+      print "Make sure to initialize the system before running it."
+      return
+    if background_plotting:
+      plot_worker = PlotWorker(plot_interval)
+      plot_worker.Start()
+      self.system.plot_worker = plot_worker
+    if compress_data:
+      compression_worker = CompressionWorker(compress_data)
+      compression_worker.Start()
+      self.system.compression_worker = compression_worker
+    if record_metrics:
+      self.system.metrics = MetricsRecorder(os.path.join(self.system.basedir, "metrics.jsonl"),
+                                            os.path.join(self.system.basedir, "metrics.prom"),
+                                            os.path.basename(os.path.normpath(self.system.basedir)))
+    throttle = None
+    if max_running_jobs is not None:
+      throttle = SubmissionThrottle(max_running_jobs, count_queue)
+    schedule = None
+    if min_sleep_length is not None:
+      schedule = PollSchedule(min_sleep_length, sleep_length)
+    try:
+      self._Run(max_time, max_jobs, sleep_length, generate_new_windows, throttle, schedule)
+    finally:
+      self.system.metrics = None
+      if background_plotting:
+        self.system.plot_worker = None
+        logging.info("Waiting for the plotting process to finish.")
+        plot_worker.Stop()
+      if compress_data:
+        self.system.compression_worker = None
+        logging.info("Waiting for the compression process to finish.")
+        compression_worker.Stop()
+
+  def _SubmitNewJobs(self, throttle):
+    if not throttle:
+      return self.system.SubmitNewJobs(self.environment)
+    n_slots = throttle.GetFreeSlots([self.system])
+    if n_slots == 0:
+      return 0
+    throttle.Order(self.system)
+    nj = self.system.SubmitNewJobs(self.environment, n_slots)
+    throttle.RecordSubmitted(nj)
+    return nj
+
+  def _Run(self, max_time, max_jobs, sleep_length, generate_new_windows, throttle=None, schedule=None):
     njobs = 0
     n_running_jobs = 0
     n_finished_jobs = 0
     t0 = time.time()
     continue_flag = True
     submit_flag = True
-    if len(self.system.windows) == 0:
-      print "System does not contain any Window."
-      print "Make sure to initialize the system before running it."
-      return
     c = 0
     logging.info("Starting the calculation with max_time={0}s,max_jobs={1},sleep_length={2}s".format(
         max_time, max_jobs, sleep_length))
+    metrics = self.system.metrics
     while continue_flag:
       c += 1
+      if metrics:
+        metrics.StartCycle()
       save_flag = False
       continue_flag = False
       if njobs >= max_jobs or time.time() - t0 >= max_time:
         submit_flag = False
-      n_updated_windows, n_crashed_jobs = self.system.UpdateUnfinishedJobList(
-          self.environment)
+      with Timer(metrics, "poll"):
+        queue = ListQueue(self.environment)
+        if throttle:
+          throttle.StartCycle(queue)
+        n_updated_windows, n_crashed_jobs = self.system.UpdateUnfinishedJobList(
+            self.environment, GetQueueStatusCache(self.environment, self.system.unfinished_jobs, queue))
       n_finished_jobs = n_running_jobs - len(self.system.unfinished_jobs)
       if n_finished_jobs > 0:
         logging.info("{0} jobs finished among which {1} crashed".format(
@@ -89,7 +175,7 @@ class SiPMF():
       # If some windows finised during last sleep (or if there are new windows)
       # We submit new jobs
       if n_updated_windows > 0 and submit_flag:
-        nj = self.system.SubmitNewJobs(self.environment)
+        nj = self._SubmitNewJobs(throttle)
         njobs += nj
         n_running_jobs = len(self.system.unfinished_jobs)
         if nj > 0:
@@ -97,13 +183,15 @@ class SiPMF():
           logging.info("Submitted {0} new jobs, {1} jobs are running or in the queue".format(
               nj, n_running_jobs))
       # If there are no running jobs, this means all current windows are finished
-      # So we generate new windows
-      if n_running_jobs == 0:
+      # So we generate new windows, unless some windows are still waiting for a free job slot
+      waiting = throttle and len(self.system.updated_windows) > 0
+      if n_running_jobs == 0 and not waiting:
         if generate_new_windows:
           logging.info(
               "No more jobs in the queue, checking whether to generate new windows")
-          n_new_windows, fe_threshold = self.system.GenerateNewWindows(
-              self.environment)
+          with Timer(metrics, "generate_windows"):
+            n_new_windows, fe_threshold = self.system.GenerateNewWindows(
+                self.environment)
         else:
           logging.info(
               "No more jobs in the queue and no new windows will be generated (generate_new_windows=False)")
@@ -113,7 +201,7 @@ class SiPMF():
           logging.info("Generate {0} new windows with free energy threshold={1}. Total of {2} windows".format(
               n_new_windows, fe_threshold, len(self.system.windows)))
         if n_new_windows != 0 and submit_flag:
-          nj = self.system.SubmitNewJobs(self.environment)
+          nj = self._SubmitNewJobs(throttle)
           njobs += nj
           n_running_jobs = len(self.system.unfinished_jobs)
           logging.info("Submitted {0} new jobs, {1} jobs are running or in the queue".format(
@@ -123,6 +211,10 @@ class SiPMF():
       # Now we update the flags
       if n_running_jobs > 0:
         continue_flag = True
+      if throttle:
+        throttle.EndCycle([self.system])
+        if self.system.updated_windows and submit_flag:
+          continue_flag = True
       if njobs < max_jobs and time.time() - t0 < max_time:
         submit_flag = True
       else:
@@ -131,9 +223,24 @@ class SiPMF():
       if save_flag:
         self.system.Save("siPMF_state")
         logging.info("Saving the system.")
+      if schedule:
+        sleep_length = schedule.GetSleepLength([self.system])
+      if metrics:
+        metrics.SetGauge("unfinished_jobs", n_running_jobs)
+        metrics.SetGauge("windows", len(self.system.windows))
+        metrics.SetGauge("submitted_jobs", njobs)
+        if throttle:
+          metrics.SetGauge("waiting_windows", len(self.system.updated_windows))
+        if schedule:
+          metrics.SetGauge("sleep_length", sleep_length)
+        metrics.EndCycle(self.system.job_durations)
       if continue_flag:
         time.sleep(sleep_length)
     # Make sure the PMF is up to date before saving and stopping
+    if metrics:
+      metrics.StartCycle()
     self.system.UpdatePMF(self.environment)
     self.system.Save("siPMF_state")
+    if metrics:
+      metrics.EndCycle(self.system.job_durations)
     logging.info("Stopping.")
@@ -0,0 +1,117 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+This module contains the :class:`PhaseSizing` class, which chooses the number of MD steps of each new phase
+from the measured throughput of the simulations.
+"""
+import math
+import logging
+
+__all__ = ('PhaseSizing',)
+
+
+class PhaseSizing():
+  """
+  Number of MD steps of the new phases of a :class:`~system.System` (replacing {RUN_NSTEP} and {INIT_NSTEP}),
+  chosen from the throughput of the finished phases of the same type in steps per second
+  (see *JobDurations.GetThroughput*) rather than the fixed *System.run_nstep* and *System.init_nstep*:
+
+   - A run phase gets the number of steps expected to run for *target_walltime* seconds, but no more than the
+     number of steps needed to collect the samples the window still needs to reach *System.n_data*, counting the
+     samples expected from its unfinished phases. The number of samples per step is measured on the finished run phases
+     of the window, or if it has none yet, on the last window for which it was measured.
+   - An initialization phase gets the number of steps expected to run for *init_walltime* seconds, if it is set.
+
+  The number of steps is rounded up to a multiple of *step_multiple* (e.g. the output frequency of the CVs)
+  and kept between *min_nstep* and *max_nstep*. Until a phase of the same type has finished, the fixed number
+  of steps of the system is used.
+  """
+
+  def __repr__(self):
+    return "PhaseSizing({0},{1},{2},{3},{4})".format(self.target_walltime, self.init_walltime, self.min_nstep,
+                                                      self.max_nstep, self.step_multiple)
+
+  def __init__(self, target_walltime, init_walltime=None, min_nstep=1, max_nstep=None, step_multiple=1):
+    """
+    :param target_walltime: Wall time (in seconds) of the jobs of the run phases.
+    :param init_walltime: Wall time (in seconds) of the jobs of the initialization phases. By default
+     they run *System.init_nstep* steps.
+    :param min_nstep: Minimal number of steps of a phase.
+    :param max_nstep: Maximal number of steps of a phase, by default there is no limit.
+    :param step_multiple: The number of steps is a multiple of *step_multiple*.
+    :type target_walltime: :class:`float`
+    :type init_walltime: :class:`float`
+    :type min_nstep: :class:`int`
+    :type max_nstep: :class:`int`
+    :type step_multiple: :class:`int`
+    """
+    if target_walltime <= 0:
+      logging.error("The target wall time has to be positive")
+      raise ValueError("The target wall time has to be positive")
+    self.target_walltime = target_walltime
+    self.init_walltime = init_walltime
+    self.min_nstep = min_nstep
+    self.max_nstep = max_nstep
+    self.step_multiple = step_multiple
+    self.samples_per_step = None
+
+  def GetSamplesPerStep(self, window, phase):
+    """
+    Number of samples per MD step, measured on the finished run phases of the window (other than *phase*).
+    Returns *None* if it was never measured.
+
+    :param window: The window
+    :param phase: The new phase
+    :type window: :class:`~window.Window`
+    :type phase: :class:`~phase.Phase`
+    """
+    counted = [p for p in window.phases if p is not phase and p.type == "run" and p.n_data > 0
+               and getattr(p, "nstep", None)]
+    if counted:
+      self.samples_per_step = float(sum([p.n_data for p in counted])) / sum([p.nstep for p in counted])
+    return self.samples_per_step
+
+  def GetNeededSteps(self, system, phase):
+    """
+    Number of steps needed for the window of a new run phase to reach *System.n_data*, *None* if it is not known
+    or if the window already has enough data (e.g. when the phase was selected by an *allocation* policy).
+
+    :param system: The system
+    :param phase: The new run phase
+    :type system: :class:`~system.System`
+    :type phase: :class:`~phase.Phase`
+    """
+    window = phase.window
+    samples_per_step = self.GetSamplesPerStep(window, phase)
+    if not samples_per_step:
+      return None
+    expected = sum([p.n_data if p.n_data > 0 else (getattr(p, "nstep", None) or 0) * samples_per_step
+                    for p in window.phases if p is not phase and p.type == "run"])
+    needed = system.n_data - expected
+    if needed <= 0:
+      return None
+    return int(math.ceil(needed / samples_per_step))
+
+  def GetNstep(self, system, phase):
+    """
+    Number of MD steps of a new phase, *None* to use the fixed number of steps of the system.
+
+    :param system: The system
+    :param phase: The new phase
+    :type system: :class:`~system.System`
+    :type phase: :class:`~phase.Phase`
+    """
+    walltime = self.target_walltime if phase.type == "run" else self.init_walltime
+    throughput = system.job_durations.GetThroughput(phase.type)
+    if walltime is None or throughput is None:
+      return None
+    nstep = throughput * walltime
+    if phase.type == "run":
+      needed = self.GetNeededSteps(system, phase)
+      if needed is not None:
+        nstep = min(nstep, needed)
+    nstep = int(math.ceil(nstep / float(self.step_multiple))) * self.step_multiple
+    nstep = max(nstep, self.min_nstep)
+    if self.max_nstep:
+      nstep = min(nstep, self.max_nstep)
+    return nstep
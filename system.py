@@ -8,12 +8,21 @@ import os
 import subprocess
 import logging
 import numpy as npy
-import matplotlib.pyplot as plt
 import itertools
 import pickle
-from window import Window
+from window import Window, _ReadWindowDataFile
 from phase import Phase
-from pmf import PMF
+from pmf import PMF, SparsePMF
+from wham import BinGrid, BuildAdaptiveGrid, SparseWham
+import plotting
+from cv_index import CVFrameIndex, LoadCVFrameIndex
+from metrics import Timer
+from overlap import OverlapMatrix
+from polling import JobDurations
+from colvars import ColvarFormat
+from reus import ReadReplicaDataFile
+from filesystem import FileSystemSnapshot
+from environment import GetQueueStatusCache
 import time
 
 __all__ = ('LoadSystem', 'System', "RebuildWindowsAndPhasesFromDirectoryTree")
@@ -58,24 +67,31 @@ def RebuildWindowsAndPhasesFromDirectoryTree(system):
       parent_window = system.FindWindow(
           info["parent cv values"], info["parent spring constants"])
       w.parent = parent_window
+    if "init_restartdir" in info:
+      w.init_restartdir = info["init_restartdir"]
     if "cv_shifts" in info:
       system.cv_shifts = info["cv_shifts"]
   # Now we add the phases to each window
   for w in system.windows:
     if os.path.isdir(os.path.join(w.subdir, "initialization")):
       w.phases.append(Phase(w, "initialization", "initialization"))
-    i = 1
-    while True:
-      phase_name = "phase" + str(i)
-      if os.path.isdir(os.path.join(w.subdir, phase_name)):
-        w.phases.append(Phase(w, phase_name, "run"))
-        i += 1
-      else:
-        break
+    walker = 0
+    while walker == 0 or os.path.isdir(os.path.join(w.subdir, w.GetPhaseName(walker, 1))):
+      i = 1
+      while True:
+        phase_name = w.GetPhaseName(walker, i)
+        if os.path.isdir(os.path.join(w.subdir, phase_name)):
+          w.phases.append(Phase(w, phase_name, "run", walker=walker))
+          i += 1
+        else:
+          break
+      walker += 1
   # Now we set the parent phases
   for w in system.windows:
     for p in w.phases:
-      if p.type == "initialization":
+      # Initialization phases and the first phases of additional walkers are restarted from another chain
+      restarted = p.type == "initialization" or (p.walker > 0 and p.name == w.GetPhaseName(p.walker, 1))
+      if restarted:
         if not os.path.isfile(os.path.join(p.outdir, "info.pkl")):
           print "Missing info.pkl file for {0}".format(p.outdir)
           continue
@@ -90,14 +106,16 @@ def RebuildWindowsAndPhasesFromDirectoryTree(system):
         if p.name == "phase1":
           parent_pname = "initialization"
         else:
-          i = int(p.name[5:])
-          parent_pname = "phase" + str(i - 1)
+          i = int(p.name.split("phase")[-1])
+          parent_pname = w.GetPhaseName(p.walker, i - 1)
         parent_phase = w.FindPhase(parent_pname)
       if not parent_phase:
         print "No parent phase for {0}".format(p.outdir)
         continue
       p.parent_phase = parent_phase
       p.restartdir = parent_phase.outdir
+      if restarted and "restart frame" in info:
+        p.SetRestartFrame(info["restart frame"], info["restart cv values"])
   return
 
 
@@ -127,7 +145,7 @@ class System():
   def __repr__(self):
     return "System({0},{1},{2},{3},{4},{5},{6},{7},{8},{9},{10},{11},{12})".format(self.basedir, self.cv_list, self.init_input_fname, self.run_input_fname, self.init_job_fname, self.run_job_fname, self.data_filename, self.init_nstep, self.run_nstep, self.n_data, self.max_E1, self.max_E2, self.temperature)
 
-  def __init__(self, basedir, cv_list, init_input_fname, run_input_fname, init_job_fname, run_job_fname, data_filename, init_nstep, run_nstep, n_data, max_E1, max_E2, temperature, check_fnames=None, target_cv_vals=None, adapt_spring_constants=False, adapt_window_centers=False, check_free_energy=True, name=""):
+  def __init__(self, basedir, cv_list, init_input_fname, run_input_fname, init_job_fname, run_job_fname, data_filename, init_nstep, run_nstep, n_data, max_E1, max_E2, temperature, check_fnames=None, target_cv_vals=None, adapt_spring_constants=False, adapt_window_centers=False, check_free_energy=True, name="", restart_from_nearest_sample=False, nearest_restart_init_nstep=None, allocation=None, packing=None, chain_length=1, reus=None, min_overlap=None, adapt_poor_overlaps=False, grid_refinement=None, phase_sizing=None, n_walkers=1, data_format=None, samples_per_frame=1, frame_offset=0):
     """
     :param basedir: The root directory in which the PMF calculation will be performed. Windows and
      phases will correspond to subdirectories of *basedir*.
@@ -150,6 +168,45 @@ class System():
     :param adapt_window_centers: If window centers should be automatically adapted for each window.
     :param check_free_energy: Only generate new windows from windows that have free energy below *max_E1*
     :param name: Name of the system. This is used for plot titles and such.
+    :param restart_from_nearest_sample: Start the initialization phase of new windows from the frame closest to the
+     center of the window among all the phases already run (see *FindNearestFrames*), rather than from the last frame
+     of the parent window. This requires a *restart_extractor* in the :class:`~environment.Environment`.
+    :param nearest_restart_init_nstep: The number of steps for initialization phases started from the nearest frame.
+     By default *init_nstep* is used.
+    :param allocation: Policy deciding which windows are sampled further. By default every window is sampled
+     until it has *n_data* data points. With an :class:`~allocation.UncertaintyAllocation`, windows are instead sampled
+     until their contribution to the uncertainty of the PMF is small enough, and *n_data* is only used for its defaults.
+    :param packing: If set, the jobs submitted together are packed into bundles, each submitted as one job
+     to the queuing system (see :class:`~packing.JobPacker`).
+    :param chain_length: Maximal number of phases of a window submitted at once. The phases of a window are then
+     submitted as a chain, each phase only starting once the previous one has finished successfully (this requires
+     a *dependency_option* in the :class:`~environment.Environment`). Only as many phases as expected to be needed to
+     reach *n_data* are submitted and the phases remaining in the queue are cancelled once the window has enough data,
+     or when a phase of the chain crashes. Chains are not used when jobs are packed (*packing*).
+    :param reus: If set, neighboring windows that need a new run phase at the same time are sampled together
+     with replica-exchange umbrella sampling (see :class:`~reus.ReplicaExchange`).
+    :param min_overlap: If set, the overlap matrix of neighboring windows (*overlap_matrix*) is updated before each WHAM
+     and the pairs of neighboring windows whose overlap is below *min_overlap* are reported (see *GetPoorOverlaps*).
+    :param adapt_poor_overlaps: If poorly overlapping windows should get an additional window with stiffer or softer
+     spring constants when generating new windows (see *AdaptPoorOverlaps*). This requires *min_overlap*.
+    :param grid_refinement: If set, the PMF is calculated in process on a multi-resolution grid, whose bins are refined
+     where the sampling is dense and the free energy changes strongly (see :class:`~wham.GridRefinement`),
+     for any number of CVs.
+    :param phase_sizing: If set, the number of MD steps of each new phase is chosen from the measured throughput,
+     to run for a target wall time and to collect no more samples than the window needs (see :class:`~sizing.PhaseSizing`),
+     instead of *run_nstep* and *init_nstep*.
+    :param n_walkers: Number of walkers of each window, i.e. of chains of run phases sampling the window at the same
+     time. The additional walkers start from different frames of the first one once it has a finished phase
+     (see *Window.StartWalker*), and their data is merged with the data of the first walker. Only as many walkers as
+     needed to reach *n_data* get a phase. Additional walkers are not used with replica exchange (*reus*).
+    :param data_format: Layout of the datafiles of the phases (columns of the time and of the CVs, comment characters),
+     see :class:`~colvars.ColvarFormat`. By default the time is in the first column followed by the CVs.
+    :param samples_per_frame: Number of data lines in the datafiles for each frame in the trajectories of the phases,
+     e.g. the ratio of the output frequencies of the trajectory and of the CVs. Line *i* of a datafile corresponds to
+     frame *(i-frame_offset)/samples_per_frame*. This mapping is used by the index of the CV samples
+     (*UpdateCVIndex*), to restart new windows from the nearest sample (*restart_from_nearest_sample*) and to start
+     additional walkers (*n_walkers*).
+    :param frame_offset: Index of the line in the datafiles corresponding to the first frame of the trajectories.
 
     :type basedir: :class:`str`
     :type cv_list: :class:`list` (:class:`~other.CollectiveVariable`)
@@ -168,14 +225,27 @@ class System():
     :type target_cv_vals: :class:`list` (:class:`tuple` (:class:`float` ) )
     :type check_free_energy: :class:`float`
     :type name: :class:`str`
+    :type restart_from_nearest_sample: :class:`bool`
+    :type nearest_restart_init_nstep: :class:`int`
+    :type allocation: :class:`~allocation.UncertaintyAllocation`
+    :type packing: :class:`~packing.JobPacker`
+    :type chain_length: :class:`int`
+    :type reus: :class:`~reus.ReplicaExchange`
+    :type min_overlap: :class:`float`
+    :type adapt_poor_overlaps: :class:`bool`
+    :type grid_refinement: :class:`~wham.GridRefinement`
+    :type phase_sizing: :class:`~sizing.PhaseSizing`
+    :type n_walkers: :class:`int`
+    :type data_format: :class:`~colvars.ColvarFormat`
+    :type samples_per_frame: :class:`int`
+    :type frame_offset: :class:`int`
     """
     self.basedir = basedir
+    self.fs_snapshot = FileSystemSnapshot()
     self.pmf_dir = os.path.join(basedir, "PMF")
-    subprocess.call(["mkdir", self.pmf_dir])
     self.simu_dir = os.path.join(basedir, "windows")
-    subprocess.call(["mkdir", self.simu_dir])
     self.hist_dir = os.path.join(basedir, "Histogram")
-    subprocess.call(["mkdir", self.hist_dir])
+    self.fs_snapshot.MakeDirs([self.pmf_dir, self.simu_dir, self.hist_dir], exist_ok=True)
     self.temperature = temperature
     if not check_fnames:
       check_fnames = []
@@ -207,10 +277,78 @@ class System():
     self.adapt_window_centers = adapt_window_centers
     self.check_free_energy = check_free_energy
     self.name = name
+    self.plot_worker = None
+    self.compression_worker = None
+    self.cv_index = None
+    self.restart_from_nearest_sample = restart_from_nearest_sample
+    self.nearest_restart_init_nstep = nearest_restart_init_nstep
+    self.metrics = None
+    self.allocation = allocation
+    self.packing = packing
+    self.chain_length = chain_length
+    self.reus = reus
+    self.overlap_matrix = OverlapMatrix()
+    self.min_overlap = min_overlap
+    self.adapt_poor_overlaps = adapt_poor_overlaps
+    self.grid_refinement = grid_refinement
+    self.job_durations = JobDurations()
+    self.phase_sizing = phase_sizing
+    self.n_walkers = n_walkers
+    self.data_format = data_format or ColvarFormat()
+    self.samples_per_frame = samples_per_frame
+    self.frame_offset = frame_offset
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    # The plotting and compression processes and the metrics recorder cannot be saved with the system
+    state["plot_worker"] = None
+    state["compression_worker"] = None
+    state["metrics"] = None
+    # The index of the CV samples is saved in its own file
+    state["cv_index"] = None
+    return state
 
   def UpdateToNewVersion(self):
     if not hasattr(self, "name"):
       self.name = ""
+    if not hasattr(self, "plot_worker"):
+      self.plot_worker = None
+    if not hasattr(self, "compression_worker"):
+      self.compression_worker = None
+    if not hasattr(self, "cv_index"):
+      self.cv_index = None
+    if not hasattr(self, "metrics"):
+      self.metrics = None
+    if not hasattr(self, "restart_from_nearest_sample"):
+      self.restart_from_nearest_sample = False
+      self.nearest_restart_init_nstep = None
+    if not hasattr(self, "allocation"):
+      self.allocation = None
+    if not hasattr(self, "packing"):
+      self.packing = None
+    if not hasattr(self, "chain_length"):
+      self.chain_length = 1
+    if not hasattr(self, "reus"):
+      self.reus = None
+    if not hasattr(self, "overlap_matrix"):
+      self.overlap_matrix = OverlapMatrix()
+      self.min_overlap = None
+      self.adapt_poor_overlaps = False
+    if not hasattr(self, "grid_refinement"):
+      self.grid_refinement = None
+    if not hasattr(self, "job_durations"):
+      self.job_durations = JobDurations()
+    if not hasattr(self, "phase_sizing"):
+      self.phase_sizing = None
+    if not hasattr(self, "n_walkers"):
+      self.n_walkers = 1
+    if not hasattr(self, "data_format"):
+      self.data_format = ColvarFormat()
+    if not hasattr(self, "fs_snapshot"):
+      self.fs_snapshot = FileSystemSnapshot()
+    if not hasattr(self, "samples_per_frame"):
+      self.samples_per_frame = 1
+      self.frame_offset = 0
 
   def Save(self, filename):
     """
@@ -219,9 +357,10 @@ class System():
     :param filename: The :class:`System` will be saved to *basedir/filename.pkl*
     :type filename: :class:`str`
     """
-    f = open(os.path.join(self.basedir, filename + ".pkl"), "w")
-    pickle.dump(self, f)
-    f.close()
+    with Timer(self.metrics, "save"):
+      f = open(os.path.join(self.basedir, filename + ".pkl"), "w")
+      pickle.dump(self, f)
+      f.close()
 
   def Initialize(self, cv_values, spring_constants, init_restartdir):
     """
@@ -242,28 +381,51 @@ class System():
     self.windows.append(w)
     self.updated_windows.append(self.windows[-1])
 
-  def UpdateUnfinishedJobList(self, environment):
+  def UpdateUnfinishedJobList(self, environment, status_cache=None):
     """
     Check whether running jobs are still in the queue and update
     the list of unfinished jobs and updated windows.
 
     :param environment:  The environment used to check the job status
+    :param status_cache: Status of the job IDs already known, e.g. for all the jobs of the queue at once
+     (see :func:`~environment.GetQueueStatusCache`). By default it is obtained from the *qstat_all* command
+     of the environment if it has one.
     :type environment: :class:`~environment.Environment`
+    :type status_cache: :class:`dict`
     """
+    # Start of a new cycle, the files written by the jobs since the last one are only seen in new listings
+    self.fs_snapshot.Clear()
     n_crashed = 0
     to_remove = []
+    # Jobs packed in the same bundle share their job ID, which is only checked once
+    if status_cache is None:
+      status_cache = GetQueueStatusCache(environment, self.unfinished_jobs)
     for job in self.unfinished_jobs:
-      job.UpdateStatus(environment)
+      job.UpdateStatus(environment, status_cache)
       if job.queue_status == "finished":
         to_remove.append(job)
     for job in to_remove:
+      if getattr(job, "cancelled", False):
+        # Cancelled with the rest of its chain after an earlier phase crashed
+        continue
       self.unfinished_jobs.remove(job)
-      self.updated_windows.append(job.phase.window)
+      # Each phase of a chain that finishes updates its window, which is only listed once
+      if job.phase.window not in self.updated_windows:
+        self.updated_windows.append(job.phase.window)
+      if self.metrics:
+        self.metrics.RecordFinishedJob(job)
+      self.job_durations.Record(job)
       if not job.success:
         n_crashed += 1
+        window = job.phase.window
+        chain = window.GetWalkerPhases(getattr(job.phase, "walker", 0))
+        following = chain[chain.index(job.phase) + 1:]
+        if following:
+          logging.info("{0} crashed, cancelling the {1} following phases of its chain".format(
+              job.phase, len(following)))
+          self.CancelPhases(following, environment)
         job.phase.window.last_phase_n_crashed += 1
-        subprocess.call(["mv", job.phase.outdir, job.phase.outdir +
-                         "_back" + str(job.phase.window.last_phase_n_crashed)])
+        self.MovePhaseDirectory(job.phase, "_back" + str(job.phase.window.last_phase_n_crashed))
         job.phase.window.phases.remove(job.phase)
         if len(job.phase.window.phases) == 0:
           job.phase.window.is_new = True
@@ -276,30 +438,210 @@ class System():
             "{0} crashed twice, please verify why and correct error before restarting".format(job.phase))
     return len(self.updated_windows), n_crashed
 
-  def SubmitNewJobs(self, environment):
+  def SubmitNewJobs(self, environment, max_jobs=None):
     """
     Submit the next series of jobs. This does not create new windows, only go through the
     existing windows and submit the next job (initialization or run) for that window if necessary
-    (if not enough data has been collected yet for that window).
+    (if not enough data has been collected yet for that window, or if an *allocation* policy is set,
+    if the policy selects the window, see :class:`~allocation.UncertaintyAllocation`).
 
     :param environment:  The environment used to submit the jobs
+    :param max_jobs: Maximal number of jobs to submit. The windows that did not get a job stay in the list of
+     updated windows, so that they get one the next time jobs are submitted. Each phase counts as one job, also
+     within replica-exchange blocks (including their idle windows) and packed bundles, so that the limit holds
+     however the phases are grouped.
     :type environment: :class:`~environment.Environment`
+    :type max_jobs: :class:`int`
+    :returns: The number of jobs submitted to the queuing system, a replica-exchange block or a bundle of packed
+     phases being one job.
     """
-    for window in self.updated_windows:
-      window.UpdateDataCount()
-    to_remove = []
-    n_new_jobs = 0
-    for window in self.updated_windows:
-      if window.n_data >= self.n_data:
-        to_remove.append(window)
+    with Timer(self.metrics, "submit"):
+      # Each window is considered once, even if it was listed several times (e.g. in systems saved before
+      # the windows were only listed once), so that it does not get a new phase or chain for each entry
+      listed = set()
+      self.updated_windows = [w for w in self.updated_windows if not (w in listed or listed.add(w))]
+      running_phases = set([job.phase for job in self.unfinished_jobs])
+      for window in self.updated_windows:
+        window.UpdateDataCount(running_phases)
+      # Windows with phases left in their chain (or, with several walkers, in the chains of all their walkers)
+      # only get their surplus phases cancelled
+      running = [w for w in self.updated_windows if any(
+          [p in running_phases for p in w.phases])]
+      windows = [w for w in self.updated_windows if self.GetIdleWalkers(w, running_phases)]
+      if self.allocation:
+        with Timer(self.metrics, "allocation"):
+          to_submit = self.allocation.SelectWindows(self, windows)
+          done = [w for w in running if not self.allocation.SelectWindows(self, [w])]
       else:
-        window.SubmitNextPhase(environment)
-        to_remove.append(window)
-        n_new_jobs += 1
-    for window in to_remove:
-      self.updated_windows.remove(window)
+        to_submit = [w for w in windows if w.n_data < self.n_data]
+        done = [w for w in running if w.n_data >= self.n_data]
+      to_submit = [w for w in to_submit if w not in done]
+      for window in done:
+        surplus = [p for p in window.phases if p in running_phases]
+        logging.info("{0} has enough data, cancelling its {1} remaining phases".format(
+            window.name, len(surplus)))
+        self.CancelPhases(surplus, environment)
+      n_unfinished = len(self.unfinished_jobs)
+      n_new_phases = 0
+      deferred = []
+      if max_jobs is not None:
+        deferred = to_submit[max_jobs:]
+        to_submit = to_submit[:max_jobs]
+      if self.reus and to_submit:
+        in_blocks = set(self.reus.Submit(self, environment, to_submit, max_jobs))
+        n_new_phases += len(in_blocks)
+        to_submit = [w for w in to_submit if w not in in_blocks]
+      jobs = []
+      # Used for the windows without finished run phases, for the length of the chains and the number of walkers
+      n_data_per_phase = self.GetNDataPerPhase(running_phases=running_phases)
+      for i, window in enumerate(to_submit):
+        if max_jobs is not None and n_new_phases >= max_jobs:
+          deferred = to_submit[i:] + deferred
+          break
+        walkers = self.GetIdleWalkers(window, running_phases)
+        walkers = walkers[:self.GetNWalkers(window, walkers, running_phases, n_data_per_phase)]
+        for walker in walkers:
+          if max_jobs is not None and n_new_phases >= max_jobs:
+            # The window gets its other walkers the next time jobs are submitted
+            deferred = [window] + deferred
+            break
+          n_phases = self.GetChainLength(window, n_data_per_phase)
+          if max_jobs is not None:
+            n_phases = min(n_phases, max_jobs - n_new_phases)
+          n_window_phases = len(window.phases)
+          jobs.append(window.SubmitNextPhase(environment, submit=not self.packing, walker=walker).job)
+          n_new_phases += 1
+          if n_phases > 1:
+            n_new_phases += window.SubmitChain(environment, n_phases - 1, walker)
+          # The walker is busy until its new phases finish (see GetIdleWalkers)
+          running_phases.update(window.phases[n_window_phases:])
+      if self.packing and jobs:
+        n_bundles = self.packing.Submit(self, environment, jobs)
+        if self.metrics:
+          self.metrics.Count("bundles_submitted", n_bundles)
+      self.updated_windows = deferred
+      n_new_jobs = len(set([job.jid for job in self.unfinished_jobs[n_unfinished:]]))
+    if self.metrics:
+      self.metrics.Count("jobs_submitted", n_new_jobs)
     return n_new_jobs
 
+  def GetIdleWalkers(self, window, running_phases):
+    """
+    Indices of the walkers of a window that can get a new phase (see *n_walkers*): the walkers without unfinished
+    phases. The additional walkers only start once the first walker has a finished phase, and are not used
+    with replica exchange (*reus*).
+
+    :param window: The window
+    :param running_phases: Phases that are not finished yet, including the phases submitted since it was computed,
+     so that a walker never gets a phase while its previous one is still running
+    :type window: :class:`~window.Window`
+    :type running_phases: :class:`set` (:class:`~phase.Phase`)
+    """
+    busy = set([getattr(p, "walker", 0) for p in window.phases if p in running_phases])
+    n_walkers = self.n_walkers
+    first = window.GetWalkerPhases(0)
+    if self.reus or window.is_new or not [p for p in first if p not in running_phases]:
+      n_walkers = 1
+    return [k for k in range(n_walkers) if k not in busy]
+
+  def GetNWalkers(self, window, walkers, running_phases, n_data_per_phase=None):
+    """
+    Number of idle walkers of a window that get a new phase. Without an *allocation* policy, this is the number of
+    phases expected to be needed for the window to reach *n_data*, counting the data expected from its unfinished phases.
+
+    :param window: The window
+    :param walkers: The idle walkers of the window (see *GetIdleWalkers*)
+    :param running_phases: Phases that are not finished yet
+    :param n_data_per_phase: Number of data points expected from a run phase, if the window does not have finished run phases yet.
+    :type window: :class:`~window.Window`
+    :type walkers: :class:`list` (:class:`int`)
+    :type running_phases: :class:`set` (:class:`~phase.Phase`)
+    :type n_data_per_phase: :class:`float`
+    """
+    if len(walkers) <= 1 or self.allocation:
+      return len(walkers)
+    n_data_per_phase = self.GetNDataPerPhase(window, running_phases) or n_data_per_phase
+    if not n_data_per_phase:
+      return len(walkers)
+    n_running = len([p for p in window.phases if p.type == "run" and p in running_phases])
+    n_phases = int(npy.ceil((self.n_data - window.n_data) / n_data_per_phase)) - n_running
+    return max(1, min(len(walkers), n_phases))
+
+  def GetNDataPerPhase(self, window=None, running_phases=None):
+    """
+    Average number of data points collected by the finished run phases of a window (of all windows if *window* is *None*).
+    Returns *None* if there are no such phases.
+    """
+    if running_phases is None:
+      running_phases = set([job.phase for job in self.unfinished_jobs])
+    if window is None:
+      windows = self.windows
+    else:
+      windows = [window]
+    n = [p.n_data for w in windows for p in w.phases if p.type ==
+         "run" and p not in running_phases and p.n_data > 0]
+    if not n:
+      return None
+    return sum(n) / float(len(n))
+
+  def GetChainLength(self, window, n_data_per_phase=None):
+    """
+    Number of phases to submit at once for a window (see *chain_length*). Without an *allocation* policy,
+    this is the number of phases expected to be needed for the window to reach *n_data*, at most *chain_length*.
+
+    :param window: The window
+    :param n_data_per_phase: Number of data points expected from a run phase, if the window does not have finished run phases yet.
+    :type window: :class:`~window.Window`
+    :type n_data_per_phase: :class:`float`
+    """
+    if self.chain_length <= 1 or self.packing:
+      return 1
+    if self.allocation:
+      return self.chain_length
+    # The window is not running, so all its phases are finished
+    n_data_per_phase = self.GetNDataPerPhase(window, ()) or n_data_per_phase
+    if not n_data_per_phase:
+      return self.chain_length
+    n_phases = int(npy.ceil((self.n_data - window.n_data) / n_data_per_phase))
+    if window.is_new and window.parent:
+      n_phases += 1
+    return max(1, min(self.chain_length, n_phases))
+
+  def CancelPhases(self, phases, environment):
+    """
+    Cancel the jobs of phases that are not finished and remove the phases from their window.
+    Their directories are renamed with a *_cancelled* suffix followed by the job ID.
+
+    :param phases: The phases to cancel
+    :param environment: The environment used to cancel the jobs
+    :type phases: :class:`list` (:class:`~phase.Phase`)
+    :type environment: :class:`~environment.Environment`
+    """
+    for phase in phases:
+      phase.job.Cancel(environment)
+      if phase.job in self.unfinished_jobs:
+        self.unfinished_jobs.remove(phase.job)
+      phase.window.phases.remove(phase)
+      self.MovePhaseDirectory(phase, "_cancelled" + str(phase.job.jid))
+    if self.metrics:
+      self.metrics.Count("jobs_cancelled", len(phases))
+
+  def MovePhaseDirectory(self, phase, suffix):
+    """
+    Move the output directory of a phase that is removed from its window (crashed or cancelled) to
+    *outdir+suffix*, so that a new phase with the same name can be run. Failures are logged, as the supervisor
+    can go on without it.
+
+    :param phase: The phase
+    :param suffix: Suffix added to the name of the directory
+    :type phase: :class:`~phase.Phase`
+    :type suffix: :class:`str`
+    """
+    try:
+      self.fs_snapshot.Move(phase.outdir, phase.outdir + suffix)
+    except OSError as e:
+      logging.error("Could not move {0} to {1}: {2}".format(phase.outdir, phase.outdir + suffix, e))
+
   def GetPathToInitInputFile(self):
     """
     Get the path to the MD input file used to generate new windows (initialization phase)
@@ -324,6 +666,25 @@ class System():
     """
     return os.path.join(self.basedir, self.run_job_fname)
 
+  def GetPhaseNstep(self, phase):
+    """
+    Number of MD steps of a new phase: *run_nstep* for a run phase and *init_nstep* for an initialization phase
+    (*nearest_restart_init_nstep* if it is set and the phase is restarted from a specific frame), unless the
+    *phase_sizing* chooses it from the measured throughput.
+
+    :param phase: The new phase
+    :type phase: :class:`~phase.Phase`
+    """
+    if self.phase_sizing:
+      nstep = self.phase_sizing.GetNstep(self, phase)
+      if nstep:
+        return nstep
+    if phase.type == "run":
+      return self.run_nstep
+    if getattr(phase, "restart_frame", None) is not None and self.nearest_restart_init_nstep:
+      return self.nearest_restart_init_nstep
+    return self.init_nstep
+
   def AddWindow(self, cv_values, spring_constants, shifts=None, parent_window=None):
     """
     Add a new window to the system
@@ -385,6 +746,8 @@ class System():
     from all the run phases and writes it into a datafile, skipping the first n_skip data points
     and adding a maximum of n_tot data points for each window.
     *n_tot=-1* means there is no maximal number of data points.
+    If a :class:`~colvars.CompressionWorker` is attached to the system (*compression_worker*), the datafiles
+    of the finished phases whose data was added are then compressed in the background.
 
     :param n_skip: The number of data points to skip.
     :param n_tot: The total number of data points used to calculate the PMF.
@@ -395,6 +758,153 @@ class System():
     """
     for window in self.windows:
       window.UpdateDataFile(n_skip, n_tot, new_only)
+    if self.compression_worker:
+      running = set([job.phase for job in self.unfinished_jobs])
+      for window in self.windows:
+        for phase in window.phases:
+          if phase.type == "run" and phase.data_added_to_window and phase not in running \
+                  and os.path.isfile(phase.path_to_datafile):
+            self.compression_worker.Submit(phase.path_to_datafile)
+
+  def GetFrameSamples(self, n_samples):
+    """
+    Indices of the lines of a datafile with *n_samples* lines that correspond to the frames of the trajectory
+    (see *samples_per_frame* and *frame_offset*). Frame *i* corresponds to the *i*-th of these lines, as in the index
+    of the CV samples (:class:`~cv_index.CVFrameIndex`).
+
+    :param n_samples: Number of lines of the datafile
+    :type n_samples: :class:`int`
+    """
+    return npy.arange(self.frame_offset, n_samples, self.samples_per_frame)
+
+  def GetPathToCVIndex(self):
+    """
+    Get the path to the file in which the index of the CV samples is saved
+    """
+    return os.path.join(self.basedir, "cv_index.pkl")
+
+  def UpdateCVIndex(self, samples_per_frame=None, frame_offset=None, bucket_sizes=None):
+    """
+    Update the index mapping every sample of the CVs to its phase and trajectory frame (:class:`~cv_index.CVFrameIndex`).
+    The index is loaded from *basedir/cv_index.pkl* (or created if it does not exist yet), the phases that are finished
+    and not yet in the index are added to it and it is saved again. The parameters are only used when the index is created.
+    An index saved with a different mapping from samples to frames is created again.
+
+    :param samples_per_frame: Number of lines in the datafiles for each frame in the trajectories.
+     By default *System.samples_per_frame*.
+    :param frame_offset: Index of the line in the datafiles corresponding to the first frame of the trajectories.
+     By default *System.frame_offset*.
+    :param bucket_sizes: Size of the buckets of the index for each CV. By default the step size of the CVs.
+    :type samples_per_frame: :class:`int`
+    :type frame_offset: :class:`int`
+    :type bucket_sizes: :class:`list` (:class:`float`)
+    """
+    if samples_per_frame is None:
+      samples_per_frame = self.samples_per_frame
+    if frame_offset is None:
+      frame_offset = self.frame_offset
+    if not self.cv_index and os.path.isfile(self.GetPathToCVIndex()):
+      self.cv_index = LoadCVFrameIndex(self.GetPathToCVIndex())
+    if self.cv_index and (self.cv_index.samples_per_frame, self.cv_index.frame_offset) != (samples_per_frame, frame_offset):
+      logging.info("The mapping from samples to frames changed, the index of the CV samples is created again")
+      self.cv_index = None
+    if not self.cv_index:
+      self.cv_index = CVFrameIndex(
+          self.cv_list, bucket_sizes, samples_per_frame, frame_offset)
+    running = set([job.phase for job in self.unfinished_jobs])
+    n_new = 0
+    for window in self.windows:
+      for phase in window.phases:
+        if phase in running or self.cv_index.HasPhase((window.name, phase.name)):
+          continue
+        if not phase.GetPathToDataFile():
+          continue
+        # Phases sampled with replica exchange are indexed with the samples of the replica of their trajectory
+        data = ReadReplicaDataFile(self, phase)
+        t, cvs = data if data is not None else phase.ReadDataFile()
+        self.cv_index.AddPhase((window.name, phase.name),
+                               npy.array(cvs).transpose())
+        n_new += 1
+    if n_new > 0:
+      self.cv_index.Save(self.GetPathToCVIndex())
+    return self.cv_index
+
+  def FindNearestFrames(self, cv_values, n=1, update=True, max_distance=None):
+    """
+    Find the *n* frames closest to a point in the CV space among all the phases of all windows.
+    Distances are measured in units of the bucket sizes of the index (by default the step size of each CV).
+
+    :param cv_values: Values of the CVs
+    :param n: Number of frames to return
+    :param update: Update the index before the query (*UpdateCVIndex*)
+    :param max_distance: Only return frames closer than this distance
+    :type cv_values: :class:`list` (:class:`float`)
+    :type n: :class:`int`
+    :type update: :class:`bool`
+    :type max_distance: :class:`float`
+
+    :returns: A list of tuples *(distance, phase, frame, cv_values)* sorted by distance.
+    """
+    if update or not self.cv_index:
+      self.UpdateCVIndex()
+    res = []
+    for d, (window_name, phase_name), frame, cvv in self.cv_index.FindNearest(cv_values, n, max_distance):
+      phase = self.FindPhaseByName(window_name, phase_name)
+      if phase:
+        res.append((d, phase, frame, cvv))
+    return res
+
+  def GetLatticeKey(self, cv_values):
+    """
+    Position of a point on the lattice of windows, in units of the step size of each CV and relative to the
+    first window. Periodic CVs are wrapped.
+
+    :param cv_values: Values of the CVs
+    :type cv_values: :class:`list` (:class:`float`)
+    """
+    key = []
+    for cvv, ref, cv in zip(cv_values, self.windows[0].cv_values, self.cv_list):
+      k = int(round((cvv - ref) / cv.step_size))
+      if cv.periodicity:
+        k %= max(int(round(cv.periodicity / cv.step_size)), 1)
+      key.append(k)
+    return tuple(key)
+
+  def GetNeighborWindows(self, windows=None):
+    """
+    Find the neighbors of windows on the lattice of windows, i.e. the windows one step away along one of the CVs.
+    Returns a dictionary mapping each window to the list of its neighbors.
+
+    :param windows: The windows for which to find the neighbors. By default all windows.
+    :type windows: :class:`list` (:class:`~window.Window`)
+    """
+    if windows is None:
+      windows = self.windows
+    lattice = {}
+    for w in self.windows:
+      lattice.setdefault(self.GetLatticeKey(w.cv_values), []).append(w)
+    neighbors = {}
+    for w in windows:
+      key = self.GetLatticeKey(w.cv_values)
+      nl = []
+      for i, cv in enumerate(self.cv_list):
+        for d in [-1, 1]:
+          k = list(key)
+          k[i] += d
+          if cv.periodicity:
+            k[i] %= max(int(round(cv.periodicity / cv.step_size)), 1)
+          nl.extend([n for n in lattice.get(tuple(k), []) if n is not w and n not in nl])
+      neighbors[w] = nl
+    return neighbors
+
+  def FindPhaseByName(self, window_name, phase_name):
+    """
+    Find a phase from the name of its window and its own name.
+    """
+    for w in self.windows:
+      if w.name == window_name:
+        return w.FindPhase(phase_name)
+    return None
 
   def UpdateDataCounts(self):
     """
@@ -407,10 +917,14 @@ class System():
     """
     Calculate the PMF. The function generates the meta file listing all the data files and
     their corresponding CV values and spring constants and then calls WHAM.
+    For more than two CVs or with a *grid_refinement*, the PMF is calculated in process instead (see *CalculateSparsePMF*).
 
     :param environment: The environment used to call WHAM
     :type environment: :class:`~environment.Environment`
     """
+    if len(self.cv_list) > 2 or self.grid_refinement:
+      self.CalculateSparsePMF(wham_tolerance)
+      return
 
     pmf_cmd = [environment.wham_executable]
     if len(self.cv_list) == 1:
@@ -429,17 +943,13 @@ class System():
           p = x + str(cv.periodicity)
         pmf_cmd.extend(
             [p, cv.wham_min_value, cv.wham_max_value, cv.wham_num_bins])
-    else:
-      logging.error("Can only work with one or two collective variables")
-      raise ValueError(
-          "Can only work with one or two collective variables")
     pmf_cmd.append(wham_tolerance)  # tolerance
     pmf_cmd.append(self.temperature)
     num_pads = max([cv.num_pads for cv in self.cv_list])
     pmf_cmd.append(num_pads)  # Number of pads for periodic variables
     f = open(self.path_to_pmf_input, "w")
     for window in self.windows:
-      if not os.path.isfile(window.path_to_datafile):
+      if not self.fs_snapshot.IsFile(window.path_to_datafile):
         continue
       l = [window.path_to_datafile]
       l.extend(
@@ -457,12 +967,57 @@ class System():
     subprocess.call(pmf_cmd)
     logging.info("WHAM finished in {0}s".format(time.time() - t0))
 
+  def CalculateSparsePMF(self, wham_tolerance=0.001):
+    """
+    Calculate the PMF with the in-process WHAM (see :func:`~wham.SparseWham`), which works for any number of CVs and only
+    stores the bins containing data. The PMF file only lists these bins, one line per bin with the values of the CVs at its
+    center, its free energy and its number of samples.
+    With a *grid_refinement*, the PMF is first calculated on the bins of the CVs, then on the multi-resolution grid
+    refined from it (see :class:`~wham.GridRefinement`), and the PMF file has an additional column with the level of
+    each bin.
+
+    :param wham_tolerance: Tolerance on the free energies of the windows for the convergence of WHAM
+    :type wham_tolerance: :class:`float`
+    """
+    windows = [w for w in self.windows if self.fs_snapshot.IsFile(w.path_to_datafile)]
+    samples = []
+    for window in windows:
+      t, cvs = window.ReadDataFile()
+      samples.append(npy.array(cvs, dtype=float).reshape([self.dimensionality, -1]).transpose())
+    centers = [[cvv + cvs for cvv, cvs in zip(w.cv_values, w.cv_shifts)] for w in windows]
+    springs = [w.spring_constants for w in windows]
+    grid = BinGrid(self.cv_list)
+    t0 = time.time()
+    codes, free, counts, window_free_energies = SparseWham(samples, centers, springs, grid, self.temperature, wham_tolerance)
+    if self.grid_refinement:
+      grid = self.grid_refinement.Refine(self.cv_list, samples, codes, free)
+      codes, free, counts, window_free_energies = SparseWham(samples, centers, springs, grid, self.temperature,
+                                                             wham_tolerance)
+    logging.info("WHAM finished in {0}s".format(time.time() - t0))
+    points = grid.GetBinCenters(codes)
+    f = open(self.path_to_pmf_output, "w")
+    if self.grid_refinement:
+      f.write("#" + " ".join([cv.name for cv in self.cv_list]) + " Free Count Level\n")
+      for p, fe, c, level in zip(points, free, counts, grid.GetLevels(codes)):
+        f.write(" ".join(["{0:.10g}".format(el) for el in p]) + " {0:f} {1:d} {2:d}\n".format(fe, int(c), level))
+    else:
+      f.write("#" + " ".join([cv.name for cv in self.cv_list]) + " Free Count\n")
+      for p, fe, c in zip(points, free, counts):
+        f.write(" ".join(["{0:.10g}".format(el) for el in p]) + " {0:f} {1:d}\n".format(fe, int(c)))
+    f.close()
+
   def ReadPMFFile(self):
     """
     Read the PMF file generated by the *CalculatePMF* function.
     """
     f = open(self.path_to_pmf_output, "r")
     nd = self.dimensionality + 1
+    if self.dimensionality > 2 or self.grid_refinement:
+      # Sparse PMF file, with the number of samples of each bin in an additional column
+      nd += 1
+    if self.grid_refinement:
+      # and the level of each bin in the multi-resolution grid
+      nd += 1
     pmf = [[] for i in range(nd)]
     for l in f:
       if l.startswith("#"):
@@ -477,9 +1032,19 @@ class System():
         pmf[i].append(float(s[i]))
     f.close()
     pmf = npy.array(pmf)
-    if self.dimensionality == 1:
+    if self.grid_refinement:
+      pmf = pmf.reshape([nd, -1])
+      points = pmf[:-3, :].transpose()
+      grid = BuildAdaptiveGrid(self.cv_list, self.grid_refinement.max_level, points, pmf[-1, :])
+      self.pmf = SparsePMF(points, pmf[-3, :], pmf[-2, :],
+                           self.cv_list, 1.25 * self.max_E_plot, self.temperature, grid)
+    elif self.dimensionality == 1:
       self.pmf = PMF(pmf[0, :], pmf[1, :],
                      self.cv_list, 1.25 * self.max_E_plot)
+    elif self.dimensionality > 2:
+      pmf = pmf.reshape([nd, -1])
+      self.pmf = SparsePMF(pmf[:-2, :].transpose(), pmf[-2, :], pmf[-1, :],
+                           self.cv_list, 1.25 * self.max_E_plot, self.temperature)
     else:
       self.pmf = PMF(pmf[:-1, :].transpose(), pmf[-1, :],
                      self.cv_list, 1.25 * self.max_E_plot)
@@ -493,20 +1058,33 @@ class System():
     :type environment: :class:`~environment.Environment`
     """
     logging.info("Updating PMF")
-    self.UpdateDataFiles(n_skip, n_tot, new_only)
-    self.CalculatePMF(environment, wham_tolerance=wham_tolerance)
-    self.ReadPMFFile()
-    self.PlotPMF(fname_extension)
+    with Timer(self.metrics, "update_datafiles"):
+      self.UpdateDataFiles(n_skip, n_tot, new_only)
+    if self.min_overlap:
+      with Timer(self.metrics, "overlap"):
+        self.UpdateOverlapMatrix()
+        for w1, w2, o in self.GetPoorOverlaps():
+          logging.warning("Poor overlap between {0} and {1}: {2:.3f}".format(w1.name, w2.name, o))
+    with Timer(self.metrics, "wham"):
+      self.CalculatePMF(environment, wham_tolerance=wham_tolerance)
+    with Timer(self.metrics, "read_pmf"):
+      self.ReadPMFFile()
+      self.pmf.interpolator
+    with Timer(self.metrics, "plot"):
+      self.PlotPMF(fname_extension)
     # Windows get assigned the minimal free energy
-    steps = [npy.arange(-cv.step_size / 2., cv.step_size /
-                        2., cv.bin_size) for cv in self.cv_list]
-    delta_cv_list = list(itertools.product(*steps))
-    for window in self.windows:
-      El = [float(self.pmf.interpolator.__call__(tuple(npy.array(
-          window.cv_values) - npy.array(delta_cv)))) for delta_cv in delta_cv_list]
-      window.free_energy = min([el for el in El if not npy.isnan(el)])
-      window.curvatures = self.pmf.GetCurvatures(npy.array(
-          window.cv_values), npy.array([cv.step_size / 2. for cv in self.cv_list]))
+    with Timer(self.metrics, "free_energy"):
+      steps = [npy.arange(-cv.step_size / 2., cv.step_size /
+                          2., cv.bin_size) for cv in self.cv_list]
+      delta_cv_list = npy.array(list(itertools.product(*steps)))
+      # The points of all the windows are interpolated at once
+      cv_values = npy.array([window.cv_values for window in self.windows], dtype=float)
+      points = (cv_values[:, None, :] - delta_cv_list[None, :, :]).reshape([-1, self.dimensionality])
+      values = self.pmf.GetValues(points).reshape([len(self.windows), -1])
+      for window, El in zip(self.windows, values):
+        window.free_energy = min([el for el in El if not npy.isnan(el)])
+        window.curvatures = self.pmf.GetCurvatures(npy.array(
+            window.cv_values), npy.array([cv.step_size / 2. for cv in self.cv_list]))
 
   def ShiftWindowFreeEnergies(self, min_val=0):
     """
@@ -524,16 +1102,22 @@ class System():
 
   def PlotPMF(self, fname_extension="", xlim=[], ylim=[], arrows=True):
     """
-    Plot the PMF.
+    Plot the PMF. If a :class:`~plotting.PlotWorker` is attached to the system (*plot_worker*),
+    a snapshot of the PMF is sent to it and the plot is rendered in the background.
     """
     if self.pmf:
       filename = "pmf_{0}{1}".format(len(self.windows), fname_extension)
       if arrows:
-        self.pmf.Plot(self.pmf_dir, filename, max_E=self.max_E_plot,
-                      windows=self.windows, title=self.name, xlim=xlim, ylim=ylim)
+        windows = self.windows
+      else:
+        windows = None
+      if self.plot_worker and (self.pmf.dimensionality in [1, 2] or isinstance(self.pmf, SparsePMF)):
+        snapshot = self.pmf.GetPlotSnapshot(max_E=self.max_E_plot, windows=windows,
+                                            title=self.name, xlim=xlim, ylim=ylim)
+        self.plot_worker.Submit("pmf", snapshot, self.pmf_dir, filename)
       else:
         self.pmf.Plot(self.pmf_dir, filename, max_E=self.max_E_plot,
-                      title=self.name, xlim=xlim, ylim=ylim)
+                      windows=windows, title=self.name, xlim=xlim, ylim=ylim)
     else:
       logging.info("PMF has to be initialized before it can be plotted.")
 
@@ -553,8 +1137,12 @@ class System():
     :type environment: :class:`~environment.Environment`
     """
     self.UpdatePMF(environment)
-    self.PlotHistogram()
+    with Timer(self.metrics, "plot"):
+      self.PlotHistogram()
     fe_shift = self.ShiftWindowFreeEnergies()
+    n_adapted = 0
+    if self.adapt_poor_overlaps:
+      n_adapted = self.AdaptPoorOverlaps()
     current_windows = [tuple(w.cv_values) for w in self.windows]
     steps = [[-cv.step_size, 0, cv.step_size] for cv in self.cv_list]
     delta_cv_list = list(itertools.product(*steps))
@@ -594,10 +1182,9 @@ class System():
       # Estimate what the free energy in that window could be
       steps2 = [npy.arange(-cv.step_size / 2., cv.step_size /
                            2., cv.bin_size) for cv in self.cv_list]
-      delta_cv_list2 = list(itertools.product(*steps2))
+      delta_cv_list2 = npy.array(list(itertools.product(*steps2)))
       for cv_values in new_windows:
-        El = [float(self.pmf.interpolator.__call__(tuple(
-            npy.array(cv_values) - npy.array(delta_cv)))) for delta_cv in delta_cv_list2]
+        El = self.pmf.GetValues(npy.array(cv_values) - delta_cv_list2)
         try:
           new_windows[cv_values]["free_energy"] = min(
               [el for el in El if not npy.isnan(el)])
@@ -652,8 +1239,84 @@ class System():
             logging.info(
                 "Reached target CV value: cv={0}. Setting max_E2=max_E1".format(cv_values))
       if n_new_windows >= 1:
-        return n_new_windows, max_free_energy
-    return n_new_windows, max_free_energy
+        return n_new_windows + n_adapted, max_free_energy
+    return n_new_windows + n_adapted, max_free_energy
+
+  def UpdateOverlapMatrix(self):
+    """
+    Update the overlap matrix of neighboring windows (*overlap_matrix*) with the data of the phases that finished
+    since the last update (see :class:`~overlap.OverlapMatrix`).
+    """
+    self.overlap_matrix.Update(self)
+    return self.overlap_matrix
+
+  def GetPoorOverlaps(self, min_overlap=None):
+    """
+    Find the pairs of neighboring windows whose overlap is below *min_overlap* (by default *System.min_overlap*),
+    according to the last update of the overlap matrix (see *UpdateOverlapMatrix*).
+    Returns a list of tuples *(window1, window2, overlap)*, sorted by increasing overlap.
+
+    :param min_overlap: The minimal overlap
+    :type min_overlap: :class:`float`
+    """
+    if min_overlap is None:
+      min_overlap = self.min_overlap
+    if not min_overlap:
+      return []
+    return self.overlap_matrix.GetPoorOverlaps(self, min_overlap)
+
+  def AdaptPoorOverlaps(self):
+    """
+    Add windows to fill the gaps between poorly overlapping neighboring windows (see *GetPoorOverlaps*).
+    New windows are added at the same CV values as an existing window, so that the lattice of windows is unchanged,
+    but with a different spring constant along the direction of the gap:
+
+    - If the samples of one of the windows are pushed away from the other window (mean deviation from the center
+    of the restraint larger than a quarter of the step size), e.g. by a steep free energy gradient, a window with
+    twice the spring constant (at most *max_spring_constant*) is added at the CV values of that window.
+    - Otherwise the samples are too narrow and a window with half the spring constant (at least *min_spring_constant*)
+    is added at the CV values of the window with the stiffer spring.
+
+    Each window is adapted at most once per call. The new windows start from their parent window and get its free energy.
+    Returns the number of windows added.
+    """
+    n_new_windows = 0
+    adapted = set()
+    for w1, w2, o in self.GetPoorOverlaps():
+      m1 = self.overlap_matrix.GetMeanDeviation(w1)
+      m2 = self.overlap_matrix.GetMeanDeviation(w2)
+      if m1 is None or m2 is None:
+        continue
+      step = npy.array(w2.cv_values, dtype=float) - npy.array(w1.cv_values, dtype=float)
+      for j, cv in enumerate(self.cv_list):
+        if cv.periodicity:
+          step[j] = (step[j] + cv.periodicity / 2.0) % cv.periodicity - cv.periodicity / 2.0
+      i = int(npy.argmax(npy.abs(step)))
+      cv = self.cv_list[i]
+      direction = npy.sign(step[i])
+      # Positive when the samples are pushed away from the other window
+      push1 = -m1[i] * direction
+      push2 = m2[i] * direction
+      if max(push1, push2) > cv.step_size / 4.0:
+        window = w1 if push1 >= push2 else w2
+        k = min(2.0 * window.spring_constants[i], cv.max_spring_constant)
+      else:
+        window = w1 if w1.spring_constants[i] >= w2.spring_constants[i] else w2
+        k = max(window.spring_constants[i] / 2.0, cv.min_spring_constant)
+      if window in adapted or k == window.spring_constants[i]:
+        continue
+      adapted.add(window)
+      spring_constants = list(window.spring_constants)
+      spring_constants[i] = k
+      if self.FindWindow(window.cv_values, spring_constants):
+        continue
+      logging.info("Poor overlap between {0} and {1} ({2:.3f}), adding window with spring constants {3}".format(
+          w1.name, w2.name, o, spring_constants))
+      self.AddWindow(window.cv_values, spring_constants, list(window.cv_shifts), window)
+      self.windows[-1].free_energy = window.free_energy
+      self.windows[-1].curvatures = window.curvatures
+      n_new_windows += 1
+    return n_new_windows
 
   def CalculateWindowsHistConvergence(self, environment, n_skip_list, n_tot_list, update_data_files=True, pool_windows=False):
     logging.info("Calculating histogram convergence for each window")
@@ -676,16 +1339,9 @@ class System():
     for wl in windows_list:
       data_list = []
       for window in wl:
-        data = [[] for i in range(self.dimensionality)]
-        if not os.path.isfile(window.path_to_datafile):
+        if not self.fs_snapshot.IsFile(window.path_to_datafile):
           continue
-        f = open(window.path_to_datafile, "r")
-        for l in f:
-          s = l.split()
-          for i in range(self.dimensionality):
-            data[i].append(float(s[i + 1]))
-        f.close()
-        data_list.append(data)
+        data_list.append(window.ReadDataFile()[1])
       hist_range = [(cv.min_value, cv.max_value) for cv in self.cv_list]
       bins = [self.cv_list[0].num_bins, self.cv_list[1].num_bins]
       hist_list = []
@@ -747,50 +1403,24 @@ class System():
 
   def PlotHistogram(self, fname_extension=""):
     """
-    Plots the histogram of the accumulated data.
+    Plots the histogram of the accumulated data. If a :class:`~plotting.PlotWorker` is attached
+    to the system (*plot_worker*), the datafiles are read and the histogram is rendered in the background.
     """
-    data = [[] for i in range(self.dimensionality)]
-    for window in self.windows:
-      if not os.path.isfile(window.path_to_datafile):
-        continue
-      f = open(window.path_to_datafile, "r")
-      for l in f:
-        s = l.split()
-        for i in range(self.dimensionality):
-          data[i].append(float(s[i + 1]))
-      f.close()
     filename = "histogram_{0}{1}".format(
         len(self.windows), fname_extension)
-    hist_range = [(cv.min_value, cv.max_value) for cv in self.cv_list]
-    plt.figure()
-    if self.dimensionality == 2:
-      bins = [self.cv_list[0].num_bins, self.cv_list[1].num_bins]
-      hist_range = [(self.cv_list[0].min_value, self.cv_list[0].max_value),
-                    (self.cv_list[1].min_value, self.cv_list[1].max_value)]
-      plt.hist2d(data[0], data[1], range=hist_range, bins=bins)
-      if self.cv_list[0].units:
-        plt.xlabel("{0} [{1}]".format(
-            self.cv_list[0].name, self.cv_list[0].units))
-      else:
-        plt.xlabel("{0}".format(self.cv_list[0].name))
-      if self.cv_list[1].units:
-        plt.ylabel("{0} [{1}]".format(
-            self.cv_list[1].name, self.cv_list[1].units))
-      else:
-        plt.ylabel("{0}".format(self.cv_list[1].name))
-      plt.colorbar()
-    elif self.dimensionality == 1:
-      bins = self.cv_list[0].num_bins
-      plt.hist(data[0], bins=bins, range=hist_range[0])
-      if self.cv_list[0].units:
-        plt.xlabel("{0} [{1}]".format(
-            self.cv_list[0].name, self.cv_list[0].units))
-      else:
-        plt.xlabel("{0}".format(self.cv_list[0].name))
-      plt.ylabel("Count")
-    plt.title(self.name)
-    plt.savefig(os.path.join(self.hist_dir, filename))
-    plt.close()
+    windows = [w for w in self.windows if self.fs_snapshot.IsFile(w.path_to_datafile)]
+    # The background process only reads the lines already written, in case data gets appended meanwhile
+    if self.plot_worker:
+      datafiles = [(window.path_to_datafile, window.datafile_n_data_tot)
+                   for window in windows]
+    else:
+      datafiles = [(window.path_to_datafile, -1) for window in windows]
+    snapshot = {"datafiles": datafiles,
+                "cv_list": self.cv_list, "title": self.name}
+    if self.plot_worker:
+      self.plot_worker.Submit("histogram", snapshot, self.hist_dir, filename)
+    else:
+      plotting.PlotHistogramSnapshot(snapshot, self.hist_dir, filename)
 
   def SetNewBaseDir(self, basedir):
     self.basedir = basedir
@@ -840,42 +1470,109 @@ class System():
         plt.close()
   """
 
-  def CalculateDiffusionConstants(self, dt_per_step, masses, new_only=False):
-    import MC_on_pmf
+  def CalculateDiffusionConstants(self, dt_per_step, masses, new_only=False, n_procs=None, plot=False):
+    """
+    Calculate the diffusion constant of every CV in every window, by fitting the autocorrelation of the CV
+    with that of a harmonically restrained brownian particle. The fits of the different windows are run in a
+    pool of *n_procs* processes. The results are cached per window, keyed on the set of phases contributing to the
+    window's datafile, so that only windows for which new data has been added are fitted again.
+
+    :param dt_per_step: Time (in ps) between two consecutive data points in the datafiles.
+    :param masses: The mass (in amu) associated with each CV.
+    :param new_only: Only fit windows that do not have any diffusion constants yet.
+    :param n_procs: Number of processes used for the fits. *None* uses all the available cores.
+    :param plot: Plot the fits (see *PlotDiffusionConstants*).
+    :type dt_per_step: :class:`float`
+    :type masses: :class:`list` (:class:`float`)
+    :type new_only: :class:`bool`
+    :type n_procs: :class:`int`
+    :type plot: :class:`bool`
+    """
+    windows = []
+    tasks = []
+    for w in self.windows:
+      if new_only == True and hasattr(w, "diffusion_constants"):
+        continue
+      key = frozenset([p.name for p in w.phases if p.data_added_to_window])
+      if hasattr(w, "diffusion_constants") and getattr(w, "diffusion_key", None) == key:
+        continue
+      if not self.fs_snapshot.IsFile(w.path_to_datafile):
+        continue
+      windows.append((w, key))
+      tasks.append((w.path_to_datafile, self.dimensionality, dt_per_step, masses,
+                    w.spring_constants, self.temperature))
+    logging.info("Fitting diffusion constants for {0} windows".format(len(tasks)))
+    if n_procs == 1 or len(tasks) <= 1:
+      results = map(_FitDiffusionConstants, tasks)
+    else:
+      import multiprocessing
+      pool = multiprocessing.Pool(n_procs)
+      try:
+        results = pool.map(_FitDiffusionConstants, tasks)
+      finally:
+        pool.close()
+        pool.join()
+    for (w, key), (diffusion_constants, fits) in zip(windows, results):
+      w.diffusion_constants = diffusion_constants
+      w.diffusion_fits = fits
+      w.diffusion_key = key
+    if plot:
+      self.PlotDiffusionConstants([w for w, key in windows])
+
+  def PlotDiffusionConstants(self, windows=None):
+    """
+    Plot the autocorrelation of the CVs and the fits obtained with *CalculateDiffusionConstants*.
+    The plots are saved in *basedir/diffusion*.
+
+    :param windows: The windows for which to plot the fits. By default all windows are plotted.
+    :type windows: :class:`list` (:class:`~window.Window`)
+    """
+    import matplotlib.pyplot as plt
+    if windows is None:
+      windows = self.windows
     if not hasattr(self, "diffusion_dir"):
       self.diffusion_dir = os.path.join(self.basedir, "diffusion")
     if not os.path.isdir(self.diffusion_dir):
       os.system("mkdir -p {0}".format(self.diffusion_dir))
-    for w in self.windows:
-      if new_only == True and hasattr(w, "diffusion_constants"):
+    for w in windows:
+      if not hasattr(w, "diffusion_fits"):
         continue
-      w.diffusion_constants = []
-      data = w.ReadDataFile()
-      t = npy.array(data[0]) * dt_per_step
-      for cv, xl, m, cv_val, cv_K in zip(self.cv_list, data[1], masses, w.cv_values, w.spring_constants):
-        def fun2(t, D, a, b):
-          return _fun(t, cv_K, m, self.temperature, D, a, b)
-        x = npy.array(xl)
-        # x=x-cv_val
-        x = x - npy.mean(x)
-        Cx = MC_on_pmf.autocorrelation(x) * npy.mean(x * x)
-        t = t - t[0]
-        # n=3*npy.argmin(Cx)
-        # print n,len(t),len(Cx)
-        n = 100
-        p, c = curve_fit(fun2, t[:n], Cx[:n], [1.0, 0.0, 1.0])
+      for cv, (t, Cx, Cx_fit) in zip(self.cv_list, w.diffusion_fits):
         plt.figure()
-        plt.plot(t[:n], Cx[:n])
-        plt.plot(t[:n], fun2(t, *p)[:n], '--', color='r')
+        plt.plot(t, Cx)
+        plt.plot(t, Cx_fit, '--', color='r')
         outname = "Ds_cv_{0}_{1}.png".format(
             "_".join([str(el) for el in w.cv_values]), cv.name)
         plt.savefig(os.path.join(self.diffusion_dir, outname))
         plt.close()
-        D = p[0]  # D is in A^2/ps
-        w.diffusion_constants.append(D)
 
 
-from scipy.optimize import curve_fit
+def _FitDiffusionConstants(args):
+  """
+  Fit the diffusion constants of the CVs for one window. This is run in the worker
+  processes of *System.CalculateDiffusionConstants*, so it only gets picklable arguments.
+  Returns the list of diffusion constants (in A^2/ps) and for each CV the time, the
+  autocorrelation and the fitted autocorrelation.
+  """
+  import MC_on_pmf
+  from scipy.optimize import curve_fit
+  path_to_datafile, dimensionality, dt_per_step, masses, spring_constants, temperature = args
+  data = _ReadWindowDataFile(path_to_datafile, dimensionality)
+  t = npy.array(data[0]) * dt_per_step
+  diffusion_constants = []
+  fits = []
+  for xl, m, cv_K in zip(data[1], masses, spring_constants):
+    def fun2(t, D, a, b):
+      return _fun(t, cv_K, m, temperature, D, a, b)
+    x = npy.array(xl)
+    x = x - npy.mean(x)
+    Cx = MC_on_pmf.autocorrelation(x) * npy.mean(x * x)
+    t = t - t[0]
+    n = 100
+    p, c = curve_fit(fun2, t[:n], Cx[:n], [1.0, 0.0, 1.0])
+    fits.append((t[:n], Cx[:n], fun2(t, *p)[:n]))
+    diffusion_constants.append(p[0])  # D is in A^2/ps
+  return diffusion_constants, fits
 
 
 def _fun(t, K, m, T, D, a, b):
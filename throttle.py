@@ -0,0 +1,111 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+This module contains the :class:`SubmissionThrottle` class, which limits the number of jobs waiting in the queue
+or running and decides which windows get a job first.
+"""
+import logging
+import numpy as npy
+
+__all__ = ('SubmissionThrottle',)
+
+
+class SubmissionThrottle():
+  """
+  Backpressure on the submission of jobs, used by :class:`~sipmf.SiPMF` and :class:`~multi.MultiSiPMF`.
+  The number of jobs waiting in the queue or running is kept below *max_running_jobs*. These are counted from the
+  unfinished jobs of the supervised systems or, with *count_queue*, read from the queuing system at every cycle
+  (with the *qstat_all_command* of the :class:`~environment.Environment`), so that jobs submitted by other
+  processes of the same user count too. The higher of the two counts is used, as the jobs submitted during the cycle
+  are not in the listing of the queue yet. Jobs are counted as in the queue: phases sharing a job (replica-exchange blocks
+  and packed bundles) count as one job.
+
+  Windows that need a job while no slot is free wait in the list of updated windows of their system, which is
+  ordered as a priority queue: windows with the lowest free energy first (for windows that do not have a free energy
+  yet, the free energy of their parent), lowered by *aging* for each cycle the window has waited, so that no window
+  waits forever. Windows with the same priority are ordered by age, the oldest window first.
+  """
+
+  def __repr__(self):
+    return "SubmissionThrottle({0},{1},{2})".format(self.max_running_jobs, self.count_queue, self.aging)
+
+  def __init__(self, max_running_jobs, count_queue=False, aging=0.5):
+    """
+    :param max_running_jobs: Maximal number of jobs waiting in the queue or running.
+    :param count_queue: Count the jobs in the queue from the queuing system rather than from the supervised systems.
+    :param aging: Decrease of the priority free energy of a window (kcal/mol) for each cycle it waited for a job.
+    :type max_running_jobs: :class:`int`
+    :type count_queue: :class:`bool`
+    :type aging: :class:`float`
+    """
+    self.max_running_jobs = max_running_jobs
+    self.count_queue = count_queue
+    self.aging = aging
+    self.n_waiting_cycles = {}
+    self.n_queued = None
+    self.n_submitted = 0
+
+  def StartCycle(self, queue=None):
+    """
+    Start a new cycle, with the jobs listed by the queuing system (see :func:`~environment.ListQueue`),
+    *None* if they are not known.
+
+    :param queue: The status of the jobs in the queue, by job ID
+    :type queue: :class:`dict`
+    """
+    self.n_queued = len(queue) if queue is not None and self.count_queue else None
+    self.n_submitted = 0
+
+  def RecordSubmitted(self, n_jobs):
+    """
+    Count jobs submitted during the cycle (see *System.SubmitNewJobs*).
+    """
+    self.n_submitted += n_jobs
+
+  def GetFreeSlots(self, systems):
+    """
+    Number of jobs that can be submitted.
+
+    :param systems: The supervised systems
+    :type systems: :class:`list` (:class:`~system.System`)
+    """
+    n_running = sum([len(set([job.jid for job in system.unfinished_jobs])) for system in systems])
+    if self.n_queued is not None:
+      n_running = max(n_running, self.n_queued + self.n_submitted)
+    return max(self.max_running_jobs - n_running, 0)
+
+  def GetPriority(self, window):
+    """
+    Priority free energy of a window, lower values getting a job first.
+    """
+    free_energy = getattr(window, "free_energy", None)
+    if (free_energy is None or npy.isnan(free_energy)) and window.parent is not None:
+      free_energy = getattr(window.parent, "free_energy", None)
+    if free_energy is None or npy.isnan(free_energy):
+      free_energy = 0.0
+    return free_energy - self.aging * self.n_waiting_cycles.get(window, 0)
+
+  def Order(self, system):
+    """
+    Order the updated windows of a system by priority (see *GetPriority*), then by age.
+
+    :param system: The system
+    :type system: :class:`~system.System`
+    """
+    age = dict((w, i) for i, w in enumerate(system.windows))
+    system.updated_windows = sorted(system.updated_windows, key=lambda w: (self.GetPriority(w), age.get(w, -1)))
+
+  def EndCycle(self, systems):
+    """
+    Count one more cycle for the windows still waiting for a job.
+
+    :param systems: The supervised systems
+    :type systems: :class:`list` (:class:`~system.System`)
+    """
+    waiting = {}
+    for system in systems:
+      for window in system.updated_windows:
+        waiting[window] = self.n_waiting_cycles.get(window, 0) + 1
+    self.n_waiting_cycles = waiting
+    if waiting:
+      logging.info("{0} windows are waiting for a free job slot".format(len(waiting)))
@@ -0,0 +1,575 @@
+"""
+.. codeauthor:: Niklaus Johner <niklaus.johner@a3.epfl.ch>
+
+This module contains an in-process implementation of WHAM for any number of CVs (:func:`SparseWham`),
+which only stores the bins of the histogram that contain data, and the :class:`BinGrid` class
+defining that histogram. It is used by *System.CalculatePMF* for more than two CVs, where the
+WHAM programs of A. Grossfield cannot be used and a dense histogram would be far too large.
+The :class:`AdaptiveGrid` class is a multi-resolution histogram whose bins are only refined where needed
+(see :class:`GridRefinement`), and can be used by :func:`SparseWham` in place of a :class:`BinGrid`.
+"""
+import logging
+import itertools
+import numpy as npy
+
+__all__ = ('BinGrid', 'AdaptiveGrid', 'BuildAdaptiveGrid', 'GridRefinement', 'SparseWham')
+
+kB = 0.0019872041  # kcal/mol
+
+
+class BinGrid():
+  """
+  Regular histogram on the CVs used for the PMF, defined by the *wham_min_value*, *wham_max_value*
+  and *wham_num_bins* of each CV. A bin is identified by its flat index (row-major order of its indices
+  along each CV), stored as a 64 bit integer, so that only the bins that are used need to be stored
+  whatever the number of bins of the whole histogram.
+  With a *refinement* of *n*, each bin is split in *2^n* bins along each CV.
+  """
+
+  def __repr__(self):
+    return "BinGrid({0})".format(self.cv_list)
+
+  def __init__(self, cv_list, refinement=0):
+    """
+    :param cv_list: List of the CVs
+    :param refinement: Number of times the bins are split in two along each CV
+    :type cv_list: :class:`list` (:class:`~colvar.CollectiveVariable`)
+    :type refinement: :class:`int`
+    """
+    self.cv_list = cv_list
+    self.dimensionality = len(cv_list)
+    self.mins = npy.array([cv.wham_min_value for cv in cv_list], dtype=float)
+    self.maxs = npy.array([cv.wham_max_value for cv in cv_list], dtype=float)
+    self.num_bins = npy.array([cv.wham_num_bins * 2**refinement for cv in cv_list], dtype=npy.int64)
+    self.widths = (self.maxs - self.mins) / self.num_bins
+    self.periods = npy.array([cv.periodicity if cv.periodicity else 0.0 for cv in cv_list], dtype=float)
+    self.strides = npy.array([npy.prod(self.num_bins[i + 1:]) for i in range(self.dimensionality)], dtype=npy.int64)
+
+  def GetBinIndices(self, points):
+    """
+    Indices along each CV of the bins containing the points, one row per point.
+    """
+    x = npy.array(points, dtype=float).reshape([-1, self.dimensionality])
+    return npy.floor((x - self.mins) / self.widths).astype(npy.int64)
+
+  def GetFlatIndices(self, indices):
+    """
+    Flat indices of the bins given by their indices along each CV (one row per bin). Indices along periodic
+    CVs are wrapped, bins outside of the histogram get a flat index of -1.
+    """
+    idx = npy.array(indices, dtype=npy.int64).reshape([-1, self.dimensionality])
+    periodic = self.periods > 0
+    if npy.any(periodic):
+      idx = idx.copy()
+      idx[:, periodic] %= self.num_bins[periodic]
+    valid = npy.all((idx >= 0) & (idx < self.num_bins), axis=1)
+    flat = npy.dot(idx, self.strides)
+    flat[~valid] = -1
+    return flat
+
+  def GetBinCenters(self, flat):
+    """
+    Values of the CVs at the centers of the bins given by their flat indices, one row per bin.
+    """
+    idx = (npy.array(flat, dtype=npy.int64).reshape([-1, 1]) // self.strides) % self.num_bins
+    return self.mins + (idx + 0.5) * self.widths
+
+  def GetCodes(self, points):
+    """
+    Flat indices of the bins containing the points, -1 for the points outside of the histogram.
+    """
+    return self.GetFlatIndices(self.GetBinIndices(points))
+
+  def GetBinVolumes(self, codes):
+    """
+    Volumes of the bins given by their flat indices, relative to the volume of a bin of the histogram (always 1).
+    """
+    return npy.ones(len(codes))
+
+  def GetBaseIndices(self, codes):
+    """
+    Indices along each CV of the bins given by their flat indices, one row per bin.
+    """
+    return (npy.array(codes, dtype=npy.int64).reshape([-1, 1]) // self.strides) % self.num_bins
+
+  def GetCornerCodes(self, points):
+    """
+    Bins used to interpolate multilinearly at the given points: the *2^d* bins whose centers are the corners of the cell
+    containing each point. Returns the flat indices of these bins and their weights, with one row per corner and one
+    column per point.
+    """
+    x = npy.array(points, dtype=float).reshape([-1, self.dimensionality])
+    u = (x - self.mins) / self.widths - 0.5
+    i0 = npy.floor(u).astype(npy.int64)
+    t = u - i0
+    corners = npy.array(list(itertools.product([0, 1], repeat=self.dimensionality)))
+    codes = npy.array([self.GetFlatIndices(i0 + c) for c in corners]).reshape([len(corners), len(x)])
+    weights = npy.array([npy.prod(npy.where(c, t, 1.0 - t), axis=1) for c in corners]).reshape([len(corners), len(x)])
+    return codes, weights
+
+  def Delta(self, x, center):
+    """
+    Difference between the points *x* and *center*, taking the periodicity of the CVs into account.
+    """
+    d = x - center
+    periodic = self.periods > 0
+    if npy.any(periodic):
+      p = self.periods[periodic]
+      d[..., periodic] -= p * npy.round(d[..., periodic] / p)
+    return d
+
+
+class AdaptiveGrid():
+  """
+  Multi-resolution histogram on the CVs used for the PMF, in the style of a quadtree (two CVs) or an octree
+  (three CVs). Level 0 is the :class:`BinGrid` of the CVs, and each bin of level *L* can be refined into the *2^d* bins
+  of level *L+1* that it contains (the :class:`BinGrid` with a *refinement* of *L+1*). The bins of the histogram are
+  the bins that are not refined (the leaves of the tree), so that only refined regions have a high resolution while
+  the rest of the histogram keeps the resolution of level 0. Only the flat indices of the refined bins of each level
+  are stored (*refined*).
+
+  A bin of level *L* is identified by its flat index on the grid of level *L* plus the number of bins of all the coarser
+  levels (*offsets*), so that the bins of all levels are numbered like the bins of a :class:`BinGrid` and can be used by
+  :func:`SparseWham` and :class:`~pmf.SparsePMF` in the same way.
+  """
+
+  def __repr__(self):
+    return "AdaptiveGrid({0},{1},{2})".format(self.cv_list, self.max_level, [len(r) for r in self.refined])
+
+  def __init__(self, cv_list, max_level, refined=None):
+    """
+    :param cv_list: List of the CVs
+    :param max_level: Maximal level of refinement
+    :param refined: Flat indices of the refined bins of each level from 0 to *max_level-1*. By default no bin is refined.
+    :type cv_list: :class:`list` (:class:`~colvar.CollectiveVariable`)
+    :type max_level: :class:`int`
+    :type refined: :class:`list` (:class:`numpy.array`)
+    """
+    self.cv_list = cv_list
+    self.dimensionality = len(cv_list)
+    self.max_level = max_level
+    self.levels = [BinGrid(cv_list, level) for level in range(max_level + 1)]
+    sizes = [int(npy.prod(level.num_bins)) for level in self.levels]
+    self.offsets = npy.cumsum([0] + sizes[:-1]).astype(npy.int64)
+    if refined is None:
+      refined = [[] for level in range(max_level)]
+    self.refined = [npy.unique(npy.array(r, dtype=npy.int64)) for r in refined]
+    base = self.levels[0]
+    self.mins = base.mins
+    self.maxs = base.maxs
+    self.periods = base.periods
+    self.num_bins = base.num_bins
+    self.widths = base.widths
+    self.strides = base.strides
+
+  def GetLevels(self, codes):
+    """
+    Levels of the bins given by their codes (-1 for a code of -1).
+    """
+    return npy.searchsorted(self.offsets, npy.array(codes, dtype=npy.int64).ravel(), "right") - 1
+
+  def GetCodes(self, points):
+    """
+    Codes of the bins (leaves) containing the points, -1 for the points outside of the histogram.
+    The points go down the levels as long as the bin containing them is refined.
+    """
+    x = npy.array(points, dtype=float).reshape([-1, self.dimensionality])
+    codes = npy.full(len(x), -1, dtype=npy.int64)
+    active = npy.arange(len(x))
+    for level, grid in enumerate(self.levels):
+      flat = grid.GetCodes(x[active])
+      inside = flat >= 0
+      if level < self.max_level:
+        refined = inside & _Contains(self.refined[level], flat)
+      else:
+        refined = npy.zeros(len(flat), dtype=bool)
+      leaf = inside & ~refined
+      codes[active[leaf]] = self.offsets[level] + flat[leaf]
+      active = active[refined]
+      if len(active) == 0:
+        break
+    return codes
+
+  def GetBinCenters(self, codes):
+    """
+    Values of the CVs at the centers of the bins given by their codes, one row per bin.
+    """
+    codes = npy.array(codes, dtype=npy.int64).ravel()
+    levels = self.GetLevels(codes)
+    centers = npy.zeros([len(codes), self.dimensionality])
+    for level in npy.unique(levels):
+      sel = levels == level
+      centers[sel] = self.levels[level].GetBinCenters(codes[sel] - self.offsets[level])
+    return centers
+
+  def GetBinVolumes(self, codes):
+    """
+    Volumes of the bins given by their codes, relative to the volume of a bin of level 0.
+    """
+    return 0.5**(self.dimensionality * self.GetLevels(codes))
+
+  def GetBaseIndices(self, codes):
+    """
+    Indices along each CV of the bins of level 0 containing the bins given by their codes, one row per bin.
+    """
+    return self.levels[0].GetBinIndices(self.GetBinCenters(codes))
+
+  def GetCornerCodes(self, points):
+    """
+    Bins used to interpolate multilinearly at the given points (see :meth:`BinGrid.GetCornerCodes`). The interpolation
+    is done on the grid of the level of the bin containing each point, the value at a corner being the one of the bin
+    containing that corner, so that the interpolation has the resolution of the histogram around each point.
+    """
+    x = npy.array(points, dtype=float).reshape([-1, self.dimensionality])
+    n_corners = 2**self.dimensionality
+    codes = npy.full([n_corners, len(x)], -1, dtype=npy.int64)
+    weights = npy.zeros([n_corners, len(x)])
+    levels = self.GetLevels(self.GetCodes(x))
+    corners = npy.array(list(itertools.product([0, 1], repeat=self.dimensionality)))
+    for level in npy.unique(levels[levels >= 0]):
+      sel = npy.where(levels == level)[0]
+      grid = self.levels[level]
+      u = (x[sel] - grid.mins) / grid.widths - 0.5
+      i0 = npy.floor(u)
+      t = u - i0
+      for k, c in enumerate(corners):
+        weights[k, sel] = npy.prod(npy.where(c, t, 1.0 - t), axis=1)
+        codes[k, sel] = self.GetCodes(grid.mins + (i0 + c + 0.5) * grid.widths)
+    return codes, weights
+
+  def Delta(self, x, center):
+    """
+    Difference between the points *x* and *center*, taking the periodicity of the CVs into account.
+    """
+    return self.levels[0].Delta(x, center)
+
+
+def BuildAdaptiveGrid(cv_list, max_level, points, levels):
+  """
+  Rebuild an :class:`AdaptiveGrid` from some of its bins (e.g. the bins of a PMF file), given by their centers and
+  levels. The bins of the coarser levels containing these bins are refined.
+
+  :param cv_list: List of the CVs
+  :param max_level: Maximal level of refinement
+  :param points: Values of the CVs at the centers of the bins, one row per bin.
+  :param levels: Level of each bin
+  :type cv_list: :class:`list` (:class:`~colvar.CollectiveVariable`)
+  :type max_level: :class:`int`
+  :type points: :class:`numpy.array`
+  :type levels: :class:`numpy.array`
+  """
+  grid = AdaptiveGrid(cv_list, max_level)
+  points = npy.array(points, dtype=float).reshape([-1, grid.dimensionality])
+  levels = npy.array(levels, dtype=int).ravel()
+  return AdaptiveGrid(cv_list, max_level, [grid.levels[level].GetCodes(points[levels > level])
+                                           for level in range(max_level)])
+
+
+class GridRefinement():
+  """
+  Policy deciding which bins of an :class:`AdaptiveGrid` are refined, used by *System.CalculateSparsePMF*.
+  The PMF is first calculated on level 0 (the :class:`BinGrid` of the CVs), which gives the change of the free energy
+  across each bin (the sum over the CVs of the absolute differences with the neighboring bins).
+  A bin of level *L* is refined if the free energy changes by more than *max_delta* across it (the change across
+  its bin of level 0 divided by *2^L*) and if it contains enough samples for each of its *2^d* sub-bins to have
+  *min_samples* samples on average, up to level *max_level*. Bins in flat or poorly sampled regions are not refined,
+  so that the resolution at barriers does not cost a dense fine histogram.
+  """
+
+  def __repr__(self):
+    return "GridRefinement({0},{1},{2})".format(self.max_level, self.min_samples, self.max_delta)
+
+  def __init__(self, max_level=2, min_samples=20, max_delta=0.5):
+    """
+    :param max_level: Maximal level of refinement. Bins of level *max_level* are *2^max_level* times smaller than
+     the bins of level 0 along each CV.
+    :param min_samples: Minimal average number of samples in the bins obtained by refining a bin.
+    :param max_delta: Maximal change of the free energy across a bin that is not refined (kcal/mol).
+    :type max_level: :class:`int`
+    :type min_samples: :class:`int`
+    :type max_delta: :class:`float`
+    """
+    self.max_level = max_level
+    self.min_samples = min_samples
+    self.max_delta = max_delta
+
+  def Refine(self, cv_list, samples, codes, free):
+    """
+    Build the :class:`AdaptiveGrid` for the given samples and PMF on level 0.
+
+    :param cv_list: List of the CVs
+    :param samples: The values of the CVs sampled in each window, one array with one row per sample for each window.
+    :param codes: Flat indices of the bins of level 0 with data, sorted, as returned by :func:`SparseWham`.
+    :param free: Free energy of these bins
+    :type cv_list: :class:`list` (:class:`~colvar.CollectiveVariable`)
+    :type samples: :class:`list` (:class:`numpy.array`)
+    :type codes: :class:`numpy.array`
+    :type free: :class:`numpy.array`
+    """
+    grid = AdaptiveGrid(cv_list, self.max_level)
+    d = grid.dimensionality
+    codes = npy.array(codes, dtype=npy.int64)
+    candidates = codes
+    changes = _FreeEnergyChanges(grid.levels[0], codes, npy.array(free, dtype=float))
+    x = npy.concatenate([npy.array(s, dtype=float).reshape([-1, d]) for s in samples]) if samples else npy.zeros([0, d])
+    children = npy.array(list(itertools.product([0, 1], repeat=d)))
+    refined = []
+    for level in range(self.max_level):
+      fine = grid.levels[level]
+      flat = fine.GetCodes(x)
+      cells, counts = npy.unique(flat[flat >= 0], return_counts=True)
+      n = npy.zeros(len(candidates))
+      if len(cells):
+        pos = npy.minimum(npy.searchsorted(cells, candidates), len(cells) - 1)
+        found = cells[pos] == candidates
+        n[found] = counts[pos[found]]
+      ok = (n >= self.min_samples * 2**d) & (changes / 2.0**level > self.max_delta)
+      refined.append(candidates[ok])
+      idx = fine.GetBaseIndices(candidates[ok])
+      candidates = npy.concatenate([grid.levels[level + 1].GetFlatIndices(2 * idx + c) for c in children])
+      changes = npy.tile(changes[ok], len(children))
+    logging.info("Refined bins on each level of the grid: {0}".format([len(r) for r in refined]))
+    return AdaptiveGrid(cv_list, self.max_level, refined)
+
+
+def SparseWham(samples, centers, springs, grid, temperature, tolerance=0.001, bias_cutoff=12.5, max_iterations=100000):
+  """
+  Solve the WHAM equations on the bins of *grid* that contain samples. The restraining potentials are
+  *1/2 k (x-x0)^2*, energies are in kcal/mol. The restraining potential of a window is only evaluated on the
+  bins where it is below *bias_cutoff* (in kT), and these bins are found through a hash of the centers of the windows,
+  so that memory and time scale with the number of bins that contain data rather than with the size of the histogram.
+  The free energies of the windows are initialized from the histograms of neighboring windows, which keeps the number
+  of iterations small even with many windows.
+
+  Returns a tuple with the codes of the bins with data (their flat indices for a :class:`BinGrid`, sorted), their free
+  energy (the minimum being 0),
+  their number of samples and the free energies of the windows.
+
+  :param samples: The values of the CVs sampled in each window, one array with one row per sample for each window.
+  :param centers: Centers of the restraining potentials of the windows, one row per window.
+  :param springs: Spring constants of the restraining potentials of the windows, one row per window.
+  :param grid: The histogram
+  :param temperature: The temperature
+  :param tolerance: The iterations stop when the free energies of the windows change less than *tolerance*.
+  :param bias_cutoff: Restraining potentials above this value (in kT) are neglected.
+  :param max_iterations: Maximal number of iterations.
+  :type samples: :class:`list` (:class:`numpy.array`)
+  :type centers: :class:`numpy.array`
+  :type springs: :class:`numpy.array`
+  :type grid: :class:`BinGrid` or :class:`AdaptiveGrid`
+  :type temperature: :class:`float`
+  :type tolerance: :class:`float`
+  :type bias_cutoff: :class:`float`
+  :type max_iterations: :class:`int`
+  """
+  kT = kB * temperature
+  d = grid.dimensionality
+  centers = npy.array(centers, dtype=float).reshape([-1, d])
+  springs = npy.array(springs, dtype=float).reshape([-1, d])
+  n_windows = len(centers)
+  flats = []
+  for s in samples:
+    flat = grid.GetCodes(s)
+    flats.append(flat[flat >= 0])
+  codes = npy.unique(npy.concatenate(flats)) if flats else npy.zeros(0, dtype=npy.int64)
+  n_bins = len(codes)
+  if n_bins == 0:
+    return codes, npy.zeros(0), npy.zeros(0), npy.zeros(n_windows)
+  # Number of samples of each window in each bin, bins being numbered by their position in codes
+  pairs = npy.concatenate([i * n_bins + npy.searchsorted(codes, flat) for i, flat in enumerate(flats)])
+  pair_codes, counts = npy.unique(pairs, return_counts=True)
+  tw, tb, tu = _BiasTriples(grid, codes, centers, springs, bias_cutoff * kT)
+  # Samples beyond the cutoff of their own window are ignored. The triples are sorted by window and bin.
+  triple_codes = tw.astype(npy.int64) * n_bins + tb
+  pos = npy.minimum(npy.searchsorted(triple_codes, pair_codes), max(len(triple_codes) - 1, 0))
+  found = triple_codes[pos] == pair_codes if len(triple_codes) else npy.zeros(len(pair_codes), dtype=bool)
+  count_windows = (pair_codes[found] // n_bins).astype(int)
+  count_bins = (pair_codes[found] % n_bins).astype(int)
+  counts = counts[found].astype(float)
+  n_samples = npy.bincount(count_windows, weights=counts, minlength=n_windows)
+  numerator = npy.bincount(count_bins, weights=counts, minlength=n_bins)
+  f = _InitialFreeEnergies(n_windows, count_windows, count_bins, counts,
+                           npy.maximum(n_samples, 1), tu[pos[found]], kT)
+  # Windows without samples do not contribute to the PMF
+  has_data = n_samples > 0
+  keep = has_data[tw]
+  tw, tb = tw[keep], tb[keep]
+  if len(tw) == 0:
+    return codes[:0], npy.zeros(0), npy.zeros(0), f
+  # The biases are below the cutoff, so that their Boltzmann factors are computed once. The free energies
+  # of the windows are shifted to a maximum of 0 before being exponentiated, so that they can span many kT.
+  boltzmann = npy.exp(-tu[keep] / kT)
+  sampled = npy.bincount(tw, minlength=n_windows) > 0
+  g = f / kT
+  p = npy.zeros(n_bins)
+  for it in range(max_iterations):
+    weights = n_samples * npy.exp(g - npy.max(g[has_data]))
+    denominator = npy.bincount(tb, weights=weights[tw] * boltzmann, minlength=n_bins)
+    p[:] = 0.0
+    positive = denominator > 0
+    p[positive] = numerator[positive] / denominator[positive]
+    z = npy.bincount(tw, weights=p[tb] * boltzmann, minlength=n_windows)
+    new_g = g.copy()
+    update = sampled & (z > 0)
+    new_g[update] = -npy.log(z[update])
+    new_g -= new_g[0]
+    change = kT * npy.max(npy.abs(new_g - g)[has_data])
+    g = new_g
+    if change < tolerance:
+      break
+  logging.info("WHAM converged in {0} iterations for {1} bins and {2} windows".format(it + 1, n_bins, n_windows))
+  finite = p > 0
+  # The free energy is given by the probability density, which matters for bins of different sizes
+  free = -kT * npy.log(p[finite] / grid.GetBinVolumes(codes[finite]))
+  free -= npy.min(free)
+  return codes[finite], free, numerator[finite], g * kT
+
+
+def _BiasTriples(grid, codes, centers, springs, max_bias):
+  """
+  Sparse representation of the restraining potentials: arrays *(window, bin, bias)* for the bins with data
+  where the bias of the window is below *max_bias*, sorted by window and bin. The centers of the windows
+  are hashed into cells at least as large as the cutoff radius, so that only the windows of the neighboring
+  cells of each bin need to be considered.
+  """
+  d = grid.dimensionality
+  n_bins = len(codes)
+  bin_centers = grid.GetBinCenters(codes)
+  radius = npy.sqrt(2.0 * max_bias / npy.min(springs, axis=0))
+  periodic = grid.periods > 0
+  cell = radius.copy()
+  n_cells = npy.ones(d, dtype=npy.int64)
+  n_cells[periodic] = npy.maximum(npy.floor(grid.periods[periodic] / radius[periodic]), 1).astype(npy.int64)
+  cell[periodic] = grid.periods[periodic] / n_cells[periodic]
+
+  def Cells(x):
+    c = npy.floor((x - grid.mins) / cell).astype(npy.int64)
+    c[:, periodic] %= n_cells[periodic]
+    return c
+  window_cells = Cells(centers)
+  bin_cells = Cells(bin_centers)
+  lo = npy.minimum(window_cells.min(axis=0), bin_cells.min(axis=0)) - 1
+  lo[periodic] = 0
+  dims = npy.maximum(window_cells.max(axis=0), bin_cells.max(axis=0)) - lo + 2
+  dims[periodic] = n_cells[periodic]
+  cell_strides = npy.array([npy.prod(dims[i + 1:]) for i in range(d)], dtype=npy.int64)
+
+  def CellCodes(c):
+    c = c.copy()
+    c[:, periodic] %= n_cells[periodic]
+    return npy.dot(c - lo, cell_strides)
+  window_codes = CellCodes(window_cells)
+  order = npy.argsort(window_codes, kind="mergesort")
+  sorted_codes = window_codes[order]
+  windows, bins, biases = [], [], []
+  offsets = npy.array(list(itertools.product([-1, 0, 1], repeat=d)), dtype=npy.int64)
+  chunk = 20000
+  for start in range(0, n_bins, chunk):
+    b_range = npy.arange(start, min(start + chunk, n_bins))
+    for offset in offsets:
+      c = CellCodes(bin_cells[b_range] + offset)
+      first = npy.searchsorted(sorted_codes, c, "left")
+      n = npy.searchsorted(sorted_codes, c, "right") - first
+      total = int(npy.sum(n))
+      if total == 0:
+        continue
+      b = npy.repeat(b_range, n)
+      within = npy.arange(total) - npy.repeat(npy.cumsum(n) - n, n)
+      w = order[npy.repeat(first, n) + within]
+      delta = grid.Delta(bin_centers[b], centers[w])
+      u = 0.5 * npy.sum(springs[w] * delta * delta, axis=1)
+      keep = u < max_bias
+      windows.append(w[keep])
+      bins.append(b[keep])
+      biases.append(u[keep])
+  if not windows:
+    return npy.zeros(0, dtype=int), npy.zeros(0, dtype=int), npy.zeros(0)
+  windows = npy.concatenate(windows)
+  bins = npy.concatenate(bins)
+  biases = npy.concatenate(biases)
+  # With few cells along a periodic CV, neighboring cells can be the same cell
+  code, first = npy.unique(windows.astype(npy.int64) * n_bins + bins, return_index=True)
+  return windows[first], bins[first], biases[first]
+
+
+def _InitialFreeEnergies(n_windows, count_windows, count_bins, counts, n_samples, bias, kT):
+  """
+  Initial guess of the free energies of the windows. Within one window, *-kT ln(n(b)/N) - U(b)* equals *F(b)-f*
+  up to the noise, so two windows sampling bin *b* give an estimate of the difference of their *f*. For each bin,
+  the differences between the window with most samples and the other windows are averaged over the bins (weighted
+  by their inverse variance) and the free energies are the weighted least squares solution of all these differences,
+  obtained with conjugate gradients.
+  """
+  a = -kT * npy.log(counts / n_samples[count_windows]) - bias
+  order = npy.lexsort((-counts, count_bins))
+  b_sorted = count_bins[order]
+  first = npy.concatenate([[True], b_sorted[1:] != b_sorted[:-1]])
+  ref = order[first][npy.cumsum(first) - 1]
+  other = order
+  mask = count_windows[other] != count_windows[ref]
+  ref = ref[mask]
+  other = other[mask]
+  f = npy.zeros(n_windows)
+  if len(ref) == 0:
+    return f
+  w = 1.0 / (1.0 / counts[ref] + 1.0 / counts[other])
+  code = count_windows[ref].astype(npy.int64) * n_windows + count_windows[other]
+  ucode, inv = npy.unique(code, return_inverse=True)
+  weights = npy.bincount(inv, weights=w)
+  delta = npy.bincount(inv, weights=w * (a[other] - a[ref])) / weights
+  i = (ucode // n_windows).astype(int)
+  j = (ucode % n_windows).astype(int)
+
+  def Laplacian(x):
+    dx = weights * (x[i] - x[j])
+    return npy.bincount(i, weights=dx, minlength=n_windows) - npy.bincount(j, weights=dx, minlength=n_windows)
+  rhs = npy.bincount(i, weights=weights * delta, minlength=n_windows) - \
+      npy.bincount(j, weights=weights * delta, minlength=n_windows)
+  r = rhs - Laplacian(f)
+  p = r.copy()
+  rr = npy.dot(r, r)
+  for it in range(10 * n_windows):
+    if rr <= 1e-20 * npy.dot(rhs, rhs):
+      break
+    lp = Laplacian(p)
+    alpha = rr / npy.dot(p, lp)
+    f += alpha * p
+    r -= alpha * lp
+    rr_new = npy.dot(r, r)
+    p = r + rr_new / rr * p
+    rr = rr_new
+  return f - f[0]
+
+
+def _Contains(sorted_values, values):
+  """
+  Whether each of *values* is in the sorted array *sorted_values*.
+  """
+  if len(sorted_values) == 0:
+    return npy.zeros(len(values), dtype=bool)
+  pos = npy.minimum(npy.searchsorted(sorted_values, values), len(sorted_values) - 1)
+  return sorted_values[pos] == values
+
+
+def _FreeEnergyChanges(grid, codes, free):
+  """
+  Change of the free energy across each of the bins of *grid* given by their flat indices (sorted) and free energies:
+  the sum over the CVs of the absolute centered differences with the neighboring bins with data (one-sided differences
+  if only one neighbor has data, 0 if none has).
+  """
+  d = grid.dimensionality
+  idx = grid.GetBaseIndices(codes)
+  changes = npy.zeros(len(codes))
+  for i in range(d):
+    step = npy.zeros(d, dtype=npy.int64)
+    step[i] = 1
+    total = npy.zeros(len(codes))
+    n = npy.zeros(len(codes))
+    for sign in [1, -1]:
+      flat = grid.GetFlatIndices(idx + sign * step)
+      found = (flat >= 0) & _Contains(codes, flat)
+      pos = npy.searchsorted(codes, flat[found])
+      total[found] += sign * (free[pos] - free[found])
+      n[found] += 1
+    changes[n > 0] += npy.abs(total[n > 0] / n[n > 0])
+  return changes
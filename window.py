@@ -4,14 +4,12 @@
 This file contains the :class:`Window` object which represents a simulation window.
 """
 import os
-import subprocess
 import logging
 import numpy as npy
-import scipy.interpolate
-import matplotlib.pyplot as plt
 import itertools
 from phase import Phase
 import pickle
+from colvars import ColvarFormat
 
 
 class Window():
@@ -70,13 +68,15 @@ class Window():
 
   def Initialize(self):
     logging.info("New window: {0}".format(self))
-    if os.path.isdir(self.subdir):
+    fs_snapshot = self.system.fs_snapshot
+    if fs_snapshot.IsDir(self.subdir):
       logging.error(
           "Directory already exists, program stops to avoid overwriting {0}.".format(self.subdir))
       raise IOError(
           "Directory already exists, program stops to avoid overwriting {0}.".format(self.subdir))
-    r = subprocess.call(["mkdir", self.subdir])
-    if r != 0:
+    try:
+      fs_snapshot.MakeDirs([self.subdir])
+    except OSError:
       logging.error(
           "Problem creating output directory {0}.".format(self.subdir))
       raise IOError(
@@ -92,7 +92,7 @@ class Window():
     pickle.dump(d, f)
     f.close()
 
-  def SubmitNextPhase(self, environment):
+  def SubmitNextPhase(self, environment, submit=True, walker=0):
     """
     Automatically creates the appropriate next :class:`Phase` and corresponding :class:`Job` and
     submits it to the cluster. What the appropriate next phase is, is determined as follows:
@@ -101,37 +101,148 @@ class Window():
     a run phase using as restart its *init_restartdir*
     - If the window has a parent phase does not contain any phase yet, the new phase will be
     an initialization phase using as restart the last phase of the parent phase.
+    If *System.restart_from_nearest_sample* is set and the environment has a *restart_extractor*,
+    the initialization phase is instead restarted from the frame closest to the center of the window
+    among all the phases of all windows (see *System.FindNearestFrames*).
     - If the window already contains one or several phases, the new phase will be
     an run phase using as restart the last phase of this window.
 
+    With several walkers (see *System.n_walkers*), each walker is its own chain of run phases, named
+    *w{walker}_phase{n}* for the walkers other than the first. The first phase of such a walker is restarted
+    from the first walker (see *StartWalker*), the following ones from the last phase of the walker.
+
     :param environment: The environment used to submit the job to the cluster.
+    :param submit: Submit the job of the new phase. If *False*, the phase and its job are only prepared,
+     e.g. to be submitted later in a bundle (see :class:`~packing.JobPacker`).
+    :param walker: Index of the walker for which the phase is submitted.
     :type environment: :class:`~environment.Environment`
+    :type submit: :class:`bool`
+    :type walker: :class:`int`
+
+    :returns: The new phase
     """
-    if self.is_new:
+    if walker > 0:
+      chain = self.GetWalkerPhases(walker)
+      if chain:
+        self.phases.append(Phase(self, self.GetPhaseName(walker, self.GetNRunPhases(walker) + 1), "run",
+                                 chain[-1], walker))
+      else:
+        self.StartWalker(environment, walker)
+    elif self.is_new:
       if self.parent:
         phase_name = "initialization"
         phase_type = "initialization"
-        restart_phase = self.parent.phases[-1]
-        self.phases.append(Phase(self, phase_name, phase_type, restart_phase))
+        nearest = None
+        if self.system.restart_from_nearest_sample and environment.restart_extractor:
+          nearest = self.system.FindNearestFrames(self.cv_values, 1)
+        if nearest:
+          d, restart_phase, frame, cv_values = nearest[0]
+          logging.info("Restarting {0} from frame {1} of {2} in {3} (CVs {4})".format(
+              self.name, frame, restart_phase.name, restart_phase.window.name, list(cv_values)))
+          self.phases.append(
+              Phase(self, phase_name, phase_type, restart_phase))
+          self.phases[-1].SetRestartFrame(frame, cv_values)
+        else:
+          restart_phase = self.parent.phases[-1]
+          self.phases.append(
+              Phase(self, phase_name, phase_type, restart_phase))
       else:
         phase_name = "phase1"
         phase_type = "run"
         self.phases.append(Phase(self, phase_name, phase_type))
       self.is_new = False
     else:
-      phase_name = "phase" + str(self.n_run_phases + 1)
+      phase_name = self.GetPhaseName(0, self.GetNRunPhases(0) + 1)
       phase_type = "run"
-      self.phases.append(Phase(self, phase_name, phase_type, self.phases[-1]))
+      self.phases.append(Phase(self, phase_name, phase_type, self.GetWalkerPhases(0)[-1]))
     next_phase = self.phases[-1]
     next_phase.Initialize()
-    next_phase.job.Submit(environment)
+    if next_phase.restart_frame is not None:
+      next_phase.ExtractRestart(environment)
+    if submit:
+      next_phase.job.Submit(environment)
+    return next_phase
+
+  def SubmitChain(self, environment, n_phases, walker=0):
+    """
+    Submit *n_phases* run phases following the last phase of a walker of the window. Each phase is restarted from the
+    previous one and its job only starts once the job of the previous phase has finished successfully
+    (see *Environment.dependency_option*).
+
+    :param environment: The environment used to submit the jobs to the cluster.
+    :param n_phases: The number of phases to submit
+    :param walker: Index of the walker
+    :type environment: :class:`~environment.Environment`
+    :type n_phases: :class:`int`
+    :type walker: :class:`int`
+    """
+    for i in range(n_phases):
+      previous = self.GetWalkerPhases(walker)[-1]
+      phase = Phase(self, self.GetPhaseName(walker, self.GetNRunPhases(walker) + 1), "run", previous, walker)
+      self.phases.append(phase)
+      phase.Initialize()
+      phase.job.Submit(environment, previous.job.jid)
+    return n_phases
+
+  def StartWalker(self, environment, walker):
+    """
+    Add the first phase of an additional walker. It is restarted from the last run phase of the first walker
+    that has data, or if there is none, from its first phase. If the environment has a *restart_extractor*
+    and the phase has data, each walker is restarted from a different frame of the trajectory of that phase
+    (frame *walker * n_frames / System.n_walkers*, see *System.GetFrameSamples*), otherwise from its last frame. Walkers restarted from the same frame
+    only decorrelate if the run input draws new initial velocities (e.g. with a seed depending on {PHASE}).
+
+    :param environment: The environment used to extract the restart files
+    :param walker: Index of the walker
+    :type environment: :class:`~environment.Environment`
+    :type walker: :class:`int`
+    """
+    chain = self.GetWalkerPhases(0)
+    finished = [p for p in chain if p.type == "run" and p.n_data > 0]
+    source = finished[-1] if finished else chain[0]
+    phase = Phase(self, self.GetPhaseName(walker, 1), "run", source, walker)
+    self.phases.append(phase)
+    if source.n_data > 0 and getattr(environment, "restart_extractor", None):
+      t, cvs = source.ReadDataFile()
+      # Frames of the trajectory, not lines of the datafile (see *System.samples_per_frame*)
+      samples = self.system.GetFrameSamples(len(t))
+      if len(samples) > 0:
+        frame = (walker * len(samples)) // max(self.system.n_walkers, walker + 1)
+        phase.SetRestartFrame(frame, [cv[samples[frame]] for cv in cvs])
+    return phase
+
+  def GetWalkerPhases(self, walker):
+    """
+    The phases of a walker, in the order in which they were run.
+    """
+    return [p for p in self.phases if getattr(p, "walker", 0) == walker]
+
+  def GetPhaseName(self, walker, n):
+    """
+    Name of the *n*-th run phase of a walker.
+    """
+    if walker == 0:
+      return "phase" + str(n)
+    return "w{0}_phase{1}".format(walker, n)
+
+  def GetNRunPhases(self, walker=None):
+    """
+    Number of run phases of the window (of one of its walkers if *walker* is given),
+    including the ones that are not finished yet.
+    """
+    return len([p for p in self.phases if p.type == "run" and (walker is None or getattr(p, "walker", 0) == walker)])
 
-  def UpdateDataCount(self):
+  def UpdateDataCount(self, running_phases=()):
     """
     Update the total number of data accumulated for this window (sum over the data in each phase of the window).
+
+    :param running_phases: Phases that are not finished yet, whose data is not counted.
+    :type running_phases: :class:`set` (:class:`~phase.Phase`)
     """
     self.n_data = 0
     for phase in self.phases:
+      if phase in running_phases:
+        continue
       phase.UpdateDataCount()
       self.n_data += phase.GetDataCount()
 
@@ -152,31 +263,29 @@ class Window():
     if not new_only:
       self.datafile_n_data_tot = 0
       self.datafile_n_data_skipped = 0
-      if os.path.isfile(self.path_to_datafile):
-        subprocess.call(["rm", self.path_to_datafile])
+      if self.system.fs_snapshot.IsFile(self.path_to_datafile):
+        self.system.fs_snapshot.Remove(self.path_to_datafile)
     for phase in self.phases:
       phase.AddDataToWindow(n_skip, n_tot, new_only)
 
   def ReadDataFile(self):
     """
     Reads the datafile of the window and returns a tuple with
-    the list of times as the first element. The second element in
-    the tuple is a list containing one list of values for each CV.
+    the array of times as the first element. The second element in
+    the tuple is an array containing one row of values for each CV.
     """
-    f = open(self.path_to_datafile, "r")
-    ll = f.readlines()
-    f.close()
-    t = []
-    cvs = [[] for i in range(self.system.dimensionality)]
-    for l in ll:
-      s = l.split()
-      t.append(float(s[0]))
-      for i in range(self.system.dimensionality):
-        cvs[i].append(float(s[i + 1]))
-    return (t, cvs)
+    return _ReadWindowDataFile(self.path_to_datafile, self.system.dimensionality)
 
   def FindPhase(self, phase_name):
     for p in self.phases:
       if p.name == phase_name:
         return p
     return None
+
+
+def _ReadWindowDataFile(path_to_datafile, dimensionality):
+  """
+  Reads a window datafile and returns a tuple with the array of times and
+  an array containing one row of values for each CV.
+  """
+  return ColvarFormat().Read(path_to_datafile, dimensionality)